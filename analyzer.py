@@ -1,199 +1,357 @@
 # -*- coding: utf-8 -*-
 import os
+import time
+import queue
+import threading
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
-from tqdm import tqdm
-import matplotlib
-
-# 強制使用 Agg 後端以確保在 GitHub Actions 等無界面環境穩定執行
-matplotlib.use('Agg')
-
-# 字體設定 (支援中日韓字元，確保簡繁中、日、韓文顯示正常)
-plt.rcParams['font.sans-serif'] = ['Noto Sans CJK TC', 'Noto Sans CJK JP', 'Noto Sans CJK KR', 'Microsoft JhengHei', 'Arial Unicode MS', 'sans-serif']
-plt.rcParams['axes.unicode_minus'] = False
+from dayk_io import read_tail_arrays, read_tails
+import price_store
+import panel_cache
+import chart_render
+import warehouse
+import metrics
 
 # 基礎分箱設定
 BIN_SIZE = 10.0
 X_MIN, X_MAX = -100, 100
 BINS = np.arange(X_MIN, X_MAX + 1, BIN_SIZE)
 
+# 從 dayK 檔尾讀取的 K 棒數 (需大於最長回溯期 250 日)
+ANALYSIS_ROWS = 260
+
+# 智慧連結引擎：各市場技術線圖的 (網址樣板, 代號正規化)，每檔只格式化一次
+MARKET_URL_TEMPLATES = {
+    # 🇺🇸 美股連結：StockCharts
+    "us-share": ("https://stockcharts.com/sc3/ui/?s={code}", lambda t: t),
+    # 🇭🇰 港股連結：AASTOCKS (補足5位數)
+    "hk-share": ("https://www.aastocks.com/tc/stocks/quote/stocktrend.aspx?symbol={code}",
+                 lambda t: t.replace(".HK", "").strip().zfill(5)),
+    # 🇨🇳 中國 A 股連結：東方財富 (識別 sh/sz)
+    "cn-share": ("https://quote.eastmoney.com/{code}.html", lambda t: ("sh" if t.startswith('6') else "sz") + t),
+    # 🇯🇵 日本連結：樂天證券 (Rakuten Securities)，格式範例：7203.T
+    "jp-share": ("https://www.rakuten-sec.co.jp/web/market/search/quote.html?ric={code}",
+                 lambda t: t if ".T" in t.upper() else f"{t.split('.')[0]}.T"),
+    # 🇰🇷 韓國連結：Naver Finance (僅接受純數字代碼，去除 .KS 或 .KQ)
+    "kr-share": ("https://finance.naver.com/item/main.naver?code={code}", lambda t: t.split('.')[0]),
+}
+# 🇹🇼 台股連結：玩股網
+DEFAULT_URL_TEMPLATE = ("https://www.wantgoo.com/stock/{code}/technical-chart", lambda t: t.split('.')[0])
+
+def url_parts(market_id):
+    """預先拆解網址樣板為 (前綴, 後綴, 代號正規化)，大量產生連結時直接字串串接"""
+    template, normalize = MARKET_URL_TEMPLATES.get(market_id.lower(), DEFAULT_URL_TEMPLATE)
+    prefix, suffix = template.split("{code}")
+    return prefix, suffix, normalize
+
 def get_market_url(market_id, ticker):
     """
     智慧連結引擎：根據市場別生成對應的技術線圖連結
     """
-    m_id = market_id.lower()
-    
-    if m_id == "us-share":
-        # 🇺🇸 美股連結：StockCharts
-        return f"https://stockcharts.com/sc3/ui/?s={ticker}"
-    
-    elif m_id == "hk-share":
-        # 🇭🇰 港股連結：AASTOCKS (補足5位數)
-        clean_code = ticker.replace(".HK", "").strip().zfill(5)
-        return f"https://www.aastocks.com/tc/stocks/quote/stocktrend.aspx?symbol={clean_code}"
-
-    elif m_id == "cn-share":
-        # 🇨🇳 中國 A 股連結：東方財富 (識別 sh/sz)
-        prefix = "sh" if ticker.startswith('6') else "sz"
-        return f"https://quote.eastmoney.com/{prefix}{ticker}.html"
-
-    elif m_id == "jp-share":
-        # 🇯🇵 日本連結：樂天證券 (Rakuten Securities)
-        # 格式範例：7203.T
-        clean_ticker = ticker if ".T" in ticker.upper() else f"{ticker.split('.')[0]}.T"
-        return f"https://www.rakuten-sec.co.jp/web/market/search/quote.html?ric={clean_ticker}"
-
-    elif m_id == "kr-share":
-        # 🇰🇷 韓國連結：Naver Finance
-        # 邏輯：Naver 僅接受純數字代碼，去除 .KS 或 .KQ
-        clean_code = ticker.split('.')[0]
-        return f"https://finance.naver.com/item/main.naver?code={clean_code}"
+    prefix, suffix, normalize = url_parts(market_id)
+    return f"{prefix}{normalize(ticker)}{suffix}"
 
-    else:
-        # 🇹🇼 台股連結：玩股網
-        clean_ticker = ticker.split('.')[0]
-        return f"https://www.wantgoo.com/stock/{clean_ticker}/technical-chart"
+def assign_bins(arr_pct, bins):
+    """
+    一次排序完成分箱：bins 為遞增邊界，[bins[i], bins[i+1]) 為第 i 區，>= bins[-1] 為極端區
+    回傳每區的索引陣列 (共 len(bins) 組)；區內維持原順序，極端區依報酬由高到低 (同值維持原順序)
+    NaN 與低於 bins[0] 者不列入任何區間
+    """
+    arr = np.asarray(arr_pct, dtype=np.float64)
+    edges = np.asarray(bins, dtype=np.float64)
+    n_bins = len(edges) - 1
+    idx = np.digitize(arr, edges) - 1
+    idx[np.isnan(arr)] = -1
+    # lexsort 為穩定排序：主鍵為區間，極端區內次鍵為負報酬
+    order = np.lexsort((np.where(idx == n_bins, -arr, 0.0), idx))
+    order = order[idx[order] >= 0]
+    counts = np.bincount(idx[order], minlength=n_bins + 1)
+    return np.split(order, np.cumsum(counts)[:-1])
 
 def build_company_list(arr_pct, codes, names, bins, market_id):
     """
     產出 HTML 格式的分箱清單，支援動態超連結與飆股高亮
+    bins 為任意遞增分箱邊界，最後一個邊界以上列為極端飆股
     """
     lines = [f"{'報酬區間':<12} | {'家數(比例)':<14} | 公司清單", "-"*80]
-    total = len(arr_pct)
-    
-    def make_link(i):
-        url = get_market_url(market_id, codes[i])
-        return f'<a href="{url}" style="text-decoration:none; color:#0366d6;">{codes[i]}({names[i]})</a>'
-
-    for lo in range(int(X_MIN), int(X_MAX), int(BIN_SIZE)):
-        up = lo + 10
-        lab = f"{lo}%~{up}%"
-        mask = (arr_pct >= lo) & (arr_pct < up)
-        cnt = int(mask.sum())
+    arr = np.asarray(arr_pct, dtype=np.float64)
+    edges = np.asarray(bins, dtype=np.float64)
+    total = len(arr)
+    pre, suf, normalize = url_parts(market_id)
+    groups = [g.tolist() for g in assign_bins(arr, edges)]
+
+    for b, picked in enumerate(groups[:-1]):
+        cnt = len(picked)
         if cnt == 0: continue
-        
-        picked_indices = np.where(mask)[0]
-        links = [make_link(idx) for idx in picked_indices]
-        lines.append(f"{lab:<12} | {cnt:>4} ({(cnt/total*100):5.1f}%) | {', '.join(links)}")
-
-    # 處理 > 100% 的極端飆股
-    extreme_mask = (arr_pct >= 100)
-    e_cnt = int(extreme_mask.sum())
+        lab = f"{edges[b]:g}%~{edges[b + 1]:g}%"
+        links = ', '.join([f'<a href="{pre}{normalize(codes[i])}{suf}" style="text-decoration:none; color:#0366d6;">{codes[i]}({names[i]})</a>'
+                           for i in picked])
+        lines.append(f"{lab:<12} | {cnt:>4} ({(cnt/total*100):5.1f}%) | {links}")
+
+    # 處理超過最後邊界 (預設 100%) 的極端飆股，已依報酬由高到低排序
+    e_picked = groups[-1]
+    e_cnt = len(e_picked)
     if e_cnt > 0:
-        e_picked = np.where(extreme_mask)[0]
-        sorted_e = sorted(e_picked, key=lambda idx: arr_pct[idx], reverse=True)
-        e_links = []
-        for idx in sorted_e:
-            url = get_market_url(market_id, codes[idx])
-            e_links.append(f'<a href="{url}" style="text-decoration:none; color:red; font-weight:bold;">{codes[idx]}({names[idx]}:{arr_pct[idx]:.0f}%)</a>')
-        
-        lines.append(f"{' > 100%':<12} | {e_cnt:>4} ({(e_cnt/total*100):5.1f}%) | {', '.join(e_links)}")
+        e_links = ', '.join([f'<a href="{pre}{normalize(codes[i])}{suf}" style="text-decoration:none; color:red; font-weight:bold;">{codes[i]}({names[i]}:{arr[i]:.0f}%)</a>'
+                             for i in e_picked])
+        lines.append(f"{' > ' + format(edges[-1], 'g') + '%':<12} | {e_cnt:>4} ({(e_cnt/total*100):5.1f}%) | {e_links}")
 
     return "\n".join(lines)
 
+def parse_identity(stem, market_id):
+    """由檔名解析 (代號, 名稱)"""
+    # 多國檔名解析策略
+    if market_id in ["hk-share", "jp-share", "kr-share"]:
+        # 港日韓多為單一代號格式 (如 7203.T.csv 或 005930.KS.csv)
+        return stem, stem
+    elif "_" in stem:
+        # 台、美、中 (如 AAPL_Apple.csv 或 600519_貴州茅台.csv)
+        tkr, nm = stem.split('_', 1)
+        return tkr, nm
+    return stem, stem
+
+# 週/月/年 回溯交易日數；計算只需最後 RETURN_WINDOW 根 K 棒
+PERIODS = [('Week', 5), ('Month', 20), ('Year', 250)]
+RETURN_WINDOW = max(d for _, d in PERIODS) + 1
+# K 棒少於此數的標的不列入統計
+MIN_BARS = 20
+
+def align_right(close, high, low, present=None, window=RETURN_WINDOW):
+    """
+    將 (標的 × 日期) 矩陣中存在的 K 棒向右靠齊並只留最後 window 欄
+    present: 該檔該日是否有 K 棒 (面板的 present 遮罩)；CSV 中價格為 NaN 的列仍是一根 K 棒，
+    值保留為 NaN 而不被略過，靠齊後的位置才與逐檔 CSV 一致。省略時以 close 非 NaN 判斷
+    """
+    close = np.asarray(close, dtype=np.float64)
+    valid = ~np.isnan(close) if present is None else np.asarray(present, dtype=bool)
+    # stable 排序：NaN 移到左側，有效 K 棒保持時間順序
+    order = np.argsort(valid, axis=1, kind='stable')[:, -window:]
+    out = [np.take_along_axis(np.asarray(a, dtype=np.float64), order, axis=1) for a in (close, high, low)]
+    pad = window - out[0].shape[1]
+    if pad > 0:
+        out = [np.pad(a, ((0, 0), (pad, 0)), constant_values=np.nan) for a in out]
+    return out[0], out[1], out[2], valid.sum(axis=1)
+
+def stack_arrays(arrays, window=RETURN_WINDOW):
+    """將逐檔 [列 × (close, high, low)] 陣列疊成右靠齊的矩陣 (K 棒數以讀入列數計)"""
+    mats = np.full((3, len(arrays), window), np.nan)
+    counts = np.zeros(len(arrays), dtype=np.int64)
+    for i, vals in enumerate(arrays):
+        tail = vals[-window:]
+        counts[i] = len(vals)
+        mats[:, i, window - len(tail):] = tail.T
+    return mats[0], mats[1], mats[2], counts
+
+def frame_matrix(prices, window=RETURN_WINDOW):
+    """將長表 (stem, date, close, high, low；依 stem、date 排序) 轉為右靠齊的矩陣"""
+    codes, stems = pd.factorize(prices['stem'], sort=False)
+    # 由每檔最後一根往前編號，直接決定欄位位置
+    pos = prices.groupby(codes, sort=False).cumcount(ascending=False).to_numpy()
+    keep = pos < window
+    mats = np.full((3, len(stems), window), np.nan)
+    for k, f in enumerate(("close", "high", "low")):
+        mats[k, codes[keep], window - 1 - pos[keep]] = prices[f].to_numpy(dtype=np.float64)[keep]
+    counts = np.bincount(codes, minlength=len(stems))
+    return list(stems), mats[0], mats[1], mats[2], counts
+
+def _window_extreme(a, days, reduce):
+    """最後 days 欄的最高/最低值，略過 NaN (同逐檔版以 max() 略過缺值)；整段皆為 NaN 時為 NaN"""
+    win = a[:, -days:]
+    has = ~np.isnan(win).all(axis=1)
+    out = np.full(len(win), np.nan)
+    out[has] = reduce(win[has], axis=1)
+    return out
+
+def compute_returns(stems, close, high, low, market_id, counts=None, names=None):
+    """
+    全市場一次計算週/月/年 最高、收盤、最低報酬 (%)
+    close/high/low: (標的 × 日期) 矩陣；counts 省略時以 close 非 NaN 數計算並自動靠齊
+    names: {stem: 名稱} (倉儲 stock_info)；省略時由檔名解析
+    K 棒不足或前收盤 <= 0 的期間以遮罩設為 NaN；全部標的皆無值的期間欄位不輸出
+    """
+    t0 = time.perf_counter()
+    if counts is None:
+        close, high, low, counts = align_right(close, high, low)
+    counts = np.asarray(counts)
+    keep = counts >= MIN_BARS
+    close, high, low, counts = close[keep], high[keep], low[keep], counts[keep]
+    if names is None:
+        names = [parse_identity(s, market_id) for s, k in zip(stems, keep) if k]
+    else:
+        names = [(s, names.get(s) or s) for s, k in zip(stems, keep) if k]
+
+    cols = {'Ticker': [t for t, _ in names], 'Full_Name': [n for _, n in names]}
+    last = close[:, -1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for p_name, days in PERIODS:
+            prev_c = close[:, -(days + 1)]
+            ok = (counts > days) & ~(prev_c <= 0)
+            for t_name, val in (('High', _window_extreme(high, days, np.nanmax)),
+                                ('Close', last),
+                                ('Low', _window_extreme(low, days, np.nanmin))):
+                ret = np.where(ok, (val - prev_c) / prev_c * 100, np.nan)
+                if ok.any():
+                    cols[f'{p_name}_{t_name}'] = ret
+    df = pd.DataFrame(cols)
+    metrics.observe("compute_seconds", time.perf_counter() - t0, market=market_id)
+    return df
+
 def run_global_analysis(market_id="tw-share"):
     """
     分析主邏輯：讀取 CSV -> 計算回報率 -> 繪製分布圖 -> 生成文字報表
     """
     market_label = market_id.upper()
     print(f"📊 正在啟動 {market_label} 深度矩陣分析...")
-    
+    return build_outputs(market_id, load_returns(market_id))
+
+def load_returns(market_id):
+    """依市場的儲存方式讀入最後 RETURN_WINDOW 根 K 棒並計算報酬；無資料時回傳空 DataFrame"""
+    # SQLite 倉儲 (港股/日股)：單一索引查詢取得每檔最後 RETURN_WINDOW 根 K 棒與名稱
+    t0 = time.perf_counter()
+    loaded = warehouse.load_window(market_id, RETURN_WINDOW)
+    if loaded is not None:
+        prices, names = loaded
+        stems, close, high, low, counts = frame_matrix(prices)
+        metrics.observe("ingest_seconds", time.perf_counter() - t0, market=market_id, source="warehouse")
+        return compute_returns(stems, close, high, low, market_id, counts, names)
+
+    # 欄式倉儲 (PRICE_STORE=parquet)：一次讀入整個市場，不必逐檔解析 CSV
+    t0 = time.perf_counter()
+    prices = price_store.load_for_analysis(market_id)
+    if prices is not None:
+        stems, close, high, low, counts = frame_matrix(prices)
+        metrics.observe("ingest_seconds", time.perf_counter() - t0, market=market_id, source="parquet")
+        return compute_returns(stems, close, high, low, market_id, counts)
+
     data_path = Path("./data") / market_id / "dayK"
-    image_out_dir = Path("./output/images") / market_id
-    image_out_dir.mkdir(parents=True, exist_ok=True)
     
     all_files = list(data_path.glob("*.csv"))
     if not all_files:
         print(f"⚠️ 找不到 {market_id} 的 CSV 數據檔案。")
-        return [], pd.DataFrame(), {}
+        return pd.DataFrame()
 
-    results = []
-    for f in tqdm(all_files, desc=f"分析 {market_label} 數據"):
+    # 面板快取：只讀取有變動的檔尾並附加新交易日，歷史資料直接由 memmap 取用
+    panel = None
+    if panel_cache.enabled():
+        t0 = time.perf_counter()
         try:
-            df = pd.read_csv(f)
-            if len(df) < 20: continue
-            df.columns = [c.lower() for c in df.columns]
-            close, high, low = df['close'].values, df['high'].values, df['low'].values
-            
-            # 解析代號與名稱
-            stem = f.name.replace(".csv", "")
-            
-            # 多國檔名解析策略
-            if market_id in ["hk-share", "jp-share", "kr-share"]:
-                # 港日韓多為單一代號格式 (如 7203.T.csv 或 005930.KS.csv)
-                tkr = stem
-                nm = stem
-            elif "_" in stem:
-                # 台、美、中 (如 AAPL_Apple.csv 或 600519_貴州茅台.csv)
-                tkr, nm = stem.split('_', 1)
-            else:
-                tkr, nm = stem, stem
-                
-            row = {'Ticker': tkr, 'Full_Name': nm}
-            
-            periods = [('Week', 5), ('Month', 20), ('Year', 250)]
-            for p_name, days in periods:
-                if len(close) <= days: continue
-                prev_c = close[-(days+1)]
-                if prev_c <= 0: continue
-                row[f'{p_name}_High'] = (max(high[-days:]) - prev_c) / prev_c * 100
-                row[f'{p_name}_Close'] = (close[-1] - prev_c) / prev_c * 100
-                row[f'{p_name}_Low'] = (min(low[-days:]) - prev_c) / prev_c * 100
-            results.append(row)
-        except: continue
-
-    df_res = pd.DataFrame(results)
-    if df_res.empty: return [], df_res, {}
+            panel = panel_cache.sync_panel(market_id, data_path)
+        except Exception as e:
+            print(f"⚠️ 面板快取同步失敗，改為逐檔讀取: {e}")
+    if panel is not None:
+        metrics.observe("ingest_seconds", time.perf_counter() - t0, market=market_id, source="panel")
+        close, high, low, counts = align_right(panel['close'], panel['high'], panel['low'], panel[panel_cache.PRESENT])
+        return compute_returns(panel.tickers, close, high, low, market_id, counts)
+
+    # 逐檔讀取：以程序池平行解析檔尾，只取 close/high/low 三欄
+    with metrics.timer("ingest_seconds", market=market_id, source="csv"):
+        tails = read_tails(all_files, ANALYSIS_ROWS, with_dates=False)
+        stems = [f.name.replace(".csv", "") for f, t in zip(all_files, tails) if t is not None]
+        close, high, low, counts = stack_arrays([t[1] for t in tails if t is not None])
+    return compute_returns(stems, close, high, low, market_id, counts)
+
+class StreamingAnalysis:
+    """
+    串流分析：下載器每完成一檔即呼叫 submit()，由背景執行緒從佇列取出並保留最後 RETURN_WINDOW 根 K 棒，
+    下載結束後 finish() 一次向量化計算並產出報表，不必再逐檔讀取整個 dayK 目錄。
+    本次下載失敗 (未送出) 但磁碟上已有 CSV 的標的，finish() 時補讀其檔尾，與非串流模式涵蓋相同標的。
+    """
+    def __init__(self, market_id):
+        self.market_id = market_id
+        self.queue = queue.Queue()
+        self.frames = {}
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def submit(self, path, df=None):
+        """
+        path: 剛寫入的 dayK CSV 路徑
+        df: 下載器手上的完整 K 線 (lower-case 欄位)；增量更新或快取命中時為 None，改由檔尾讀取
+        """
+        self.queue.put((str(path), df))
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            path, df = item
+            try:
+                if df is None or len(df) < ANALYSIS_ROWS:
+                    vals = read_tail_arrays(path, ANALYSIS_ROWS)[1]
+                else:
+                    vals = df[['close', 'high', 'low']].to_numpy(dtype=np.float64)[-ANALYSIS_ROWS:]
+                self.frames[Path(path).name.replace(".csv", "")] = vals
+            except Exception:
+                continue
 
-    # --- 繪圖邏輯 ---
-    images = []
-    color_map = {'High': '#28a745', 'Close': '#007bff', 'Low': '#dc3545'}
-    EXTREME_COLOR = '#FF4500' 
+    def _backfill(self):
+        """補讀未經 submit() 送入的既有 CSV (下載失敗的標的沿用上次的資料)"""
+        data_path = Path("./data") / self.market_id / "dayK"
+        missing = [f for f in data_path.glob("*.csv") if f.name.replace(".csv", "") not in self.frames]
+        if not missing:
+            return
+        tails = read_tails(missing, ANALYSIS_ROWS, with_dates=False)
+        n = 0
+        for f, t in zip(missing, tails):
+            if t is not None:
+                self.frames[f.name.replace(".csv", "")] = t[1]
+                n += 1
+        print(f"📂 {self.market_id.upper()} 補讀本次未更新的既有資料 {n} 檔")
+
+    def finish(self):
+        """等待佇列清空後產出與 run_global_analysis 相同格式的結果"""
+        self.queue.put(None)
+        self._thread.join()
+        self._backfill()
+        print(f"📊 {self.market_id.upper()} 串流分析完成，共 {len(self.frames)} 檔")
+        stems = sorted(self.frames)
+        close, high, low, counts = stack_arrays([self.frames[s] for s in stems])
+        return build_outputs(self.market_id, compute_returns(stems, close, high, low, self.market_id, counts))
+
+def build_chart_specs(market_id, df_res, image_out_dir):
+    """計算九張分布圖的直方圖規格"""
+    market_label = market_id.upper()
+    # --- 繪圖邏輯：直方圖在此計算，繪圖交由 chart_render 平行處理 ---
     plot_bins = np.append(BINS, X_MAX + BIN_SIZE)
+    x_labels = [f"{int(x)}%" for x in BINS] + [f">{int(X_MAX)}%"]
+    specs = []
 
     for p_n, p_z in [('Week', '週'), ('Month', '月'), ('Year', '年')]:
         for t_n, t_z in [('High', '最高-進攻'), ('Close', '收盤-實質'), ('Low', '最低-防禦')]:
             col = f"{p_n}_{t_n}"
             if col not in df_res.columns: continue
             data = df_res[col].dropna()
-            
-            fig, ax = plt.subplots(figsize=(12, 7))
-            clipped_data = np.clip(data.values, X_MIN, X_MAX + BIN_SIZE)
-            counts, edges = np.histogram(clipped_data, bins=plot_bins)
-            
-            ax.bar(edges[:-2], counts[:-1], width=9, align='edge', 
-                   color=color_map[t_n], alpha=0.7, edgecolor='white')
-            ax.bar(edges[-2], counts[-1], width=9, align='edge', 
-                   color=EXTREME_COLOR, alpha=0.9, edgecolor='black', linewidth=1.5)
-            
-            max_h = counts.max() if len(counts) > 0 else 1
-            for i, h in enumerate(counts):
-                if h > 0:
-                    x_pos = edges[i] + 4.5
-                    is_extreme = (i == len(counts) - 1)
-                    ax.text(x_pos, h + (max_h * 0.02), f'{int(h)}\n({h/len(data)*100:.1f}%)', 
-                            ha='center', va='bottom', fontsize=9, fontweight='bold', 
-                            color='red' if is_extreme else 'black')
-
-            ax.set_ylim(0, max_h * 1.4) 
-            ax.set_title(f"【{market_label}】{p_z}K {t_z} 報酬分布 (樣本:{len(data)})", fontsize=18, fontweight='bold')
-            ax.set_xticks(plot_bins)
-            x_labels = [f"{int(x)}%" for x in BINS] + [f">{int(X_MAX)}%"]
-            ax.set_xticklabels(x_labels, rotation=45)
-            ax.grid(axis='y', linestyle='--', alpha=0.3)
-            plt.tight_layout()
-            
-            img_path = image_out_dir / f"{col.lower()}.png"
-            plt.savefig(img_path, dpi=120)
-            plt.close()
-            images.append({'id': col.lower(), 'path': str(img_path), 'label': f"【{market_label}】{p_z}K {t_z}"})
+            specs.append(chart_render.make_spec(
+                col.lower(), image_out_dir / f"{col.lower()}.png", f"【{market_label}】{p_z}K {t_z}",
+                f"【{market_label}】{p_z}K {t_z} 報酬分布 (樣本:{len(data)})",
+                data.values, plot_bins, x_labels, t_n))
+    return specs
 
+def build_text_reports(market_id, df_res):
+    """週/月/年 最高報酬的分箱公司清單"""
     text_reports = {}
     for p_n in ['Week', 'Month', 'Year']:
         col = f'{p_n}_High'
         if col in df_res.columns:
-            text_reports[p_n] = build_company_list(df_res[col].values, df_res['Ticker'].tolist(), df_res['Full_Name'].tolist(), BINS, market_id)
-    
-    return images, df_res, text_reports
+            with metrics.timer("text_report_seconds", market=market_id, period=p_n):
+                text_reports[p_n] = build_company_list(df_res[col].values, df_res['Ticker'].tolist(), df_res['Full_Name'].tolist(), BINS, market_id)
+    return text_reports
+
+def build_outputs(market_id, df_res):
+    """由報酬結果產出 9 張分布圖與文字報表"""
+    market_label = market_id.upper()
+    if df_res.empty: return [], df_res, {}
+
+    image_out_dir = Path("./output/images") / market_id
+    image_out_dir.mkdir(parents=True, exist_ok=True)
+    specs = build_chart_specs(market_id, df_res, image_out_dir)
+
+    if chart_render.CHART_GRID and specs:
+        grid_path = chart_render.render_grid(specs, image_out_dir / "overview.png", f"【{market_label}】報酬分布總覽")
+        images = [{'id': 'overview', 'path': grid_path, 'label': f"【{market_label}】報酬分布總覽"}]
+    else:
+        chart_render.render_charts(specs)
+        images = [{'id': s['id'], 'path': s['path'], 'label': s['label']} for s in specs]
+
+    return images, df_res, build_text_reports(market_id, df_res)
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+離線合成市場基準測試
+- 依各市場實際的落地格式產生合成 OHLCV：TW/US/CN/KR 為 data/<market>/dayK/*.csv，HK/JP 為 SQLite 倉儲
+- 分段計時：下載落地 (寫檔/寫倉儲)、報酬分析 (冷/熱)、文字報表、繪圖、郵件報告組裝，並記錄各段峰值記憶體
+- 全程不連網；所有檔案寫在暫存工作目錄，不會動到正式 data/ 與 output/
+- 結果輸出為 JSON，可指定 --baseline 與既有結果比較，退化超過容許比例時以代碼 1 結束
+
+用法：
+  python bench.py                                    # quick：六個市場各 1000 檔 × 1 年
+  python bench.py --preset full --markets tw-share,hk-share
+  python bench.py --tickers 6000 --years 5 --repeat 3 --baseline output/bench/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import dayk_io
+import warehouse
+import price_store
+import panel_cache
+import chart_render
+import analyzer
+import notifier
+from profiler import StageMeter, max_rss_mb
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.path.join(BASE_DIR, "output", "bench")
+
+# ========== 規模設定 ==========
+PRESETS = {
+    "quick": {"tickers": [1000], "years": [1]},
+    "standard": {"tickers": [1000, 6000], "years": [1, 5]},
+    "full": {"tickers": [1000, 6000, 20000], "years": [1, 10]},
+}
+MARKETS = ["tw-share", "us-share", "cn-share", "kr-share", "hk-share", "jp-share"]
+TRADING_DAYS_PER_YEAR = 250
+# 合成資料的最後交易日固定，結果不隨執行日期變動
+END_DATE = "2024-12-31"
+# 每次產生的標的數 (控制產生器的記憶體上限)
+GEN_CHUNK = 500
+# 新上市標的比例 (只有部分 K 棒，可覆蓋 MIN_BARS 與週/月/年 遮罩)
+NEW_LISTING_RATIO = 0.03
+DAILY_DRIFT, DAILY_VOL = 0.0003, 0.02
+# RSS 取樣間隔 (秒)
+RSS_INTERVAL = 0.01
+
+# ========== 比較設定 ==========
+# 耗時增加超過此比例視為退化
+TOLERANCE = 0.2
+# 差距小於此秒數 / MB 不判定退化 (避免小規模量測雜訊)
+MIN_DELTA_SECS = 0.05
+MIN_DELTA_MB = 32
+
+# 各市場的時區 (CSV 日期格式與 yfinance 相同) 與命名方式
+MARKET_TZ = {"tw-share": "Asia/Taipei", "us-share": "America/New_York",
+             "cn-share": "Asia/Shanghai", "kr-share": "Asia/Seoul"}
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+def synthetic_identity(market, i):
+    """第 i 檔的 (檔名 stem 或倉儲代號, 名稱)，格式與各下載器一致"""
+    if market == "tw-share":
+        return f"{1000 + i}.TW_合成{i}", f"合成{i}"
+    if market == "us-share":
+        return f"SYN{i}_Synthetic {i}", f"Synthetic {i}"
+    if market == "cn-share":
+        return f"{600000 + i:06d}_合成{i}", f"合成{i}"
+    if market == "kr-share":
+        return f"{i:06d}.KS", f"{i:06d}.KS"
+    if market == "hk-share":
+        return f"{i + 1:04d}.HK", f"SYNTH HK {i}"
+    return f"{1300 + i}.T", f"合成日股{i}"
+
+def synthetic_prices(n_tickers, n_days, seed):
+    """
+    逐塊產生 (標的 × 日) 的 OHLCV：對數常態隨機漫步
+    yield (起始列, 各檔上市位置, open, high, low, close, volume)；上市位置之前的 K 棒不存在
+    """
+    rng = np.random.default_rng(seed)
+    for lo in range(0, n_tickers, GEN_CHUNK):
+        k = min(GEN_CHUNK, n_tickers - lo)
+        close = rng.uniform(5, 500, (k, 1)) * np.exp(np.cumsum(rng.normal(DAILY_DRIFT, DAILY_VOL, (k, n_days)), axis=1))
+        spread = np.abs(rng.normal(0, 0.01, (k, n_days)))
+        high = close * (1 + spread)
+        low = close * (1 - spread * rng.uniform(0, 1, (k, n_days)))
+        open_ = np.clip(close * (1 + rng.normal(0, 0.005, (k, n_days))), low, high)
+        volume = rng.integers(1_000, 10_000_000, (k, n_days))
+        listed = np.where(rng.random(k) < NEW_LISTING_RATIO, rng.integers(1, n_days, k), 0)
+        yield lo, listed, open_, high, low, close, volume
+
+class Workspace:
+    """將各模組的資料根目錄與工作目錄導向暫存區 (分析與繪圖使用相對路徑 ./data、./output)"""
+    def __init__(self, root):
+        self.root = Path(root)
+        self._saved = None
+
+    def __enter__(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._saved = (os.getcwd(), warehouse.BASE_DIR, panel_cache.BASE_DIR, price_store.BASE_DIR,
+                       chart_render.CHART_CACHE)
+        os.chdir(self.root)
+        warehouse.BASE_DIR = panel_cache.BASE_DIR = price_store.BASE_DIR = str(self.root)
+        # 每次都要實際繪圖，關閉內容雜湊快取
+        chart_render.CHART_CACHE = False
+        price_store._STORES.clear()
+        return self
+
+    def __exit__(self, *exc):
+        cwd, warehouse.BASE_DIR, panel_cache.BASE_DIR, price_store.BASE_DIR, chart_render.CHART_CACHE = self._saved
+        price_store._STORES.clear()
+        os.chdir(cwd)
+        return False
+
+    def reset(self):
+        """清空上一輪的 data/ 與 output/ (含面板與倉儲)，讓每一輪都從冷狀態開始"""
+        for sub in ("data", "output"):
+            shutil.rmtree(self.root / sub, ignore_errors=True)
+        for name in warehouse.MARKET_DBS.values():
+            for suffix in ("", "-wal", "-shm"):
+                (self.root / f"{name}{suffix}").unlink(missing_ok=True)
+        price_store._STORES.clear()
+
+def write_csv_market(market, n_tickers, n_days, seed):
+    """以下載器相同的 write_frame 落地為 dayK CSV；回傳 (產生資料秒數, 落地秒數)"""
+    out_dir = Path("data") / market / "dayK"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    dates = pd.bdate_range(end=END_DATE, periods=n_days, tz=MARKET_TZ[market], name="date")
+    gen_secs = write_secs = 0.0
+    t0 = time.perf_counter()
+    for lo, listed, o, h, l, c, v in synthetic_prices(n_tickers, n_days, seed):
+        t1 = time.perf_counter()
+        gen_secs += t1 - t0
+        for j in range(len(listed)):
+            s = listed[j]
+            df = pd.DataFrame({"date": dates[s:], "open": o[j, s:], "high": h[j, s:], "low": l[j, s:],
+                               "close": c[j, s:], "volume": v[j, s:], "dividends": 0.0, "stock splits": 0.0})
+            dayk_io.write_frame(df, out_dir / f"{synthetic_identity(market, lo + j)[0]}.csv")
+        t0 = time.perf_counter()
+        write_secs += t0 - t1
+    t1 = time.perf_counter()
+    price_store.flush(market, complete=True)
+    write_secs += time.perf_counter() - t1
+    return gen_secs, write_secs
+
+def write_warehouse_market(market, n_tickers, n_days, seed):
+    """以下載器相同的 WarehouseWriter 寫入 SQLite 倉儲；回傳 (產生資料秒數, 落地秒數)"""
+    path = warehouse.db_path(market)
+    conn = warehouse.connect(path)
+    try:
+        warehouse.init_schema(conn)
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) VALUES (?, ?, ?, ?, ?)",
+                             [(*synthetic_identity(market, i), "Synthetic", "BENCH", END_DATE) for i in range(n_tickers)])
+    finally:
+        conn.close()
+
+    dates = pd.bdate_range(end=END_DATE, periods=n_days).strftime("%Y-%m-%d")
+    gen_secs = write_secs = 0.0
+    writer = warehouse.WarehouseWriter(path)
+    t0 = time.perf_counter()
+    for lo, listed, o, h, l, c, v in synthetic_prices(n_tickers, n_days, seed):
+        t1 = time.perf_counter()
+        gen_secs += t1 - t0
+        for j in range(len(listed)):
+            s = listed[j]
+            df = pd.DataFrame({"date": dates[s:], "open": o[j, s:], "high": h[j, s:], "low": l[j, s:],
+                               "close": c[j, s:], "volume": v[j, s:]})
+            df["symbol"] = sym = synthetic_identity(market, lo + j)[0]
+            writer.put(sym, df)
+        t0 = time.perf_counter()
+        write_secs += t0 - t1
+    t1 = time.perf_counter()
+    writer.close()
+    warehouse.maintain(path)
+    write_secs += time.perf_counter() - t1
+    return gen_secs, write_secs
+
+def run_case(ws, market, n_tickers, years, seed):
+    """單一 (市場, 標的數, 年數) 的一輪完整量測；回傳 {stage: 紀錄}"""
+    n_days = years * TRADING_DAYS_PER_YEAR
+    stages = {}
+    ws.reset()
+
+    write = write_warehouse_market if market in warehouse.MARKET_DBS else write_csv_market
+    with StageMeter(RSS_INTERVAL) as m:
+        gen_secs, write_secs = write(market, n_tickers, n_days, seed)
+    stages["generate"] = m.record(gen_secs)
+    stages["download"] = m.record(write_secs)
+
+    # 冷：首次讀取 (含建立面板)；熱：資料未變動的重跑 (每日增量後的常態)
+    with StageMeter(RSS_INTERVAL) as m:
+        df_res = analyzer.load_returns(market)
+    stages["analysis"] = m.record()
+    with StageMeter(RSS_INTERVAL) as m:
+        df_res = analyzer.load_returns(market)
+    stages["analysis_warm"] = m.record()
+
+    with StageMeter(RSS_INTERVAL) as m:
+        text_reports = analyzer.build_text_reports(market, df_res)
+    stages["text_reports"] = m.record()
+
+    image_out_dir = Path("./output/images") / market
+    image_out_dir.mkdir(parents=True, exist_ok=True)
+    with StageMeter(RSS_INTERVAL) as m:
+        specs = analyzer.build_chart_specs(market, df_res, image_out_dir)
+        if chart_render.CHART_GRID:
+            path = chart_render.render_grid(specs, image_out_dir / "overview.png", market.upper())
+            images = [{'id': 'overview', 'path': path, 'label': market.upper()}]
+        else:
+            chart_render.render_charts(specs)
+            images = [{'id': s['id'], 'path': s['path'], 'label': s['label']} for s in specs]
+    stages["charts"] = m.record()
+
+    stats = {"total": n_tickers, "success": n_tickers, "fail": 0}
+    with StageMeter(RSS_INTERVAL) as m:
+        job = notifier.StockNotifier().build_report_job(market, images, df_res, text_reports, stats)
+    stages["report"] = m.record()
+    stages["report"]["payload_kb"] = round(len(json.dumps(job, ensure_ascii=False).encode("utf-8")) / 1024, 1)
+    stages["analysis"]["rows"] = int(len(df_res))
+    return stages
+
+def summarize(runs):
+    """多輪結果取最短耗時 (最少受干擾) 與最高峰值記憶體"""
+    out = {}
+    for stage in runs[0]:
+        recs = [r[stage] for r in runs]
+        best = dict(min(recs, key=lambda r: r["seconds"]))
+        best["peak_rss_mb"] = max(r["peak_rss_mb"] for r in recs)
+        best["rss_growth_mb"] = max(r["rss_growth_mb"] for r in recs)
+        if len(recs) > 1:
+            best["runs"] = [r["seconds"] for r in recs]
+        out[stage] = best
+    return out
+
+def case_key(case):
+    return f"{case['market']}/{case['tickers']}x{case['years']}y"
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """逐段比較耗時與記憶體成長；回傳退化清單 [(案例, 段落, 指標, 基準, 本次)]"""
+    base = {case_key(c): c["stages"] for c in baseline.get("cases", [])}
+    regressions = []
+    print(f"\n{'案例':<24}{'段落':<15}{'基準(s)':>10}{'本次(s)':>10}{'變化':>9}")
+    for case in results["cases"]:
+        key = case_key(case)
+        if key not in base:
+            print(f"{key:<24}(基準無此案例)")
+            continue
+        for stage, rec in case["stages"].items():
+            old = base[key].get(stage)
+            if old is None or stage == "generate":
+                continue
+            ratio = rec["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+            flag = ""
+            if ratio > 1 + tolerance and rec["seconds"] - old["seconds"] > MIN_DELTA_SECS:
+                regressions.append((key, stage, "seconds", old["seconds"], rec["seconds"]))
+                flag = " ❌"
+            grow, old_grow = rec["rss_growth_mb"], old.get("rss_growth_mb", 0.0)
+            if grow > old_grow * (1 + tolerance) and grow - old_grow > MIN_DELTA_MB:
+                regressions.append((key, stage, "rss_growth_mb", old_grow, grow))
+                flag += f" ❌ 記憶體 {old_grow:.0f}→{grow:.0f} MB"
+            print(f"{key:<24}{stage:<15}{old['seconds']:>10.3f}{rec['seconds']:>10.3f}{ratio - 1:>+9.1%}{flag}")
+    return regressions
+
+def environment():
+    """執行環境與會影響效能的設定，供比較結果時判斷是否可比"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    import matplotlib
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": {"numpy": np.__version__, "pandas": pd.__version__, "matplotlib": matplotlib.__version__},
+        "config": {k: os.getenv(k) for k in ("CHART_WORKERS", "CHART_GRID", "INGEST_WORKERS",
+                                             "PANEL_CACHE", "PANEL_DAYS", "PRICE_STORE", "MAIL_IMAGE_FORMAT")},
+    }
+
+def _int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline synthetic-market benchmark")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--markets', type=str, default='all', help='逗號分隔的市場 ID，或 all')
+    parser.add_argument('--tickers', type=_int_list, help='逗號分隔的標的數 (覆寫 preset)，例如 1000,6000,20000')
+    parser.add_argument('--years', type=_int_list, help='逗號分隔的年數 (覆寫 preset)，例如 1,10')
+    parser.add_argument('--repeat', type=int, default=1, help='每個案例重跑次數，取最短耗時')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', type=str, help='合成資料目錄 (預設為暫存目錄，結束後刪除)')
+    parser.add_argument('--keep', action='store_true', help='保留合成資料目錄')
+    parser.add_argument('--output', type=str, help='結果 JSON 路徑 (預設 output/bench/bench_<時間>.json)')
+    parser.add_argument('--baseline', type=str, help='與此結果 JSON 比較，退化時以代碼 1 結束')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='容許的耗時/記憶體成長比例')
+    args = parser.parse_args(argv)
+
+    markets = MARKETS if args.markets == 'all' else [m.strip() for m in args.markets.split(",") if m.strip()]
+    unknown = [m for m in markets if m not in MARKETS]
+    if unknown:
+        parser.error(f"未知的市場 ID: {', '.join(unknown)}")
+    tickers = args.tickers or PRESETS[args.preset]["tickers"]
+    years = args.years or PRESETS[args.preset]["years"]
+
+    output = Path(args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")).resolve()
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+    root = Path(args.workdir).resolve() if args.workdir else Path(tempfile.mkdtemp(prefix="stock_bench_"))
+    results = {"meta": environment(), "cases": []}
+    log(f"🧪 基準測試：{', '.join(markets)} | 標的數 {tickers} | 年數 {years} | 重跑 {args.repeat} 次 | 工作目錄 {root}")
+
+    try:
+        with Workspace(root) as ws:
+            for mi, market in enumerate(markets):
+                for n in tickers:
+                    for y in years:
+                        log(f"▶️ {market} {n} 檔 × {y} 年")
+                        runs = [run_case(ws, market, n, y, args.seed + mi) for _ in range(max(1, args.repeat))]
+                        case = {"market": market, "tickers": n, "years": y,
+                                "bars": n * y * TRADING_DAYS_PER_YEAR, "stages": summarize(runs)}
+                        results["cases"].append(case)
+                        log("⏱️ " + " | ".join(f"{s} {r['seconds']:.2f}s/{r['peak_rss_mb']:.0f}MB"
+                                                for s, r in case["stages"].items()))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    # 子程序 (繪圖、平行讀檔) 的峰值 RSS 無法逐段取樣，只記錄整體最大值
+    results["meta"]["children_peak_rss_mb"] = round(max_rss_mb("children"), 1)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+    log(f"💾 結果已寫入 {output}")
+
+    if baseline is not None:
+        with open(baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            log(f"❌ 共 {len(regressions)} 項超過容許退化 {args.tolerance:.0%}")
+            return 1
+        log("✅ 未發現效能退化")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+報酬分布圖繪製
+- 直方圖計數在主程序算好，工作程序只負責繪圖 (spec 為純資料，可跨程序傳遞)
+- 每個工作程序只建立一次圖表樣板，之後僅更新長條高度、標籤與標題再存檔
+- CHART_GRID=1 時改為輸出單張 3×3 總覽圖
+- 以規格內容的雜湊作為快取鍵，內容未變的圖表直接沿用既有 PNG (重跑、休市日不必重繪)
+- matplotlib 於第一次實際繪圖時才匯入 (快取全數命中的執行不需載入)
+"""
+import os
+import json
+import time
+import hashlib
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import metrics
+
+# 字體設定 (支援中日韓字元，確保簡繁中、日、韓文顯示正常)
+FONT_FAMILY = ['Noto Sans CJK TC', 'Noto Sans CJK JP', 'Noto Sans CJK KR', 'Microsoft JhengHei', 'Arial Unicode MS', 'sans-serif']
+
+# ========== 繪圖設定 ==========
+# 繪圖程序數 (九張圖分給數個程序)；設為 1 則在本程序依序繪製
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", str(min(os.cpu_count() or 1, 3))))
+CHART_GRID = os.getenv("CHART_GRID", "0") == "1"
+# 繪圖程序的啟動方式：繪圖時下載/寫入/派送等執行緒可能仍在執行，fork 會複製到它們持有中的鎖而卡死，
+# 因此改用 forkserver (由乾淨的單執行緒伺服器程序分叉)，不支援的平台用 spawn
+CHART_START_METHOD = os.getenv("CHART_START_METHOD") or (
+    "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+# 繪圖快取 (設為 0 則每次重繪)
+CHART_CACHE = os.getenv("CHART_CACHE", "1") != "0"
+CACHE_NAME = ".render_cache.json"
+# 繪圖樣式變更時遞增，使既有快取全部失效
+RENDER_VERSION = 1
+DPI = 120
+COLOR_MAP = {'High': '#28a745', 'Close': '#007bff', 'Low': '#dc3545'}
+EXTREME_COLOR = '#FF4500'
+BAR_WIDTH = 9
+
+_PLT = None
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+def pyplot():
+    """第一次繪圖時才匯入 matplotlib 並套用後端與字體設定"""
+    global _PLT
+    if _PLT is None:
+        import matplotlib
+        # 強制使用 Agg 後端以確保在 GitHub Actions 等無界面環境穩定執行
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        plt.rcParams['font.sans-serif'] = FONT_FAMILY
+        plt.rcParams['axes.unicode_minus'] = False
+        _PLT = plt
+    return _PLT
+
+def make_spec(chart_id, path, label, title, data, edges, tick_labels, kind):
+    """計算直方圖並打包成繪圖規格 (kind 為 High / Close / Low)"""
+    clipped = np.clip(np.asarray(data, dtype=np.float64), edges[0], edges[-1])
+    counts, _ = np.histogram(clipped, bins=edges)
+    return {
+        'id': chart_id, 'path': str(path), 'label': label, 'title': title,
+        'counts': counts.tolist(), 'edges': [float(e) for e in edges],
+        'tick_labels': list(tick_labels), 'n': int(len(clipped)), 'color': COLOR_MAP[kind],
+    }
+
+def spec_key(spec):
+    """圖表內容雜湊：計數、分箱、刻度、標題與樣式相同即產出相同的 PNG (不含輸出路徑)"""
+    payload = {k: spec[k] for k in ('counts', 'edges', 'tick_labels', 'title', 'n', 'color')}
+    payload['style'] = [RENDER_VERSION, DPI, EXTREME_COLOR, BAR_WIDTH, FONT_FAMILY]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class RenderCache:
+    """
+    單一輸出目錄的繪圖快取：.render_cache.json 記錄 {檔名: 內容雜湊}
+    commit() 時移除不再屬於本次圖表的舊檔與紀錄
+    """
+    def __init__(self, out_dir):
+        self.dir = Path(out_dir)
+        self.path = self.dir / CACHE_NAME
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    def fresh(self, name, key):
+        return CHART_CACHE and self.manifest.get(name) == key and (self.dir / name).exists()
+
+    def commit(self, current):
+        """current: 本次所有圖表的 {檔名: 雜湊} (含沿用與新繪製者)"""
+        for name in set(self.manifest) - set(current):
+            (self.dir / name).unlink(missing_ok=True)
+        self.manifest = dict(current)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+def _bar_label(h, n):
+    return f'{int(h)}\n({h/n*100:.1f}%)'
+
+def draw(ax, spec, title_size=18, label_size=9):
+    """在空白座標軸上完整繪製一張分布圖 (總覽圖使用)"""
+    counts, edges = np.array(spec['counts']), np.array(spec['edges'])
+    ax.bar(edges[:-2], counts[:-1], width=BAR_WIDTH, align='edge',
+           color=spec['color'], alpha=0.7, edgecolor='white')
+    ax.bar(edges[-2], counts[-1], width=BAR_WIDTH, align='edge',
+           color=EXTREME_COLOR, alpha=0.9, edgecolor='black', linewidth=1.5)
+    max_h = counts.max() if len(counts) > 0 and counts.max() > 0 else 1
+    for i, h in enumerate(counts):
+        if h > 0:
+            ax.text(edges[i] + BAR_WIDTH / 2, h + max_h * 0.02, _bar_label(h, spec['n']),
+                    ha='center', va='bottom', fontsize=label_size, fontweight='bold',
+                    color='red' if i == len(counts) - 1 else 'black')
+    ax.set_ylim(0, max_h * 1.4)
+    ax.set_title(spec['title'], fontsize=title_size, fontweight='bold')
+    ax.set_xticks(edges)
+    ax.set_xticklabels(spec['tick_labels'], rotation=45)
+    ax.grid(axis='y', linestyle='--', alpha=0.3)
+
+class ChartTemplate:
+    """
+    可重複使用的單張圖表樣板：座標軸、刻度、格線與版面只建立一次，
+    每次繪圖只更新長條高度/顏色、數值標籤、y 軸範圍與標題
+    """
+    def __init__(self, edges, tick_labels):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.tick_labels = list(tick_labels)
+        n_bins = len(self.edges) - 1
+        self.fig, self.ax = pyplot().subplots(figsize=(12, 7))
+        ax = self.ax
+        self.bars = list(ax.bar(self.edges[:-2], np.zeros(n_bins - 1), width=BAR_WIDTH, align='edge',
+                                color=COLOR_MAP['Close'], alpha=0.7, edgecolor='white'))
+        self.bars += list(ax.bar(self.edges[-2], 0, width=BAR_WIDTH, align='edge',
+                                 color=EXTREME_COLOR, alpha=0.9, edgecolor='black', linewidth=1.5))
+        self.texts = [ax.text(self.edges[i] + BAR_WIDTH / 2, 0, "", ha='center', va='bottom',
+                              fontsize=9, fontweight='bold', color='red' if i == n_bins - 1 else 'black')
+                      for i in range(n_bins)]
+        self.title = ax.set_title("【TEMPLATE】", fontsize=18, fontweight='bold')
+        ax.set_xticks(self.edges)
+        ax.set_xticklabels(self.tick_labels, rotation=45)
+        ax.grid(axis='y', linestyle='--', alpha=0.3)
+        # 版面只在 y 軸刻度位數改變時重算 (x 軸刻度與字級固定)
+        self._layout_key = None
+
+    def matches(self, spec):
+        return len(spec['edges']) == len(self.edges) and np.allclose(spec['edges'], self.edges) \
+            and spec['tick_labels'] == self.tick_labels
+
+    def render(self, spec):
+        counts = np.array(spec['counts'])
+        max_h = counts.max() if len(counts) > 0 and counts.max() > 0 else 1
+        for i, (bar, text, h) in enumerate(zip(self.bars, self.texts, counts)):
+            bar.set_height(h)
+            if i < len(self.bars) - 1:
+                bar.set_facecolor(spec['color'])
+                bar.set_alpha(0.7)
+            if h > 0:
+                text.set_position((self.edges[i] + BAR_WIDTH / 2, h + max_h * 0.02))
+                text.set_text(_bar_label(h, spec['n']))
+                text.set_visible(True)
+            else:
+                text.set_visible(False)
+        self.ax.set_ylim(0, max_h * 1.4)
+        self.title.set_text(spec['title'])
+        layout_key = max(len(t) for t in self.ax.yaxis.get_major_formatter().format_ticks(self.ax.get_yticks()))
+        if layout_key != self._layout_key:
+            self.fig.tight_layout()
+            self._layout_key = layout_key
+        self.fig.savefig(spec['path'], dpi=DPI)
+        return spec['path']
+
+_TEMPLATE = None
+
+def render_one(spec):
+    """以本程序的共用樣板繪製一張圖 (樣板不符時重建)"""
+    global _TEMPLATE
+    if _TEMPLATE is None or not _TEMPLATE.matches(spec):
+        if _TEMPLATE is not None:
+            pyplot().close(_TEMPLATE.fig)
+        _TEMPLATE = ChartTemplate(spec['edges'], spec['tick_labels'])
+    return _TEMPLATE.render(spec)
+
+def _render_many(specs):
+    """依序繪製一組圖表，回傳 [(圖表 id, 秒數)] 供主程序記錄 (工作程序的量測不會回傳)"""
+    out = []
+    for s in specs:
+        t0 = time.perf_counter()
+        render_one(s)
+        out.append((s['id'], time.perf_counter() - t0))
+    return out
+
+def _render_pool(specs, workers):
+    workers = max(1, min(workers, len(specs)))
+    if workers == 1:
+        return _render_many(specs)
+    groups = [specs[i::workers] for i in range(workers)]
+    ctx = mp.get_context(CHART_START_METHOD)
+    if CHART_START_METHOD == "forkserver":
+        # 伺服器程序預先匯入本模組 (numpy/pandas)，工作程序分叉後不必各自重新匯入
+        ctx.set_forkserver_preload([__name__])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        return [t for ts in pool.map(_render_many, groups) for t in ts]
+
+def render_charts(specs, workers=None):
+    """
+    平行繪製多張圖；每個工作程序分到一組圖表，各自沿用一份樣板
+    內容雜湊與上次相同且檔案仍在的圖表直接沿用，不重繪
+    """
+    workers = CHART_WORKERS if workers is None else workers
+    by_dir = {}
+    for s in specs:
+        by_dir.setdefault(str(Path(s['path']).parent), []).append(s)
+
+    for out_dir, group in by_dir.items():
+        cache = RenderCache(out_dir)
+        keys = {Path(s['path']).name: spec_key(s) for s in group}
+        todo = [s for s in group if not cache.fresh(Path(s['path']).name, keys[Path(s['path']).name])]
+        if todo:
+            for chart_id, secs in _render_pool(todo, workers):
+                metrics.observe("chart_render_seconds", secs, chart_id, market=Path(out_dir).name)
+        metrics.inc("chart_cache_total", len(group) - len(todo), market=Path(out_dir).name, outcome="hit")
+        metrics.inc("chart_cache_total", len(todo), market=Path(out_dir).name, outcome="miss")
+        cache.commit(keys)
+        if len(todo) < len(group):
+            log(f"🖼️ 圖表快取命中 {len(group) - len(todo)}/{len(group)} 張 ({out_dir})")
+    return [s['path'] for s in specs]
+
+def render_grid(specs, path, title):
+    """將九張分布圖合併為單張 3×3 總覽圖 (內容未變時沿用既有檔案)"""
+    path = Path(path)
+    cache = RenderCache(path.parent)
+    key = hashlib.sha256(json.dumps([title] + [spec_key(s) for s in specs]).encode("utf-8")).hexdigest()
+    if cache.fresh(path.name, key):
+        cache.commit({path.name: key})
+        log(f"🖼️ 總覽圖快取命中 ({path})")
+        return str(path)
+
+    t0 = time.perf_counter()
+    plt = pyplot()
+    fig, axes = plt.subplots(3, 3, figsize=(30, 19))
+    for ax, spec in zip(axes.flat, specs):
+        draw(ax, spec, title_size=14, label_size=7)
+    for ax in list(axes.flat)[len(specs):]:
+        ax.axis('off')
+    fig.suptitle(title, fontsize=22, fontweight='bold')
+    fig.tight_layout()
+    fig.savefig(path, dpi=DPI)
+    plt.close(fig)
+    metrics.observe("chart_render_seconds", time.perf_counter() - t0, "overview", market=path.parent.name)
+    cache.commit({path.name: key})
+    return str(path)
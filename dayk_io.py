@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import price_store
+import metrics
+
+# ========== 增量更新參數 ==========
+# 增量抓取時往回重疊的日曆天數，用來比對 Yahoo 是否修正過既有 K 棒
+OVERLAP_DAYS = 7
+# 讀取檔尾時保留的列數 (需涵蓋重疊區間)
+TAIL_ROWS = 30
+# 重疊區間收盤價的容許相對誤差，超過即視為除權息/分割調整
+ADJUST_RTOL = 1e-4
+
+# ========== 平行讀取檔尾 ==========
+# 程序數 (預設為 CPU 核心數)；設為 1 則在本程序逐檔讀取
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+# 檔案少於此數時不建立程序池 (啟動成本高於讀取本身)
+INGEST_MIN_FILES = 200
+# 讀取程序的啟動方式：串流分析與下載執行緒仍在時也會呼叫 read_tails，fork 可能把持有中的鎖帶進子程序；
+# 預設 forkserver，無此方式的平台 (Windows) 用 spawn
+INGEST_START_METHOD = os.getenv("INGEST_START_METHOD") or (
+    "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+PRICE_FIELDS = ("close", "high", "low")
+
+def read_tail_lines(path, n_rows=TAIL_ROWS):
+    """回傳 (表頭, 最後 n_rows 列) 的原始 bytes，不做任何解析"""
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        chunks, newlines, step = [], 0, 8192
+        while pos > len(header) and newlines <= n_rows:
+            step = min(step, pos - len(header))
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            chunks.append(chunk)
+            newlines += chunk.count(b"\n")
+            step *= 2
+        data = b"".join(reversed(chunks))
+
+    lines = data.splitlines()
+    # 若未讀到表頭位置，第一行可能是被截斷的半行
+    if pos > len(header):
+        lines = lines[1:]
+    return header, [ln for ln in lines[-n_rows:] if ln.strip()]
+
+def read_tail(path, n_rows=TAIL_ROWS):
+    """只讀取 CSV 表頭與最後 n_rows 列，避免為了最後日期解析整個檔案"""
+    header, lines = read_tail_lines(path, n_rows)
+    df = pd.read_csv(io.BytesIO(header + b"\n".join(lines)), encoding="utf-8-sig")
+    df.columns = [c.lower() for c in df.columns]
+    return df
+
+def read_tail_arrays(path, n_rows=TAIL_ROWS, fields=PRICE_FIELDS):
+    """
+    只解析檔尾 n_rows 列的日期與指定欄位
+    回傳 (YYYY-MM-DD 清單, float64 矩陣 [列 × 欄位])；略過 dividends、時區等不需要的欄位
+    """
+    header, lines = read_tail_lines(path, n_rows)
+    cols = header.decode("utf-8-sig").strip().lower().split(",")
+    pick = [cols.index(c) for c in ("date",) + tuple(fields)]
+    try:
+        # 每檔只有數百列，直接切分比 pd.read_csv 的固定開銷快得多
+        dates, vals = [], []
+        for ln in lines:
+            parts = ln.decode("utf-8").rstrip("\r").split(",")
+            dates.append(parts[pick[0]][:10])
+            vals.append([float(parts[k]) if parts[k] else np.nan for k in pick[1:]])
+        return dates, np.array(vals, dtype=np.float64).reshape(-1, len(fields))
+    except (ValueError, IndexError):
+        # 含引號或非數值欄位時交由 pandas 解析
+        df = pd.read_csv(io.BytesIO(header + b"\n".join(lines)), encoding="utf-8-sig",
+                         usecols=lambda c: c.lower() in ("date",) + tuple(fields))
+        df.columns = [c.lower() for c in df.columns]
+        vals = df[list(fields)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        return [str(d)[:10] for d in df['date'].tolist()], vals
+
+def _read_tail_chunk(args):
+    paths, n_rows, fields, with_dates = args
+    out = []
+    for p in paths:
+        try:
+            dates, vals = read_tail_arrays(p, n_rows, fields)
+            out.append((dates if with_dates else None, vals))
+        except Exception:
+            out.append(None)
+    return out
+
+def read_tails(paths, n_rows=TAIL_ROWS, fields=PRICE_FIELDS, with_dates=True, workers=None):
+    """
+    以程序池平行讀取多個 dayK 檔尾，回傳與 paths 同順序的 [(dates, vals) 或 None]
+    with_dates=False 時不回傳日期，減少跨程序傳輸量
+    """
+    paths = [str(p) for p in paths]
+    workers = INGEST_WORKERS if workers is None else workers
+    if workers <= 1 or len(paths) < INGEST_MIN_FILES:
+        return _read_tail_chunk((paths, n_rows, fields, with_dates))
+
+    # 每個程序分到數個區塊，平衡各檔大小不一造成的負載差異
+    size = max(1, -(-len(paths) // (workers * 4)))
+    jobs = [(paths[i:i + size], n_rows, fields, with_dates) for i in range(0, len(paths), size)]
+    ctx = mp.get_context(INGEST_START_METHOD)
+    if INGEST_START_METHOD == "forkserver":
+        ctx.set_forkserver_preload([__name__])
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        return [r for chunk in pool.map(_read_tail_chunk, jobs) for r in chunk]
+
+def _date_keys(series):
+    """統一日期比對鍵：只取 YYYY-MM-DD，忽略時區與時間部分"""
+    return series.astype(str).str[:10]
+
+def last_stored_date(path):
+    """回傳 CSV 最後一筆 K 棒的日期 (pd.Timestamp)，無法判斷時回傳 None"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    try:
+        tail = read_tail(path, n_rows=1)
+        if tail.empty or 'date' not in tail.columns:
+            return None
+        return pd.Timestamp(_date_keys(tail['date']).iloc[-1])
+    except Exception:
+        return None
+
+def delta_start(path):
+    """計算增量下載起始日 (含重疊區間)，回傳 None 代表需完整下載"""
+    last = last_stored_date(path)
+    if last is None:
+        return None
+    return (last - pd.Timedelta(days=OVERLAP_DAYS)).strftime("%Y-%m-%d")
+
+def apply_delta(path, new_df):
+    """
+    將增量 K 棒合併進既有 CSV
+    回傳:
+      "appended"  - 僅追加新 K 棒
+      "unchanged" - 無新資料 (僅更新檔案時間)
+      "rewritten" - 最後一根 K 棒被修正，改寫檔尾
+      "refetch"   - 重疊區間價格變動 (除權息/分割)，需完整重抓
+    """
+    tail = read_tail(path)
+    if tail.empty or 'date' not in tail.columns or 'date' not in new_df.columns:
+        return "refetch"
+
+    old = tail.set_index(_date_keys(tail['date']))
+    new = new_df.set_index(_date_keys(new_df['date']))
+    new = new[~new.index.duplicated(keep='last')]
+    last_key = old.index[-1]
+
+    common = old.index.intersection(new.index)
+    if len(common) == 0:
+        return "refetch"
+
+    close_old = pd.to_numeric(old.loc[common, 'close'], errors='coerce').values
+    close_new = pd.to_numeric(new.loc[common, 'close'], errors='coerce').values
+    changed = common[~np.isclose(close_new, close_old, rtol=ADJUST_RTOL, equal_nan=True)]
+    if (changed < last_key).any():
+        return "refetch"
+
+    fresh = new[new.index > last_key]
+    for col in ('dividends', 'stock splits'):
+        if col in fresh.columns and (pd.to_numeric(fresh[col], errors='coerce').fillna(0) != 0).any():
+            return "refetch"
+
+    if last_key in changed:
+        full = pd.read_csv(path, encoding="utf-8-sig")
+        # 保留原始表頭 (例如 Date,Open,...)，小寫名稱只用於比對欄位
+        lower = {c.lower(): c for c in full.columns}
+        keep = full[_date_keys(full[lower['date']]) < last_key]
+        revised = new[new.index >= last_key].reindex(columns=list(lower)).set_axis(full.columns, axis=1)
+        pd.concat([keep, revised], ignore_index=True).to_csv(path, index=False, encoding='utf-8-sig')
+        return "rewritten"
+
+    if fresh.empty:
+        os.utime(path)
+        return "unchanged"
+
+    fresh.reindex(columns=tail.columns).to_csv(path, mode='a', header=False, index=False, encoding='utf-8')
+    return "appended"
+
+def write_frame(df, path, start=None):
+    """
+    寫入單檔 dayK：start 為 None 時整檔覆寫，否則視為增量資料合併
+    回傳 False 表示偵測到價格調整，呼叫端需改為完整重抓
+    寫入成功的資料同步暫存到欄式倉儲 (PRICE_STORE=parquet 時)
+    """
+    t0 = time.perf_counter()
+    if start is None:
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+        price_store.stage_csv_write(path, df, replace=True)
+        metrics.observe("write_seconds", time.perf_counter() - t0, mode="full")
+        return True
+    outcome = apply_delta(path, df)
+    if outcome in ("appended", "rewritten"):
+        price_store.stage_csv_write(path, df, replace=False)
+    metrics.observe("write_seconds", time.perf_counter() - t0, mode=outcome)
+    if outcome == "refetch":
+        metrics.inc("refetch_total", store="csv")
+    return outcome != "refetch"
+
+def sync_batch(entries, fetch, prepare):
+    """
+    批次增量同步
+    entries: [(symbol, out_path)]
+    fetch(symbols, start): 回傳 {symbol: 原始 history DataFrame}，start 為 None 表示完整期間
+    prepare(hist): 將原始 history 轉為寫檔格式
+    回傳 {symbol: 完整 K 線或 None (增量合併)}；未出現在結果中的標的代表批次缺漏，交由呼叫端逐檔補抓
+    """
+    paths = dict(entries)
+    starts = {sym: delta_start(path) for sym, path in entries}
+    full = [sym for sym, st in starts.items() if st is None]
+    delta = [sym for sym, st in starts.items() if st is not None]
+
+    results = {}
+    if delta:
+        # 同一批共用最早的起始日，多出來的舊 K 棒在合併時會被忽略
+        frames = fetch(delta, min(starts[sym] for sym in delta))
+        for sym, hist in frames.items():
+            if write_frame(prepare(hist), paths[sym], starts[sym]):
+                results[sym] = None
+            else:
+                full.append(sym)
+
+    if full:
+        frames = fetch(full, None)
+        for sym, hist in frames.items():
+            df = prepare(hist)
+            if not df.empty:
+                write_frame(df, paths[sym])
+                results[sym] = df
+    return results
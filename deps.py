@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+第三方套件檢查與延遲匯入
+- 各市場需要的套件集中列在 MARKET_DEPS，下載器只在實際用到時才以 require() 匯入
+- 匯入模組不再有 pip install 的副作用；AUTO_INSTALL_DEPS=1 時 require() 才會在缺套件時安裝
+- python main.py --check-deps 列出所選市場的套件狀態 (只查詢是否存在，不匯入)
+"""
+import os
+import sys
+import importlib
+import importlib.util
+import subprocess
+from datetime import datetime
+
+# 缺套件時是否自動安裝 (預設否，改為提示安裝指令)
+AUTO_INSTALL = os.getenv("AUTO_INSTALL_DEPS", "0") == "1"
+
+# (pip 名稱, 匯入名稱, 是否必要)；非必要者缺少時只會失去備援來源或選用功能
+CORE_DEPS = [
+    ("pandas", "pandas", True),
+    ("numpy", "numpy", True),
+    ("requests", "requests", True),
+    ("yfinance", "yfinance", True),
+    ("tqdm", "tqdm", True),
+    ("matplotlib", "matplotlib", True),
+    ("resend", "resend", True),
+    # PRICE_STORE=parquet 的欄式倉儲
+    ("pyarrow", "pyarrow", False),
+    # MAIL_IMAGE_FORMAT=palette / webp 的附件重新壓縮
+    ("Pillow", "PIL", False),
+]
+MARKET_DEPS = {
+    "tw-share": [("lxml", "lxml", True), ("akshare", "akshare", False)],
+    "us-share": [],
+    "hk-share": [("xlrd", "xlrd", True)],
+    "cn-share": [("akshare", "akshare", True)],
+    "jp-share": [("tokyo-stock-exchange", "tokyo_stock_exchange", True)],
+    "kr-share": [("pykrx", "pykrx", True)],
+}
+
+def log(msg: str):
+    print(f"{datetime.now():%H:%M:%S}: {msg}")
+
+def installed(import_name):
+    """只查詢套件是否存在，不執行其匯入 (避免載入耗時或有副作用的套件)"""
+    return importlib.util.find_spec(import_name.split(".")[0]) is not None
+
+def install(pkg):
+    log(f"🔧 正在安裝 {pkg}...")
+    ok = subprocess.run([sys.executable, "-m", "pip", "install", "-q", pkg]).returncode == 0
+    importlib.invalidate_caches()
+    return ok
+
+def require(pkg, import_name=None):
+    """
+    匯入套件並回傳模組 (import_name 可為子模組，例如 pykrx.stock)
+    缺少時依 AUTO_INSTALL_DEPS 安裝，否則拋出附安裝指令的 ImportError，由呼叫端的備援流程處理
+    """
+    import_name = import_name or pkg
+    if not installed(import_name):
+        if not AUTO_INSTALL:
+            raise ImportError(f"缺少套件 {pkg}，請執行 pip install {pkg} (或設定 AUTO_INSTALL_DEPS=1)")
+        install(pkg)
+    return importlib.import_module(import_name)
+
+def check(markets):
+    """[(範圍, pip 名稱, 是否必要, 是否已安裝)]；AUTO_INSTALL_DEPS=1 時順便安裝缺少的套件"""
+    rows = []
+    for scope, specs in [("core", CORE_DEPS)] + [(m, MARKET_DEPS.get(m, [])) for m in markets]:
+        for pkg, import_name, required in specs:
+            ok = installed(import_name)
+            if not ok and AUTO_INSTALL:
+                ok = install(pkg) and installed(import_name)
+            rows.append((scope, pkg, required, ok))
+    return rows
+
+def report(markets):
+    """印出套件狀態；回傳缺少的必要套件數"""
+    rows = check(markets)
+    for scope, pkg, required, ok in rows:
+        mark = "✅" if ok else ("❌" if required else "⚠️")
+        print(f"  {mark} {scope:<10}{pkg:<24}{'必要' if required else '選用'}")
+    missing = sorted({pkg for _, pkg, required, ok in rows if required and not ok})
+    if missing:
+        print(f"❌ 缺少必要套件：pip install {' '.join(missing)}")
+    return len(missing)
@@ -1,120 +1,206 @@
 # -*- coding: utf-8 -*-
-import os, time, random, json, subprocess
+import os
 import pandas as pd
-import yfinance as yf
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
+from yf_batch import YAHOO, chunked, fetch_history, fetch_history_batch, history_kwargs
+import metrics
+from rate_limiter import get_limiter
+from fetch_engine import run_tasks
+from dayk_io import delta_start, write_frame, sync_batch
+import price_store
+from universe_store import load_universe
+from progress_journal import ProgressJournal
+import deps
 
 # ========== 核心參數與路徑 ==========
 MARKET_CODE = "cn-share"
 DATA_SUBDIR = "dayK"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, DATA_SUBDIR)
-CACHE_LIST_PATH = os.path.join(BASE_DIR, "cn_stock_list_cache.json")
 
-# 中國 A 股標的極多，建議控制執行緒在 3-4 之間，避免被封 IP
-THREADS_CN = 4
+# 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+THREADS_CN = YAHOO.max_workers
+# 單一下載任務 (一個批次) 的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 600
+# 批次模式：每次請求合併的標的數 (設為 1 則退回逐檔下載)
+BATCH_SIZE = int(os.getenv("CN_BATCH_SIZE", "50"))
 os.makedirs(DATA_DIR, exist_ok=True)
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
-def get_cn_list():
-    """使用 akshare 獲取 A 股清單，具備今日快取機制與雙接口備援"""
-    if os.path.exists(CACHE_LIST_PATH):
-        file_mtime = os.path.getmtime(CACHE_LIST_PATH)
-        if datetime.fromtimestamp(file_mtime).date() == datetime.now().date():
-            log("📦 載入今日 A 股清單快取...")
-            with open(CACHE_LIST_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
-
+def fetch_cn_list(snapshot=None):
+    """使用 akshare 獲取 A 股清單，具備雙接口備援；兩者皆失敗時回傳空清單"""
     log("📡 正在獲取最新 A 股清單 (東方財富接口)...")
     try:
-        import akshare as ak
+        ak = deps.require("akshare")
         # 改用更穩定的 spot_em 接口
-        df = ak.stock_zh_a_spot_em()
+        with get_limiter("eastmoney").request():
+            df = ak.stock_zh_a_spot_em()
         
         # 過濾常見板塊 (00, 30, 60, 68)
-        df['代码'] = df['代码'].astype(str)
-        valid_prefixes = ('00','30','60','68')
-        df = df[df['代码'].str.startswith(valid_prefixes)]
-        
-        res = [f"{row['代码']}&{row['名称']}" for _, row in df.iterrows()]
+        code = df['代码'].astype(str)
+        valid = code.str.startswith(('00','30','60','68'))
+        res = (code[valid] + "&" + df.loc[valid, '名称'].astype(str)).tolist()
         
         if len(res) > 1000:
-            with open(CACHE_LIST_PATH, "w", encoding="utf-8") as f:
-                json.dump(res, f, ensure_ascii=False)
             log(f"✅ 成功獲取 {len(res)} 檔 A 股標的")
-            return res
+            return res, {}
         else:
             raise ValueError("數據量異常過少")
             
     except Exception as e:
         log(f"⚠️ A 股清單獲取失敗: {e}，嘗試備援方案...")
         try:
+            ak = deps.require("akshare")
             # 備援：原本的 info 接口
-            df_bak = ak.stock_info_a_code_name()
-            res_bak = [f"{row['code']}&{row['name']}" for _, row in df_bak.iterrows()]
-            return res_bak
-        except:
-            return ["600519&貴州茅台", "000001&平安銀行"]
+            with get_limiter("eastmoney").request():
+                df_bak = ak.stock_info_a_code_name()
+            return (df_bak['code'].astype(str) + "&" + df_bak['name'].astype(str)).tolist(), {}
+        except Exception:
+            return [], {}
+
+def get_cn_list():
+    """A 股清單：快照有效期內直接載入，抓取失敗時沿用舊快照，再不行才用最小備援名單"""
+    res, _ = load_universe(MARKET_CODE, fetch_cn_list, min_items=1000)
+    return res or ["600519&貴州茅台", "000001&平安銀行"]
+
+def parse_item(item):
+    """解析 "代號&名稱"，回傳 (code, symbol, out_path)；Yahoo 格式：6開頭 (含688) 為上海 .SS, 其餘為深圳 .SZ"""
+    code, name = item.split('&', 1)
+    symbol = f"{code}.SS" if code.startswith('6') else f"{code}.SZ"
+    return code, symbol, os.path.join(DATA_DIR, f"{code}_{name}.csv")
+
+def is_fresh(out_path):
+    """✅ 今日快取檢查"""
+    if not os.path.exists(out_path): return False
+    mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
+    return mtime == datetime.now().date() and os.path.getsize(out_path) > 1000
+
+def prepare_history(hist):
+    hist = hist.reset_index()
+    hist.columns = [c.lower() for c in hist.columns]
+    return hist
 
 def download_one(item):
-    """下載 A 股數據，判斷交易所後綴 (.SS 或 .SZ)"""
+    """下載 A 股數據，判斷交易所後綴 (.SS 或 .SZ)；既有檔案只抓取缺少的 K 棒"""
     try:
-        code, name = item.split('&', 1)
-        # Yahoo Finance 格式：6開頭 (含688) 為上海 .SS, 其餘為深圳 .SZ
-        if code.startswith('6'):
-            symbol = f"{code}.SS"
-        else:
-            symbol = f"{code}.SZ"
-            
-        out_path = os.path.join(DATA_DIR, f"{code}_{name}.csv")
+        code, symbol, out_path = parse_item(item)
 
-        # ✅ 今日快取檢查
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "code": code}
+        if is_fresh(out_path):
+            return {"status": "exists", "code": code, "path": out_path}
 
-        time.sleep(random.uniform(0.5, 1.2))
-        tk = yf.Ticker(symbol)
+        start = delta_start(out_path)
         # A 股建議用 2y 數據，因市場波動與政策週期較長
-        hist = tk.history(period="2y", timeout=20)
+        hist = fetch_history(symbol, **history_kwargs(start), timeout=20)
         
         if hist is not None and not hist.empty:
-            hist.reset_index(inplace=True)
-            hist.columns = [c.lower() for c in hist.columns]
             # 統一存檔格式
-            hist.to_csv(out_path, index=False, encoding='utf-8-sig')
-            return {"status": "success", "code": code}
-            
+            df = prepare_history(hist)
+            if not write_frame(df, out_path, start):
+                # 重疊區間價格遭調整 (除權息/分割)，改為完整重抓
+                hist = fetch_history(symbol, period="2y", timeout=20)
+                if hist is None or hist.empty: return {"status": "empty", "code": code}
+                df, start = prepare_history(hist), None
+                write_frame(df, out_path)
+            # 完整下載時附上整份 K 線供串流分析使用，增量更新則由分析端讀取檔尾
+            return {"status": "success", "code": code, "path": out_path, "frame": None if start else df}
+
+        # 增量區間沒有新 K 棒，既有資料仍然有效
+        if start: return {"status": "exists", "code": code, "path": out_path}
         return {"status": "empty", "code": code}
     except:
         return {"status": "error", "code": item.split('&')[0]}
 
-def main():
-    items = get_cn_list()
+def fetch_batch(symbols, start):
+    return fetch_history_batch(symbols, **history_kwargs(start), timeout=20)
+
+def download_batch(chunk):
+    """批次下載：整塊標的合併為一次請求，批次中缺漏的標的再逐檔補抓"""
+    parsed = {}
+    for it in chunk:
+        try:
+            parsed[it] = parse_item(it)
+        except Exception:
+            parsed[it] = None
+
+    done = {}
+    for attempt in range(2):
+        try:
+            done = sync_batch([(p[1], p[2]) for p in parsed.values() if p], fetch_batch, prepare_history)
+            break
+        except Exception:
+            if attempt == 0:
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="batch")
+            continue
+
+    results = []
+    for it, p in parsed.items():
+        if p is None:
+            results.append({"status": "error", "code": it.split('&')[0]})
+        elif p[1] in done:
+            results.append({"status": "success", "code": p[0], "path": p[2], "frame": done[p[1]]})
+        else:
+            # 批次結果缺漏的標的逐檔補抓
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="fallback")
+            results.append(download_one(it))
+    return results
+
+def download_chunk(chunk):
+    """依 BATCH_SIZE 選擇批次或逐檔模式，一律回傳結果清單 (每筆附上清單項目，供進度日誌記錄)"""
+    results = download_batch(chunk) if BATCH_SIZE > 1 else [download_one(it) for it in chunk]
+    return [dict(res, item=it) for it, res in zip(chunk, results)]
+
+def main(sink=None):
+    """sink(path, frame): 串流分析入口，每檔下載完成或命中快取時即送出"""
+    # 續跑中斷的下載時沿用日誌中的清單，不再重新抓取
+    journal = ProgressJournal(MARKET_CODE)
+    items = journal.items if journal.load() else get_cn_list()
     if not items:
         return {"total": 0, "success": 0, "fail": 0}
+    journal.begin(items)
 
     log(f"🚀 開始下載中國 A 股 (共 {len(items)} 檔)")
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
+
+    # 日誌中已完成的標的沿用狀態；其餘先排除今日已更新的檔案，只將待下載標的分塊送出
+    done, pending = journal.split(items)
+    for it, status in done:
+        stats[status] += 1
+        if sink and status in ("success", "exists"): sink(parse_item(it)[2])
+    todo = []
+    for it in pending:
+        try:
+            out_path = parse_item(it)[2]
+            fresh = is_fresh(out_path)
+        except Exception:
+            fresh = False
+        if fresh:
+            stats["exists"] += 1
+            journal.record(it, "exists")
+            if sink: sink(out_path)
+        else:
+            todo.append(it)
     
-    with ThreadPoolExecutor(max_workers=THREADS_CN) as executor:
-        futs = {executor.submit(download_one, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="CN 下載進度")
-        for f in as_completed(futs):
-            res = f.result()
+    pbar = tqdm(total=len(items), initial=len(items) - len(todo), desc="CN 下載進度")
+
+    def on_result(results):
+        for res in results:
             stats[res.get("status", "error")] += 1
+            journal.record(res.get("item"), res.get("status", "error"))
             pbar.update(1)
-            
-            # 每處理 100 檔稍微休息，防止 IP 封鎖
-            if pbar.n % 100 == 0:
-                time.sleep(random.uniform(5, 10))
-        pbar.close()
+            if sink and res.get("status") in ("success", "exists"):
+                sink(res["path"], res.get("frame"))
+
+    run_tasks(download_chunk, list(chunked(todo, BATCH_SIZE)), host="yahoo", limit=THREADS_CN,
+              timeout=TASK_TIMEOUT, on_result=on_result,
+              on_error=lambda chunk, e: [{"status": "error", "code": it.split('&')[0], "item": it} for it in chunk])
+    pbar.close()
+    log(YAHOO.summary())
+    # 欄式倉儲 (選用)：整批寫出下載期間暫存的 K 線
+    price_store.flush(MARKET_CODE, rebuild=journal.resumed)
     
     # ✨ 重要：封裝結果並 return 給 main.py
     report_stats = {
@@ -122,6 +208,7 @@ def main():
         "success": stats["success"] + stats["exists"],
         "fail": stats["error"] + stats["empty"]
     }
+    journal.finish(report_stats)
     
     log(f"📊 A 股下載完成: {report_stats}")
     return report_stats
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-import os, io, time, random, sqlite3, requests
+import os, io, time
 import pandas as pd
-import yfinance as yf
+from yf_batch import YAHOO, fetch_history
+from fetch_engine import run_tasks
+import warehouse
+import metrics
+from progress_journal import ProgressJournal
+from universe_store import load_universe, conditional_get
 from io import StringIO
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import urllib3
 
@@ -17,8 +21,10 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "hk_stock_warehouse.db")
 IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
 
-# ✅ 效能調優
-MAX_WORKERS = 3 if IS_GITHUB_ACTIONS else 5 
+# ✅ 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+MAX_WORKERS = YAHOO.max_workers
+# 單一標的下載任務的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 300
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
@@ -26,18 +32,10 @@ def log(msg: str):
 # ========== 2. 資料庫初始化 ==========
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = warehouse.connect(DB_PATH)
     try:
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
-                            symbol TEXT PRIMARY KEY, 
-                            name TEXT, 
-                            sector TEXT, 
-                            market TEXT,
-                            updated_at TEXT)''')
+        # 價格表、資訊表與 (symbol, date) 索引
+        warehouse.init_schema(conn)
         
         # 自動升級舊資料庫
         cursor = conn.execute("PRAGMA table_info(stock_info)")
@@ -51,10 +49,10 @@ def init_db():
 
 # ========== 3. 獲取港股清單 (強化穩定性) ==========
 
-def get_hk_stock_list():
-    """獲取港股清單並確保寫入 stock_info"""
-    url = "https://www.hkex.com.hk/-/media/HKEX-Market/Services/Trading/Securities/Securities-Lists/Securities-Using-Standard-Transfer-Form-(including-GEM)-By-Stock-Code-Order/secstkorder.xls"
-    
+HKEX_LIST_URL = "https://www.hkex.com.hk/-/media/HKEX-Market/Services/Trading/Securities/Securities-Lists/Securities-Using-Standard-Transfer-Form-(including-GEM)-By-Stock-Code-Order/secstkorder.xls"
+
+def fetch_hk_list(snapshot=None):
+    """以條件式請求下載港交所名單；檔案未變動 (304) 時回傳 None 沿用快照"""
     # 模擬完整瀏覽器 Header
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -64,97 +62,111 @@ def get_hk_stock_list():
     log(f"📡 正在從港交所獲取名單...")
     try:
         # 使用 verify=False 避免 SSL 阻擋
-        r = requests.get(url, headers=headers, timeout=20, verify=False)
+        r, validators = conditional_get(HKEX_LIST_URL, "hkex", snapshot, headers=headers, timeout=20, verify=False)
+        if r is None:
+            return None, {HKEX_LIST_URL: validators}
         r.raise_for_status()
         
         # 讀取 Excel
         df_raw = pd.read_excel(io.BytesIO(r.content), header=None)
         
         # 尋找包含 "Stock Code" 的正確起始行
-        hdr_idx = None
-        for i in range(len(df_raw)):
-            row_str = " ".join([str(x) for x in df_raw.iloc[i].values])
-            if "Stock Code" in row_str:
-                hdr_idx = i
-                break
-        
-        if hdr_idx is None: 
+        has_hdr = df_raw.astype(str).apply(lambda col: col.str.contains("Stock Code", regex=False)).any(axis=1)
+        if not has_hdr.any():
             log("❌ 找不到 Excel 表頭，請檢查網址是否有變。")
-            return []
+            return [], {}
+        hdr_idx = int(has_hdr.values.argmax())
         
         # 重新整理 DataFrame
         df = df_raw.iloc[hdr_idx+1:].copy()
         df.columns = df_raw.iloc[hdr_idx].values
-        
-        conn = sqlite3.connect(DB_PATH)
-        stock_list = []
-        
-        # 💡 先清空舊 info 數據確保重新同步
-        conn.execute("DELETE FROM stock_info")
-
-        for _, row in df.iterrows():
-            raw_code = str(row['Stock Code']).strip()
-            # 港股名稱可能在不同欄位名下 (English Stock Short Name)
-            name_col = [c for c in df.columns if 'Short Name' in str(c) and 'English' in str(c)]
-            name = str(row[name_col[0]]).strip() if name_col else "Unknown"
-            
-            # 港股普通股邏輯：數字且長度 <= 4 (或是 5 位但前幾位是 0)
-            if raw_code.isdigit() and int(raw_code) < 10000:
-                symbol = f"{raw_code.zfill(4)}.HK"
-                market = "HKEX"
-                
-                conn.execute("""
-                    INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (symbol, name, "Unknown", market, datetime.now().strftime("%Y-%m-%d")))
-                stock_list.append((symbol, name))
-                
-        conn.commit()
-        conn.close()
-        log(f"✅ 港股清單同步完成：{len(stock_list)} 檔")
-        return stock_list
-        
+
+        code = df['Stock Code'].astype(str).str.strip()
+        # 港股名稱可能在不同欄位名下 (English Stock Short Name)
+        name_col = [c for c in df.columns if 'Short Name' in str(c) and 'English' in str(c)]
+        name = df[name_col[0]].astype(str).str.strip() if name_col else pd.Series("Unknown", index=df.index)
+
+        # 港股普通股邏輯：數字且長度 <= 4 (或是 5 位但前幾位是 0)
+        valid = code.str.isdigit() & (pd.to_numeric(code, errors='coerce') < 10000)
+        symbol = code[valid].str.zfill(4) + ".HK"
+        return [list(x) for x in zip(symbol, name[valid])], {HKEX_LIST_URL: validators}
+
     except Exception as e:
         log(f"⚠️ 港股名單獲取異常: {e}")
+        return [], {}
+
+def get_hk_stock_list():
+    """獲取港股清單並確保寫入 stock_info"""
+    items, _ = load_universe(MARKET_CODE, fetch_hk_list)
+    if not items:
         # 萬一失敗，返回基本的藍籌股名單確保程序不崩潰
         return [("0700.HK", "TENCENT"), ("09988.HK", "BABA-SW"), ("00005.HK", "HSBC HOLDINGS")]
 
+    stock_list = [tuple(x) for x in items]
+    today = datetime.now().strftime("%Y-%m-%d")
+    conn = warehouse.connect(DB_PATH)
+    try:
+        # 💡 清空舊 info 後整批寫入 (單一交易)，下市標的隨之移除
+        with conn:
+            conn.execute("DELETE FROM stock_info")
+            conn.executemany("""
+                INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
+                VALUES (?, ?, ?, ?, ?)
+            """, [(sym, nm, "Unknown", "HKEX", today) for sym, nm in stock_list])
+    finally:
+        conn.close()
+    log(f"✅ 港股清單同步完成：{len(stock_list)} 檔")
+    return stock_list
+
 # ========== 4. 下載邏輯 ==========
 
+def fetch_frame(symbol, start_date):
+    """下載單檔 K 線並整理為倉儲欄位；無資料時回傳 None"""
+    hist = fetch_history(symbol, start=start_date, timeout=25, auto_adjust=True)
+    if hist is None or hist.empty:
+        return None
+
+    hist.reset_index(inplace=True)
+    hist.columns = [c.lower() for c in hist.columns]
+    if 'date' in hist.columns:
+        hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
+    
+    df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
+    df_final['symbol'] = symbol
+    return df_final
+
 def download_one(args):
-    symbol, name, mode = args
-    start_date = "2020-01-01" if mode == 'hot' else "2000-01-01"
+    symbol, name, mode, writer, tail = args
+    full_start = "2020-01-01" if mode == 'hot' else "2000-01-01"
+    # hot 模式且倉儲已有資料：只抓最後日期往前重疊區間之後的 K 棒
+    start_date = warehouse.delta_start(tail) if mode == 'hot' and tail else full_start
     
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            wait_time = random.uniform(2.0, 4.0) if IS_GITHUB_ACTIONS else random.uniform(0.2, 0.5)
-            time.sleep(wait_time)
-            
-            tk = yf.Ticker(symbol)
-            hist = tk.history(start=start_date, timeout=25, auto_adjust=True)
-            
-            if hist is None or hist.empty:
+            df_final = fetch_frame(symbol, start_date)
+            # 重疊區間價格被修正 (除權息/分割)：改為完整重抓
+            if df_final is not None and start_date != full_start:
+                if warehouse.revised(tail, df_final):
+                    start_date = full_start
+                    metrics.inc("refetch_total", store="sqlite")
+                    df_final = fetch_frame(symbol, start_date)
+                else:
+                    # 重疊區間未變動：只寫入最後一根 (可能盤中修正) 與新 K 棒
+                    df_final = df_final[df_final['date'] >= tail[0][-1]]
+            # 增量區間沒有新 K 棒 (假日/停牌) 不算失敗；empty 只留給完整下載
+            if start_date != full_start and (df_final is None or df_final.empty):
+                return {"symbol": symbol, "status": "unchanged"}
+            if df_final is None:
                 return {"symbol": symbol, "status": "empty"}
-                
-            hist.reset_index(inplace=True)
-            hist.columns = [c.lower() for c in hist.columns]
-            if 'date' in hist.columns:
-                hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-            
-            df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final['symbol'] = symbol
-            
-            conn = sqlite3.connect(DB_PATH, timeout=60)
-            df_final.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                            method=lambda table, conn, keys, data_iter: 
-                            conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            conn.close()
             
+            # 交由單一寫入者批次寫入資料庫
+            writer.put(symbol, df_final)
             return {"symbol": symbol, "status": "success"}
         except Exception:
+            # 限流/逾時的冷卻與降速由限流器統一處理
             if attempt < max_retries - 1:
-                time.sleep(random.uniform(5, 12))
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="single")
                 continue
             return {"symbol": symbol, "status": "error"}
 
@@ -162,38 +174,78 @@ def run_sync(mode='hot'):
     start_time = time.time()
     init_db()
     
-    items = get_hk_stock_list()
+    # 續跑中斷的同步時沿用日誌中的清單，不再重新抓取
+    journal = ProgressJournal(MARKET_CODE, mode=mode)
+    items = [tuple(x) for x in journal.items] if journal.load() else get_hk_stock_list()
     if not items:
         return {"fail_list": [], "success": 0, "has_changed": False}
+    journal.begin(items)
 
     log(f"🚀 開始港股同步 | 目標: {len(items)} 檔")
 
-    stats = {"success": 0, "empty": 0, "error": 0}
+    stats = {"success": 0, "unchanged": 0, "empty": 0, "error": 0}
     fail_list = []
+
+    # 日誌中已完成的標的沿用狀態，只同步其餘標的
+    done, todo = journal.split(items)
+    for _, s in done:
+        stats[s if s in stats else 'error'] += 1
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_one, (it[0], it[1], mode)): it[0] for it in items}
-        for f in tqdm(as_completed(futures), total=len(items), desc="HK同步"):
-            res = f.result()
-            s = res.get("status", "error")
-            stats[s if s in stats else 'error'] += 1
-            if s == "error": fail_list.append(res.get("symbol"))
-
-    log("🧹 資料庫 VACUUM...")
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("VACUUM")
-    conn.close()
+    # 一次查出各檔最後 K 棒，決定增量起始日
+    tails = warehouse.last_bars(DB_PATH) if mode == 'hot' else {}
+    n_delta = sum(1 for it in todo if it[0] in tails)
+    log(f"🔁 增量 {n_delta} 檔 | 完整下載 {len(todo) - n_delta} 檔" + (f" | 日誌沿用 {len(done)} 檔" if done else ""))
+
+    pbar = tqdm(total=len(items), initial=len(done), desc="HK同步")
+
+    def on_commit(symbols):
+        # 成功的標的等批次提交後才記入日誌 (中斷時仍在佇列中的資料下次會重抓)
+        for sym in symbols:
+            journal.record(sym, "success")
+
+    writer = warehouse.WarehouseWriter(DB_PATH, on_commit=on_commit)
+
+    def on_result(res):
+        s = res.get("status", "error")
+        stats[s if s in stats else 'error'] += 1
+        if s == "error": fail_list.append(res.get("symbol"))
+        if s != "success": journal.record(res.get("symbol"), s)
+        pbar.update(1)
+
+    run_tasks(download_one, [(it[0], it[1], mode, writer, tails.get(it[0])) for it in todo], host="yahoo", limit=MAX_WORKERS,
+              timeout=TASK_TIMEOUT, on_result=on_result,
+              on_error=lambda args, e: {"symbol": args[0], "status": "error"})
+    pbar.close()
+    log(YAHOO.summary())
+
+    # 等待佇列寫完；寫入失敗的標的改列為失敗
+    writer.close()
+    for sym in writer.failed:
+        stats['success'] -= 1
+        stats['error'] += 1
+        fail_list.append(sym)
+        journal.record(sym, "error")
+
+    # 資料庫優化：碎片超過門檻才 VACUUM
+    warehouse.maintain(DB_PATH)
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
     
-    return {
-        "success": stats['success'],
+    report_stats = {
+        "success": stats['success'] + stats['unchanged'],
         "error": stats['error'],
         "total": len(items),
+        "fail": stats['error'] + stats['empty'],
         "fail_list": fail_list,
         "has_changed": stats['success'] > 0
     }
+    journal.finish({k: report_stats[k] for k in ("total", "success", "fail")})
+    return report_stats
+
+def main(mode='hot'):
+    """main.py 管線入口"""
+    return run_sync(mode=mode)
 
 if __name__ == "__main__":
-    run_sync(mode='hot')
+    main()
@@ -1,21 +1,15 @@
 # -*- coding: utf-8 -*-
-import os, sys, time, random, subprocess, sqlite3
+import os, time
 import pandas as pd
-import yfinance as yf
+from yf_batch import YAHOO, fetch_history
+from fetch_engine import run_tasks
+import warehouse
+import metrics
+from progress_journal import ProgressJournal
+from universe_store import load_universe
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-
-# ====== 自動安裝必要套件 ======
-def ensure_pkg(pkg_install_name, import_name):
-    try:
-        __import__(import_name)
-    except ImportError:
-        print(f"🔧 正在安裝 {pkg_install_name}...")
-        subprocess.run([sys.executable, "-m", "pip", "install", "-q", pkg_install_name])
-
-ensure_pkg("tokyo-stock-exchange", "tokyo_stock_exchange")
-from tokyo_stock_exchange import tse
+import deps
 
 # ========== 核心參數設定 ==========
 MARKET_CODE = "jp-share"
@@ -23,8 +17,10 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "jp_stock_warehouse.db")
 IS_GITHUB_ACTIONS = os.getenv('GITHUB_ACTIONS') == 'true'
 
-# ✅ 效能設定
-MAX_WORKERS = 3 if IS_GITHUB_ACTIONS else 5
+# ✅ 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+MAX_WORKERS = YAHOO.max_workers
+# 單一標的下載任務的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 300
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
@@ -32,19 +28,10 @@ def log(msg: str):
 # ========== 2. 資料庫初始化 (支援自動升級) ==========
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = warehouse.connect(DB_PATH)
     try:
-        # 價格表
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_prices (
-                            date TEXT, symbol TEXT, open REAL, high REAL, 
-                            low REAL, close REAL, volume INTEGER,
-                            PRIMARY KEY (date, symbol))''')
-        # 資訊表
-        conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
-                            symbol TEXT PRIMARY KEY, 
-                            name TEXT, 
-                            sector TEXT, 
-                            updated_at TEXT)''')
+        # 價格表、資訊表與 (symbol, date) 索引
+        warehouse.init_schema(conn)
         
         # 💡 自動升級：檢查並新增 market 欄位
         cursor = conn.execute("PRAGMA table_info(stock_info)")
@@ -58,10 +45,12 @@ def init_db():
 
 # ========== 3. 獲取日股清單 (修復 API 問題) ==========
 
-def get_jp_stock_list():
-    """獲取日股清單並同步至 stock_info"""
+def fetch_jp_list(snapshot=None):
+    """讀取 TSE 上市清單，回傳 [[symbol, name, sector]]"""
     log("📡 正在獲取日股清單 (TSE)...")
     try:
+        # 上市清單套件只在清單快照過期需要重抓時才載入
+        tse = deps.require("tokyo-stock-exchange", "tokyo_stock_exchange.tse")
         # 💡 修正：不再調用 download_csv，直接讀取套件內建的路徑
         # 如果路徑不存在，該套件通常會在讀取時自動處理
         df = pd.read_csv(tse.csv_file_path)
@@ -70,69 +59,87 @@ def get_jp_stock_list():
         name_col = next((c for c in ['銘柄名', 'Name', 'name', 'Issues'] if c in df.columns), None)
         sector_col = next((c for c in ['33業種区分', 'Sector', 'industry'] if c in df.columns), None)
 
-        conn = sqlite3.connect(DB_PATH)
-        stock_list = []
-        
-        for _, row in df.iterrows():
-            raw_code = str(row[code_col]).strip()
-            if len(raw_code) >= 4 and raw_code[:4].isdigit():
-                symbol = f"{raw_code[:4]}.T"
-                name = str(row[name_col]).strip() if name_col else "Unknown"
-                sector = str(row[sector_col]).strip() if sector_col else "Unknown"
-                
-                # 寫入資訊表
-                conn.execute("""
-                    INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (symbol, name, sector, "TSE", datetime.now().strftime("%Y-%m-%d")))
-                stock_list.append((symbol, name))
-        
-        conn.commit()
-        conn.close()
-        log(f"✅ 成功獲取 {len(stock_list)} 檔日股資訊")
-        return stock_list
+        code = df[code_col].astype(str).str.strip()
+        valid = (code.str.len() >= 4) & code.str[:4].str.isdigit()
+        symbol = code[valid].str[:4] + ".T"
+        name = df.loc[valid, name_col].astype(str).str.strip() if name_col else pd.Series("Unknown", index=symbol.index)
+        sector = df.loc[valid, sector_col].astype(str).str.strip() if sector_col else pd.Series("Unknown", index=symbol.index)
+        return [list(x) for x in zip(symbol, name, sector)], {}
     except Exception as e:
         log(f"❌ 日股清單獲取失敗: {e}")
+        return [], {}
+
+def get_jp_stock_list():
+    """獲取日股清單並同步至 stock_info"""
+    items, _ = load_universe(MARKET_CODE, fetch_jp_list)
+    if not items:
         return [("7203.T", "TOYOTA MOTOR")]
 
+    today = datetime.now().strftime("%Y-%m-%d")
+    conn = warehouse.connect(DB_PATH)
+    try:
+        # 寫入資訊表 (單一交易整批寫入)
+        with conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO stock_info (symbol, name, sector, market, updated_at) 
+                VALUES (?, ?, ?, ?, ?)
+            """, [(sym, nm, sec, "TSE", today) for sym, nm, sec in items])
+    finally:
+        conn.close()
+    stock_list = [(sym, nm) for sym, nm, _ in items]
+    log(f"✅ 成功獲取 {len(stock_list)} 檔日股資訊")
+    return stock_list
+
 # ========== 4. 核心下載邏輯 ==========
 
+def fetch_frame(symbol, start_date):
+    """下載單檔 K 線並整理為倉儲欄位；無資料時回傳 None"""
+    hist = fetch_history(symbol, start=start_date, timeout=25, auto_adjust=True)
+    if hist is None or hist.empty:
+        return None
+
+    hist.reset_index(inplace=True)
+    hist.columns = [c.lower() for c in hist.columns]
+    # 處理日期格式
+    if 'date' in hist.columns:
+        hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
+    
+    df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
+    df_final['symbol'] = symbol
+    return df_final
+
 def download_one(args):
-    symbol, name, mode = args
-    start_date = "2020-01-01" if mode == 'hot' else "2000-01-01"
+    symbol, name, mode, writer, tail = args
+    full_start = "2020-01-01" if mode == 'hot' else "2000-01-01"
+    # hot 模式且倉儲已有資料：只抓最後日期往前重疊區間之後的 K 棒
+    start_date = warehouse.delta_start(tail) if mode == 'hot' and tail else full_start
     
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            time.sleep(random.uniform(1.5, 3.0) if IS_GITHUB_ACTIONS else 0.2)
-            
-            tk = yf.Ticker(symbol)
-            hist = tk.history(start=start_date, timeout=25, auto_adjust=True)
-            
-            if hist is None or hist.empty:
+            df_final = fetch_frame(symbol, start_date)
+            # 重疊區間價格被修正 (除權息/分割)：改為完整重抓
+            if df_final is not None and start_date != full_start:
+                if warehouse.revised(tail, df_final):
+                    start_date = full_start
+                    metrics.inc("refetch_total", store="sqlite")
+                    df_final = fetch_frame(symbol, start_date)
+                else:
+                    # 重疊區間未變動：只寫入最後一根 (可能盤中修正) 與新 K 棒
+                    df_final = df_final[df_final['date'] >= tail[0][-1]]
+            # 增量區間沒有新 K 棒 (假日/停牌) 不算失敗；empty 只留給完整下載
+            if start_date != full_start and (df_final is None or df_final.empty):
+                return {"symbol": symbol, "status": "unchanged"}
+            if df_final is None:
                 return {"symbol": symbol, "status": "empty"}
-                
-            hist.reset_index(inplace=True)
-            hist.columns = [c.lower() for c in hist.columns]
-            
-            # 處理日期格式
-            if 'date' in hist.columns:
-                hist['date'] = pd.to_datetime(hist['date']).dt.tz_localize(None).dt.strftime('%Y-%m-%d')
-            
-            df_final = hist[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
-            df_final['symbol'] = symbol
-            
-            # 寫入資料庫
-            conn = sqlite3.connect(DB_PATH, timeout=60)
-            df_final.to_sql('stock_prices', conn, if_exists='append', index=False, 
-                            method=lambda table, conn, keys, data_iter: 
-                            conn.executemany(f"INSERT OR REPLACE INTO {table.name} ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", data_iter))
-            conn.close()
             
+            # 交由單一寫入者批次寫入資料庫
+            writer.put(symbol, df_final)
             return {"symbol": symbol, "status": "success"}
         except:
+            # 限流/逾時的冷卻與降速由限流器統一處理
             if attempt < max_retries - 1:
-                time.sleep(random.uniform(5, 10))
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="single")
                 continue
             return {"symbol": symbol, "status": "error"}
 
@@ -140,39 +147,78 @@ def run_sync(mode='hot'):
     start_time = time.time()
     init_db()
     
-    items = get_jp_stock_list()
+    # 續跑中斷的同步時沿用日誌中的清單，不再重新抓取
+    journal = ProgressJournal(MARKET_CODE, mode=mode)
+    items = [tuple(x) for x in journal.items] if journal.load() else get_jp_stock_list()
     if not items:
         return {"fail_list": [], "success": 0, "has_changed": False}
+    journal.begin(items)
 
     log(f"🚀 開始日股同步 ({mode}) | 目標: {len(items)} 檔")
 
-    stats = {"success": 0, "empty": 0, "error": 0}
+    stats = {"success": 0, "unchanged": 0, "empty": 0, "error": 0}
     fail_list = []
+
+    # 日誌中已完成的標的沿用狀態，只同步其餘標的
+    done, todo = journal.split(items)
+    for _, s in done:
+        stats[s if s in stats else 'error'] += 1
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_one, (it[0], it[1], mode)): it[0] for it in items}
-        for f in tqdm(as_completed(futures), total=len(items), desc="JP同步"):
-            res = f.result()
-            s = res.get("status", "error")
-            stats[s if s in stats else 'error'] += 1
-            if s == "error": fail_list.append(res.get("symbol"))
-
-    # 資料庫優化
-    log("🧹 執行資料庫優化 (VACUUM)...")
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("VACUUM")
-    conn.close()
+    # 一次查出各檔最後 K 棒，決定增量起始日
+    tails = warehouse.last_bars(DB_PATH) if mode == 'hot' else {}
+    n_delta = sum(1 for it in todo if it[0] in tails)
+    log(f"🔁 增量 {n_delta} 檔 | 完整下載 {len(todo) - n_delta} 檔" + (f" | 日誌沿用 {len(done)} 檔" if done else ""))
+
+    pbar = tqdm(total=len(items), initial=len(done), desc="JP同步")
+
+    def on_commit(symbols):
+        # 成功的標的等批次提交後才記入日誌 (中斷時仍在佇列中的資料下次會重抓)
+        for sym in symbols:
+            journal.record(sym, "success")
+
+    writer = warehouse.WarehouseWriter(DB_PATH, on_commit=on_commit)
+
+    def on_result(res):
+        s = res.get("status", "error")
+        stats[s if s in stats else 'error'] += 1
+        if s == "error": fail_list.append(res.get("symbol"))
+        if s != "success": journal.record(res.get("symbol"), s)
+        pbar.update(1)
+
+    run_tasks(download_one, [(it[0], it[1], mode, writer, tails.get(it[0])) for it in todo], host="yahoo", limit=MAX_WORKERS,
+              timeout=TASK_TIMEOUT, on_result=on_result,
+              on_error=lambda args, e: {"symbol": args[0], "status": "error"})
+    pbar.close()
+    log(YAHOO.summary())
+
+    # 等待佇列寫完；寫入失敗的標的改列為失敗
+    writer.close()
+    for sym in writer.failed:
+        stats['success'] -= 1
+        stats['error'] += 1
+        fail_list.append(sym)
+        journal.record(sym, "error")
+
+    # 資料庫優化：碎片超過門檻才 VACUUM
+    warehouse.maintain(DB_PATH)
 
     duration = (time.time() - start_time) / 60
     log(f"📊 同步完成！費時: {duration:.1f} 分鐘")
     
-    return {
-        "success": stats['success'],
+    report_stats = {
+        "success": stats['success'] + stats['unchanged'],
         "error": stats['error'],
         "total": len(items),
+        "fail": stats['error'] + stats['empty'],
         "fail_list": fail_list,
         "has_changed": stats['success'] > 0
     }
+    journal.finish({k: report_stats[k] for k in ("total", "success", "fail")})
+    return report_stats
+
+def main(mode='hot'):
+    """main.py 管線入口"""
+    return run_sync(mode=mode)
 
 if __name__ == "__main__":
-    run_sync(mode='hot')
+    main()
@@ -1,20 +1,16 @@
 # -*- coding: utf-8 -*-
-import os, sys, time, random, logging, warnings, subprocess, json
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os, logging, warnings, json
 from tqdm import tqdm
 import pandas as pd
-import yfinance as yf
-
-# ====== 自動安裝必要套件 ======
-def ensure_pkg(pkg: str):
-    try:
-        __import__(pkg)
-    except ImportError:
-        subprocess.run([sys.executable, "-m", "pip", "install", "-q", pkg])
-
-ensure_pkg("pykrx")
-from pykrx import stock as krx
+from yf_batch import YAHOO, chunked, fetch_history, fetch_history_batch, history_kwargs
+import metrics
+from rate_limiter import get_limiter
+from fetch_engine import run_tasks
+from dayk_io import delta_start, write_frame, sync_batch
+import price_store
+from universe_store import load_universe
+from progress_journal import ProgressJournal, RETRY_STATUSES
+import deps
 
 # ====== 降噪與環境設定 ======
 warnings.filterwarnings("ignore")
@@ -29,9 +25,12 @@ LIST_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, "lists")
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(LIST_DIR, exist_ok=True)
 
-# 續跑清單紀錄檔案
-MANIFEST_CSV = Path(LIST_DIR) / "kr_manifest.csv"
-THREADS = 4
+# 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+THREADS = YAHOO.max_workers
+# 單一下載任務 (一個批次) 的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 600
+# 批次模式：每次請求合併的標的數 (設為 1 則退回逐檔下載)
+BATCH_SIZE = int(os.getenv("KR_BATCH_SIZE", "50"))
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
@@ -53,95 +52,170 @@ def standardize_df(df: pd.DataFrame) -> pd.DataFrame:
     req = ['date','open','high','low','close','volume']
     return df[req] if all(c in df.columns for c in req) else pd.DataFrame()
 
-def get_kr_list():
-    """從 KRX 獲取最新 KOSPI/KOSDAQ 普通股清單"""
+def universe_key(item):
+    return f"{item['code']}.{item['board']}"
+
+def fetch_kr_list(snapshot=None):
+    """
+    從 KRX 獲取最新 KOSPI/KOSDAQ 普通股清單
+    名稱優先沿用快照，只對新上市代號查詢名稱 (原本每檔一次請求)
+    """
     today = pd.Timestamp.today().strftime("%Y%m%d")
+    known = {x["code"]: x["name"] for x in (snapshot or {}).get("items", [])}
     lst = []
     log("📡 正在從 KRX 獲取韓國股市清單...")
     try:
+        # pykrx 只在清單快照過期需要重抓時才載入
+        krx = deps.require("pykrx", "pykrx.stock")
         # 抓取 KOSPI (KS) 與 KOSDAQ (KQ)
         for mk, bd in [("KOSPI","KS"), ("KOSDAQ","KQ")]:
-            tickers = krx.get_market_ticker_list(today, market=mk)
-            for t in tickers:
-                name = krx.get_market_ticker_name(t)
-                # 過濾：排除優先股 (通常代號第6位不是0) 與 衍生品
-                if t.endswith('0'): 
-                    lst.append({"code": t, "name": name, "board": bd, "status": "pending"})
-        
-        df = pd.DataFrame(lst)
-        log(f"✅ 成功獲取 {len(df)} 檔韓國普通股標的")
-        return df
+            with get_limiter("krx").request():
+                tickers = krx.get_market_ticker_list(today, market=mk)
+            # 過濾：排除優先股 (通常代號第6位不是0) 與 衍生品
+            for t in [t for t in tickers if t.endswith('0')]:
+                name = known.get(t) or krx.get_market_ticker_name(t)
+                lst.append({"code": t, "name": name, "board": bd})
+        return lst, {}
     except Exception as e:
         log(f"⚠️ 獲取清單失敗: {e}")
+        return [], {}
+
+def get_kr_list():
+    """KOSPI/KOSDAQ 普通股清單 (含續跑狀態欄位)"""
+    lst, _ = load_universe(MARKET_CODE, fetch_kr_list, key=universe_key)
+    if not lst:
         # 基礎備援
-        return pd.DataFrame([{"code":"005930","name":"三星電子","board":"KS", "status": "pending"}])
+        lst = [{"code":"005930","name":"三星電子","board":"KS"}]
+    df = pd.DataFrame(lst).assign(status="pending")
+    log(f"✅ 成功獲取 {len(df)} 檔韓國普通股標的")
+    return df
+
+def is_fresh(out_path):
+    """✅ 今日快取檢查"""
+    if not os.path.exists(out_path): return False
+    mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
+    return mtime == datetime.now().date() and os.path.getsize(out_path) > 1000
 
 def download_one(row_data):
-    """下載單一韓股 K 線數據"""
+    """下載單一韓股 K 線數據 (既有檔案只抓取缺少的 K 棒)"""
     idx, row = row_data
     code, board = row['code'], row['board']
     symbol = map_symbol_kr(code, board)
     # 存檔名稱範例: 005930.KS.csv
     out_path = os.path.join(DATA_DIR, f"{code}.{board}.csv")
     
-    # ✅ 今日快取檢查
-    if os.path.exists(out_path):
-        mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-        if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-            return idx, "exists"
+    if is_fresh(out_path):
+        return idx, "exists"
 
     try:
-        time.sleep(random.uniform(0.3, 1.0)) # 隨機延遲防止封鎖
-        tk = yf.Ticker(symbol)
-        df_raw = tk.history(period="2y", interval="1d", auto_adjust=False)
+        start = delta_start(out_path)
+        df_raw = fetch_history(symbol, **history_kwargs(start), interval="1d", auto_adjust=False)
         df = standardize_df(df_raw)
         
         if not df.empty:
-            df.to_csv(out_path, index=False, encoding='utf-8-sig')
+            if not write_frame(df, out_path, start):
+                # 重疊區間價格遭調整 (分割/減資)，改為完整重抓
+                df = standardize_df(fetch_history(symbol, period="2y", interval="1d", auto_adjust=False))
+                if df.empty: return idx, "empty"
+                write_frame(df, out_path)
             return idx, "done"
+        # 增量區間沒有新 K 棒，既有資料仍然有效
+        if start: return idx, "exists"
         return idx, "empty"
     except:
         return idx, "failed"
 
+def fetch_batch(symbols, start):
+    return fetch_history_batch(symbols, **history_kwargs(start), interval="1d", auto_adjust=False)
+
+def download_batch(chunk):
+    """批次下載：整塊標的合併為一次請求，批次中缺漏的標的再逐檔補抓"""
+    entries = {idx: (map_symbol_kr(row['code'], row['board']),
+                     os.path.join(DATA_DIR, f"{row['code']}.{row['board']}.csv")) for idx, row in chunk}
+    done = {}
+    for attempt in range(2):
+        try:
+            done = sync_batch(list(entries.values()), fetch_batch, standardize_df)
+            break
+        except Exception:
+            if attempt == 0:
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="batch")
+            continue
+
+    results = []
+    for idx, row in chunk:
+        if entries[idx][0] in done:
+            results.append((idx, "done"))
+        else:
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="fallback")
+            results.append(download_one((idx, row)))
+    return results
+
+def download_chunk(chunk):
+    """依 BATCH_SIZE 選擇批次或逐檔模式，一律回傳結果清單"""
+    if BATCH_SIZE > 1:
+        return download_batch(chunk)
+    return [download_one(item) for item in chunk]
+
 from datetime import datetime
 
-def main():
+def main(sink=None):
+    """sink(path, frame): 串流分析入口，每檔下載完成或命中快取時即送出"""
     log("🇰🇷 啟動韓股下載引擎 (KOSPI/KOSDAQ)")
     
-    # 1. 獲取標的名單
-    mf = get_kr_list()
+    # 1. 獲取標的名單 (續跑中斷的下載時沿用日誌中的清單，不再重新抓取)
+    journal = ProgressJournal(MARKET_CODE)
+    mf = pd.DataFrame(journal.items).assign(status="pending") if journal.load() else get_kr_list()
     if mf.empty:
         return {"total": 0, "success": 0, "fail": 0}
-
-    # 2. 偵測本機已存在的檔案 (續跑機制)
-    existing_files = [f for f in os.listdir(DATA_DIR) if f.endswith(".csv")]
+    journal.begin(mf[["code", "name", "board"]].to_dict("records"))
+
+    # 2. 續跑機制：日誌中已完成的標的沿用狀態，再偵測今日已更新的檔案；較舊的檔案交由增量下載補齊新 K 棒
+    prev = mf["code"].map(journal.status)
+    resumed = prev.notna() & ~prev.isin(RETRY_STATUSES)
+    mf.loc[resumed, "status"] = prev[resumed]
+    if sink:
+        for code, board, status in zip(mf["code"], mf["board"], mf["status"]):
+            if status in ("done", "exists"):
+                sink(os.path.join(DATA_DIR, f"{code}.{board}.csv"))
+    existing_files = [f for f in os.listdir(DATA_DIR) if f.endswith(".csv") and is_fresh(os.path.join(DATA_DIR, f))]
     for f in existing_files:
         code_part = f.replace(".csv", "")
         if "." in code_part:
             c, b = code_part.split(".")
-            mf.loc[(mf['code'] == c) & (mf['board'] == b), "status"] = "exists"
+            mask = (mf['code'] == c) & (mf['board'] == b) & (mf['status'] == "pending")
+            if mask.any():
+                mf.loc[mask, "status"] = "exists"
+                journal.record(c, "exists")
+                if sink: sink(os.path.join(DATA_DIR, f))
 
     todo = mf[mf["status"] == "pending"]
-    log(f"📝 總標的：{len(mf)} | 待處理：{len(todo)} | 已存在：{len(mf[mf['status']=='exists'])}")
+    log(f"📝 總標的：{len(mf)} | 待處理：{len(todo)} | 已存在：{len(mf[mf['status']=='exists'])} | 日誌沿用：{int(resumed.sum())}")
 
     # 3. 多執行緒下載
     stats = {"done": 0, "exists": len(mf[mf['status']=='exists']), "empty": 0, "failed": 0}
     
     if not todo.empty:
-        with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = {executor.submit(download_one, item): item for item in todo.iterrows()}
-            pbar = tqdm(total=len(todo), desc="韓股下載進度")
-            
-            for f in as_completed(futures):
-                idx, status = f.result()
+        pbar = tqdm(total=len(todo), desc="韓股下載進度")
+
+        def on_result(results):
+            for idx, status in results:
                 mf.at[idx, "status"] = status
+                journal.record(mf.at[idx, "code"], status)
                 if status in ["done", "empty", "failed"]:
                     stats[status if status != "done" else "done"] += 1
                 pbar.update(1)
-            pbar.close()
+                if sink and status in ("done", "exists"):
+                    sink(os.path.join(DATA_DIR, f"{mf.at[idx, 'code']}.{mf.at[idx, 'board']}.csv"))
+
+        run_tasks(download_chunk, list(chunked(list(todo.iterrows()), BATCH_SIZE)), host="yahoo",
+                  limit=THREADS, timeout=TASK_TIMEOUT, on_result=on_result,
+                  on_error=lambda chunk, e: [(idx, "failed") for idx, _ in chunk])
+        pbar.close()
+        log(YAHOO.summary())
 
-    # 4. 儲存續跑清單
-    mf.to_csv(MANIFEST_CSV, index=False)
+    # 欄式倉儲 (選用)：整批寫出下載期間暫存的 K 線
+    price_store.flush(MARKET_CODE, rebuild=journal.resumed)
     
     # ✨ 重要：構建回傳給 main.py 的統計字典
     report_stats = {
@@ -149,6 +223,7 @@ def main():
         "success": len(mf[mf["status"].isin(["done", "exists"])]),
         "fail": len(mf[mf["status"].isin(["empty", "failed"])])
     }
+    journal.finish(report_stats)
     
     print("\n" + "="*50)
     log(f"📊 韓股任務完成報告: {report_stats}")
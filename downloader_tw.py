@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
-import time
-import random
-import requests
 import pandas as pd
-import yfinance as yf
 from io import StringIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
+from yf_batch import YAHOO, chunked, fetch_history, fetch_history_batch, history_kwargs
+import metrics
+from rate_limiter import get_limiter
+from fetch_engine import http_get, run_tasks
+from dayk_io import delta_start, write_frame, sync_batch
+import price_store
+from universe_store import load_universe
+from progress_journal import ProgressJournal
+import deps
 
 # ========== 核心參數設定 ==========
 MARKET_CODE = "tw-share"
@@ -16,15 +20,19 @@ DATA_SUBDIR = "dayK"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, DATA_SUBDIR)
 
-# ✅ 效能優化：調低至 3，配合隨機延遲可有效避開 Yahoo 封鎖
-MAX_WORKERS = 3 
+# ✅ 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+MAX_WORKERS = YAHOO.max_workers
+# 單一下載任務 (一個批次) 的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 600
+# 批次模式：每次請求合併的標的數 (設為 1 則退回逐檔下載)
+BATCH_SIZE = int(os.getenv("TW_BATCH_SIZE", "50"))
 Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
-def get_full_stock_list():
-    """獲取台股全市場清單 (雙重機制：證交所 JSP + Akshare 備援)"""
+def fetch_stock_list(snapshot=None):
+    """從來源抓取台股全市場清單 (雙重機制：證交所 JSP + Akshare 備援)"""
     url_configs = [
         {'name': 'listed', 'url': 'https://isin.twse.com.tw/isin/class_main.jsp?market=1&issuetype=1&Page=1&chklike=Y', 'suffix': '.TW'},
         {'name': 'dr', 'url': 'https://isin.twse.com.tw/isin/class_main.jsp?owncode=&stockname=&isincode=&market=1&issuetype=J&industry_code=&Page=1&chklike=Y', 'suffix': '.TW'},
@@ -33,104 +41,190 @@ def get_full_stock_list():
         {'name': 'rotc', 'url': 'https://isin.twse.com.tw/isin/class_main.jsp?owncode=&stockname=&isincode=&market=E&issuetype=R&industry_code=&Page=1&chklike=Y', 'suffix': '.TWO'},
     ]
     
-    all_items = []
-    log("📡 [方案 A] 正在從證交所 JSP 獲取清單...")
-    
-    for cfg in url_configs:
+    def fetch_page(cfg):
+        page_items = []
         try:
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
-            resp = requests.get(cfg['url'], timeout=15, headers=headers)
+            resp = http_get(cfg['url'], host="twse", timeout=15)
             df_list = pd.read_html(StringIO(resp.text), header=0)
-            if not df_list: continue
+            if not df_list: return page_items
             df = df_list[0]
-            for _, row in df.iterrows():
-                code = str(row['有價證券代號']).strip()
-                name = str(row['有價證券名稱']).strip()
-                if code and '有價證券' not in code:
-                    all_items.append(f"{code}{cfg['suffix']}&{name}")
-        except Exception as e:
-            continue
+            code = df['有價證券代號'].astype(str).str.strip()
+            name = df['有價證券名稱'].astype(str).str.strip()
+            valid = (code != "") & ~code.str.contains('有價證券')
+            page_items = (code[valid] + cfg['suffix'] + "&" + name[valid]).tolist()
+        except Exception:
+            pass
+        return page_items
+
+    all_items = []
+    log("📡 [方案 A] 正在從證交所 JSP 獲取清單...")
+    # 五個分類頁面經由共用連線池同時抓取
+    for page_items in run_tasks(fetch_page, url_configs, host="twse"):
+        all_items.extend(page_items or [])
 
     # --- 方案 B: Akshare 備援 (當證交所失敗時) ---
     if len(all_items) < 500:
         log("📡 [方案 B] 證交所資料獲取不足，改用 Akshare 備援...")
         try:
-            import akshare as ak
+            ak = deps.require("akshare")
             # 獲取上市與上櫃清單
-            df_tw_listed = ak.stock_tw_spot_em() # 台灣市場即時行情
-            for _, row in df_tw_listed.iterrows():
-                code = str(row['代码'])
-                name = str(row['名称'])
-                # Akshare 的代號通常需要判斷 .TW 或 .TWO
-                # 這裡簡單處理：如果是上市公司通常是 .TW，其餘 .TWO
-                suffix = ".TW" if len(code) == 4 and code.startswith(('2', '1', '3')) else ".TWO"
-                all_items.append(f"{code}{suffix}&{name}")
+            with get_limiter("eastmoney").request():
+                df_tw_listed = ak.stock_tw_spot_em() # 台灣市場即時行情
+            code = df_tw_listed['代码'].astype(str)
+            name = df_tw_listed['名称'].astype(str)
+            # Akshare 的代號通常需要判斷 .TW 或 .TWO
+            # 這裡簡單處理：如果是上市公司通常是 .TW，其餘 .TWO
+            listed = (code.str.len() == 4) & code.str.startswith(('2', '1', '3'))
+            suffix = listed.map({True: ".TW", False: ".TWO"})
+            all_items.extend((code + suffix + "&" + name).tolist())
         except Exception as e:
             log(f"❌ 備援方案亦失敗: {e}")
 
-    final_res = list(set(all_items))
+    return sorted(set(all_items)), {}
+
+def get_full_stock_list():
+    """獲取台股全市場清單：快照有效期內不發出請求，抓取不足 500 檔時沿用上次快照"""
+    final_res, _ = load_universe(MARKET_CODE, fetch_stock_list, min_items=500)
     log(f"✅ 台股清單獲取完成，共 {len(final_res)} 檔標的。")
     return final_res
 
+def parse_item(item):
+    """解析 "代號&名稱" 清單項目，回傳 (yf_tkr, out_path)；格式錯誤回傳 None"""
+    parts = item.split('&', 1)
+    if len(parts) < 2: return None
+    yf_tkr, name = parts
+    safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
+    return yf_tkr, os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
+
+def is_fresh(out_path):
+    """今日快取檢查：檔案為今天寫入且大小合理"""
+    if not os.path.exists(out_path): return False
+    mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
+    return mtime == datetime.now().date() and os.path.getsize(out_path) > 1000
+
+def prepare_history(hist):
+    hist = hist.reset_index()
+    hist.columns = [c.lower() for c in hist.columns]
+    return hist
+
 def download_stock_data(item):
-    """具備隨機延遲與自動重試的下載邏輯"""
+    """經由共用限流器下載並自動重試 (既有檔案只抓取缺少的 K 棒)"""
     yf_tkr = "ParseError"
     try:
-        parts = item.split('&', 1)
-        if len(parts) < 2: return {"status": "error", "tkr": item}
-        
-        yf_tkr, name = parts
-        safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
-        out_path = os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
+        parsed = parse_item(item)
+        if parsed is None: return {"status": "error", "tkr": item}
+        yf_tkr, out_path = parsed
         
         # 今日快取檢查
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "tkr": yf_tkr}
+        if is_fresh(out_path):
+            return {"status": "exists", "tkr": yf_tkr, "path": out_path}
 
-        time.sleep(random.uniform(0.5, 1.2))
-        tk = yf.Ticker(yf_tkr)
+        start = delta_start(out_path)
         
         for attempt in range(2):
             try:
-                hist = tk.history(period="2y", timeout=15)
+                hist = fetch_history(yf_tkr, **history_kwargs(start), timeout=15)
                 if hist is not None and not hist.empty:
-                    hist.reset_index(inplace=True)
-                    hist.columns = [c.lower() for c in hist.columns]
-                    hist.to_csv(out_path, index=False, encoding='utf-8-sig')
-                    return {"status": "success", "tkr": yf_tkr}
+                    df = prepare_history(hist)
+                    if not write_frame(df, out_path, start):
+                        # 重疊區間價格遭調整 (除權息/分割)，改為完整重抓
+                        hist = fetch_history(yf_tkr, period="2y", timeout=15)
+                        if hist is None or hist.empty: return {"status": "empty", "tkr": yf_tkr}
+                        df, start = prepare_history(hist), None
+                        write_frame(df, out_path)
+                    # 完整下載時附上整份 K 線供串流分析使用，增量更新則由分析端讀取檔尾
+                    return {"status": "success", "tkr": yf_tkr, "path": out_path, "frame": None if start else df}
+                # 增量區間沒有新 K 棒，既有資料仍然有效
+                if start: return {"status": "exists", "tkr": yf_tkr, "path": out_path}
                 if attempt == 1: return {"status": "empty", "tkr": yf_tkr}
             except:
-                time.sleep(random.uniform(3, 7))
+                # 限流/逾時的退讓由限流器統一處理，這裡直接重試
+                if attempt == 1: break
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="single")
 
         return {"status": "empty", "tkr": yf_tkr}
     except:
         return {"status": "error", "tkr": yf_tkr}
 
+def fetch_batch(symbols, start):
+    return fetch_history_batch(symbols, **history_kwargs(start), timeout=15)
+
+def download_batch(chunk):
+    """批次下載：整塊標的合併為一次請求，批次中缺漏的標的再逐檔補抓"""
+    parsed = {it: parse_item(it) for it in chunk}
+    done = {}
+    for attempt in range(2):
+        try:
+            done = sync_batch([p for p in parsed.values() if p], fetch_batch, prepare_history)
+            break
+        except Exception:
+            if attempt == 0:
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="batch")
+            continue
+
+    results = []
+    for it, p in parsed.items():
+        if p is None:
+            results.append({"status": "error", "tkr": it})
+        elif p[0] in done:
+            results.append({"status": "success", "tkr": p[0], "path": p[1], "frame": done[p[0]]})
+        else:
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="fallback")
+            results.append(download_stock_data(it))
+    return results
+
+def download_chunk(chunk):
+    """依 BATCH_SIZE 選擇批次或逐檔模式，一律回傳結果清單 (每筆附上清單項目，供進度日誌記錄)"""
+    results = download_batch(chunk) if BATCH_SIZE > 1 else [download_stock_data(it) for it in chunk]
+    return [dict(res, item=it) for it, res in zip(chunk, results)]
+
 from datetime import datetime
 
-def main():
-    items = get_full_stock_list()
+def main(sink=None):
+    """sink(path, frame): 串流分析入口，每檔下載完成或命中快取時即送出"""
+    # 續跑中斷的下載時沿用日誌中的清單，不再重新抓取
+    journal = ProgressJournal(MARKET_CODE)
+    items = journal.items if journal.load() else get_full_stock_list()
     if not items:
         return {"total": 0, "success": 0, "fail": 0}
+    journal.begin(items)
         
     log(f"🚀 啟動台股下載任務，目標總數: {len(items)}")
     
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_stock_data, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="台股下載")
-        
-        for future in as_completed(futures):
-            res = future.result()
+    # 日誌中已完成的標的沿用狀態；其餘先排除今日已更新的檔案，只將待下載標的分塊送出
+    done, pending = journal.split(items)
+    for it, status in done:
+        stats[status] += 1
+        if sink and status in ("success", "exists"): sink(parse_item(it)[1])
+    todo = []
+    for it in pending:
+        parsed = parse_item(it)
+        if parsed and is_fresh(parsed[1]):
+            stats["exists"] += 1
+            journal.record(it, "exists")
+            if sink: sink(parsed[1])
+        else:
+            todo.append(it)
+
+    pbar = tqdm(total=len(items), initial=len(items) - len(todo), desc="台股下載")
+
+    def on_result(results):
+        for res in results:
             stats[res["status"]] += 1
+            journal.record(res.get("item"), res["status"])
             pbar.update(1)
-            
-            if pbar.n % 100 == 0:
-                time.sleep(random.uniform(5, 10))
-        pbar.close()
+            if sink and res["status"] in ("success", "exists"):
+                sink(res["path"], res.get("frame"))
+
+    run_tasks(download_chunk, list(chunked(todo, BATCH_SIZE)), host="yahoo", limit=MAX_WORKERS,
+              timeout=TASK_TIMEOUT, on_result=on_result,
+              on_error=lambda chunk, e: [{"status": "error", "tkr": it, "item": it} for it in chunk])
+    pbar.close()
+    log(YAHOO.summary())
+    # 欄式倉儲 (選用)：整批寫出下載期間暫存的 K 線
+    price_store.flush(MARKET_CODE, rebuild=journal.resumed)
     
     # ✨ 重要：構建回傳給 main.py 的統計字典
     report_stats = {
@@ -138,6 +232,7 @@ def main():
         "success": stats["success"] + stats["exists"],
         "fail": stats["error"] + stats["empty"]
     }
+    journal.finish(report_stats)
     
     print("\n" + "="*50)
     log(f"📊 台股下載完成報告: {report_stats}")
@@ -1,153 +1,236 @@
 # -*- coding: utf-8 -*-
 import os
-import time
-import random
-import json
-import requests
 import pandas as pd
-import yfinance as yf
 from datetime import datetime
 from io import StringIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
+from yf_batch import YAHOO, chunked, fetch_history, fetch_history_batch, history_kwargs
+import metrics
+from fetch_engine import http_get, run_tasks
+from dayk_io import delta_start, write_frame, sync_batch
+import price_store
+from universe_store import load_universe, conditional_get
+from progress_journal import ProgressJournal
 
 # ========== 核心參數設定 ==========
 MARKET_CODE = "us-share"
 DATA_SUBDIR = "dayK"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data", MARKET_CODE, DATA_SUBDIR)
-# 清單快取路徑
-CACHE_LIST_PATH = os.path.join(BASE_DIR, "us_stock_list_cache.json")
+# Nasdaq Trader 清單來源：(網址, 代號欄位, 名稱)
+LIST_SOURCES = [
+    ("https://www.nasdaqtrader.com/dynamic/symdir/nasdaqlisted.txt", "Symbol", "NASDAQ"),
+    ("https://www.nasdaqtrader.com/dynamic/symdir/otherlisted.txt", "NASDAQ Symbol", "NYSE/Other"),
+]
+# 名稱含以下關鍵字者視為衍生品
+EXCLUDE_KEYWORDS = ["WARRANT", "RIGHTS", "UNIT", "PREFERRED", "DEBENTURE"]
+# 兩份來源合計的普通股約六千檔，新清單少於此數視為抓取失敗
+MIN_LIST_ITEMS = 3000
 
-# 美股標的多，建議 4-5 執行緒，並配合隨機延遲
-MAX_WORKERS = 4 
+# 執行緒池上限：實際同時請求數由共用限流器 (AIMD) 依 Yahoo 回應動態調整
+MAX_WORKERS = YAHOO.max_workers
+# 單一下載任務 (一個批次) 的逾時秒數，含等待限流器的時間
+TASK_TIMEOUT = 600
+# 批次模式：每次請求合併的標的數 (設為 1 則退回逐檔下載)
+BATCH_SIZE = int(os.getenv("US_BATCH_SIZE", "100"))
 Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
 
 def log(msg: str):
     print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
 
-def classify_security(name: str, is_etf: bool) -> str:
-    """過濾邏輯：排除 ETF 與 衍生品 (Warrant, Rights 等)"""
-    if is_etf: return "Exclude"
-    n_upper = str(name).upper()
-    exclude_keywords = ["WARRANT", "RIGHTS", "UNIT", "PREFERRED", "DEBENTURE"]
-    if any(kw in n_upper for kw in exclude_keywords): return "Exclude"
-    return "Common Stock"
+def common_stock_items(text, symbol_col):
+    """解析 Nasdaq Trader 清單文字並過濾出普通股：排除測試代號、ETF 與衍生品 (Warrant, Rights 等)"""
+    df = pd.read_csv(StringIO(text), sep="|")
+    df = df[df["Test Issue"] == "N"].dropna(subset=[symbol_col, "Security Name"])
+    name = df["Security Name"].astype(str)
+    keep = (df["ETF"] != "Y") & ~name.str.upper().str.contains("|".join(EXCLUDE_KEYWORDS), regex=True)
+    symbol = df.loc[keep, symbol_col].astype(str).str.strip().str.replace('$', '-', regex=False)
+    return (symbol + "&" + name[keep]).tolist()
 
-def get_full_stock_list():
+def fetch_stock_list(snapshot=None):
     """
-    ⚡ 快取化清單獲取：優先從 Nasdaq 官網抓取清單，並過濾出普通股
+    以條件式請求 (ETag / Last-Modified) 抓取 Nasdaq Trader 清單
+    兩份來源皆回應 304 時回傳 None，沿用快照；任一來源失敗時回傳空清單 (沿用舊快照，不以半份清單覆寫)
     """
-    if os.path.exists(CACHE_LIST_PATH):
-        file_mtime = os.path.getmtime(CACHE_LIST_PATH)
-        # 如果檔案是今天產生的，就直接載入
-        if datetime.fromtimestamp(file_mtime).date() == datetime.now().date():
-            log("📦 偵測到今日已緩存美股清單，直接載入...")
-            with open(CACHE_LIST_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
-
-    log("📡 緩存失效，開始從官網獲取美股普通股清單...")
-    all_rows = []
+    log("📡 清單快照過期，開始從官網獲取美股普通股清單...")
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+    responses, validators = {}, {}
+    for url, _, label in LIST_SOURCES:
+        try:
+            responses[url], validators[url] = conditional_get(url, "nasdaqtrader", snapshot, timeout=15, headers=headers)
+        except Exception as e:
+            log(f"⚠️ {label} 獲取失敗: {e}")
+            responses[url] = False
 
-    # 1. NASDAQ 市場清單
-    try:
-        r1 = requests.get("https://www.nasdaqtrader.com/dynamic/symdir/nasdaqlisted.txt", timeout=15, headers=headers)
-        df1 = pd.read_csv(StringIO(r1.text), sep="|")
-        df1 = df1[df1["Test Issue"] == "N"].dropna(subset=["Symbol", "Security Name"])
-        for _, row in df1.iterrows():
-            name = str(row["Security Name"])
-            if classify_security(name, row["ETF"] == "Y") == "Common Stock":
-                symbol = str(row['Symbol']).strip().replace('$', '-')
-                all_rows.append(f"{symbol}&{name}")
-    except Exception as e: log(f"⚠️ NASDAQ 獲取失敗: {e}")
-
-    # 2. NYSE 與其餘市場清單
-    try:
-        r2 = requests.get("https://www.nasdaqtrader.com/dynamic/symdir/otherlisted.txt", timeout=15, headers=headers)
-        df2 = pd.read_csv(StringIO(r2.text), sep="|")
-        df2 = df2[df2["Test Issue"] == "N"].dropna(subset=["NASDAQ Symbol", "Security Name"])
-        for _, row in df2.iterrows():
-            name = str(row["Security Name"])
-            if classify_security(name, row["ETF"] == "Y") == "Common Stock":
-                symbol = str(row['NASDAQ Symbol']).strip().replace('$', '-')
-                all_rows.append(f"{symbol}&{name}")
-    except Exception as e: log(f"⚠️ NYSE/Other 獲取失敗: {e}")
-
-    final_list = list(set(all_rows))
-    
+    if any(r is False for r in responses.values()):
+        return [], {}
+    if all(r is None for r in responses.values()):
+        return None, validators
+
+    all_rows = []
+    for url, symbol_col, label in LIST_SOURCES:
+        resp = responses[url]
+        try:
+            if resp is None:
+                # 另一份來源已變動，需完整清單重建：此份改為無條件抓取
+                resp = http_get(url, host="nasdaqtrader", timeout=15, headers=headers)
+            all_rows.extend(common_stock_items(resp.text, symbol_col))
+        except Exception as e:
+            log(f"⚠️ {label} 獲取失敗: {e}")
+            return [], {}
+
+    return sorted(set(all_rows)), validators
+
+def get_full_stock_list():
+    """
+    ⚡ 快照化清單獲取：優先沿用清單快照，過期後以條件式請求向 Nasdaq 官網更新，並過濾出普通股
+    """
+    final_list, _ = load_universe(MARKET_CODE, fetch_stock_list, min_items=MIN_LIST_ITEMS)
     if final_list:
-        with open(CACHE_LIST_PATH, "w", encoding="utf-8") as f:
-            json.dump(final_list, f, ensure_ascii=False)
-        log(f"✅ 美股清單更新完成，共 {len(final_list)} 檔普通股。")
-        return final_list
+        log(f"✅ 美股清單準備完成，共 {len(final_list)} 檔普通股。")
     else:
         log("❌ 無法獲取任何美股標的清單。")
-        return []
+    return final_list
+
+def parse_item(item):
+    """解析 "代號&名稱" 清單項目，回傳 (yf_tkr, out_path)；格式錯誤回傳 None"""
+    parts = item.split('&', 1)
+    if len(parts) < 2: return None
+    yf_tkr, name = parts
+    # 移除檔名非法字元
+    safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
+    return yf_tkr, os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
+
+def is_fresh(out_path):
+    """✅ 快取檢查：檢查檔案是否存在且是今天更新的"""
+    if not os.path.exists(out_path): return False
+    mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
+    return mtime == datetime.now().date() and os.path.getsize(out_path) > 1000
+
+def prepare_history(hist):
+    hist = hist.reset_index()
+    hist.columns = [c.lower() for c in hist.columns]
+    return hist
 
 def download_stock_data(item):
     """
-    ⚡ 檔案級快取下載邏輯
+    ⚡ 檔案級快取 + 增量下載邏輯 (既有檔案只抓取缺少的 K 棒)
     """
     try:
-        parts = item.split('&', 1)
-        if len(parts) < 2: return {"status": "error"}
-        yf_tkr, name = parts
+        parsed = parse_item(item)
+        if parsed is None: return {"status": "error"}
+        yf_tkr, out_path = parsed
         
-        # 移除檔名非法字元
-        safe_name = "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
-        out_path = os.path.join(DATA_DIR, f"{yf_tkr}_{safe_name}.csv")
-        
-        # ✅ 快取檢查：檢查檔案是否存在且是今天更新的
-        if os.path.exists(out_path):
-            mtime = datetime.fromtimestamp(os.path.getmtime(out_path)).date()
-            if mtime == datetime.now().date() and os.path.getsize(out_path) > 1000:
-                return {"status": "exists", "tkr": yf_tkr}
+        if is_fresh(out_path):
+            return {"status": "exists", "tkr": yf_tkr, "path": out_path}
 
         # --- 若無快取則下載 ---
-        time.sleep(random.uniform(0.4, 1.2))
-        tk = yf.Ticker(yf_tkr)
+        start = delta_start(out_path)
         
         for attempt in range(2):
             try:
-                hist = tk.history(period="2y", timeout=20)
+                hist = fetch_history(yf_tkr, **history_kwargs(start), timeout=20)
                 if hist is not None and not hist.empty:
-                    hist.reset_index(inplace=True)
-                    hist.columns = [c.lower() for c in hist.columns]
-                    hist.to_csv(out_path, index=False, encoding='utf-8-sig')
-                    return {"status": "success", "tkr": yf_tkr}
+                    df = prepare_history(hist)
+                    if not write_frame(df, out_path, start):
+                        # 重疊區間價格遭調整 (除權息/分割)，改為完整重抓
+                        hist = fetch_history(yf_tkr, period="2y", timeout=20)
+                        if hist is None or hist.empty: return {"status": "empty", "tkr": yf_tkr}
+                        df, start = prepare_history(hist), None
+                        write_frame(df, out_path)
+                    # 完整下載時附上整份 K 線供串流分析使用，增量更新則由分析端讀取檔尾
+                    return {"status": "success", "tkr": yf_tkr, "path": out_path, "frame": None if start else df}
+                # 增量區間沒有新 K 棒，既有資料仍然有效
+                if start: return {"status": "exists", "tkr": yf_tkr, "path": out_path}
                 if attempt == 1: return {"status": "empty", "tkr": yf_tkr}
-            except Exception as e:
-                if "Rate limited" in str(e): 
-                    time.sleep(random.uniform(20, 40))
-            time.sleep(random.uniform(3, 6))
+            except Exception:
+                # 限流 (429) 的冷卻與降速由限流器統一處理，這裡直接重試
+                if attempt == 1: break
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="single")
 
         return {"status": "empty", "tkr": yf_tkr}
     except: 
         return {"status": "error"}
 
-def main():
-    items = get_full_stock_list()
+def fetch_batch(symbols, start):
+    return fetch_history_batch(symbols, **history_kwargs(start), timeout=20)
+
+def download_batch(chunk):
+    """
+    ⚡ 批次下載：整塊標的合併為一次請求，批次中缺漏的標的再逐檔補抓
+    """
+    parsed = {it: parse_item(it) for it in chunk}
+    done = {}
+    for attempt in range(2):
+        try:
+            done = sync_batch([p for p in parsed.values() if p], fetch_batch, prepare_history)
+            break
+        except Exception:
+            if attempt == 0:
+                metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="batch")
+            continue
+
+    results = []
+    for it, p in parsed.items():
+        if p is None:
+            results.append({"status": "error"})
+        elif p[0] in done:
+            results.append({"status": "success", "tkr": p[0], "path": p[1], "frame": done[p[0]]})
+        else:
+            metrics.inc("retries_total", op="download", market=MARKET_CODE, mode="fallback")
+            results.append(download_stock_data(it))
+    return results
+
+def download_chunk(chunk):
+    """依 BATCH_SIZE 選擇批次或逐檔模式，一律回傳結果清單 (每筆附上清單項目，供進度日誌記錄)"""
+    results = download_batch(chunk) if BATCH_SIZE > 1 else [download_stock_data(it) for it in chunk]
+    return [dict(res, item=it) for it, res in zip(chunk, results)]
+
+def main(sink=None):
+    """sink(path, frame): 串流分析入口，每檔下載完成或命中快取時即送出"""
+    # 續跑中斷的下載時沿用日誌中的清單，不再重新抓取
+    journal = ProgressJournal(MARKET_CODE)
+    items = journal.items if journal.load() else get_full_stock_list()
     if not items:
         return {"total": 0, "success": 0, "fail": 0}
+    journal.begin(items)
 
     log(f"🚀 啟動美股下載任務，目標總數: {len(items)}")
     stats = {"success": 0, "exists": 0, "empty": 0, "error": 0}
+
+    # 日誌中已完成的標的沿用狀態；其餘先排除今日已更新的檔案，只將待下載標的分塊送出
+    done, pending = journal.split(items)
+    for it, status in done:
+        stats[status] += 1
+        if sink and status in ("success", "exists"): sink(parse_item(it)[1])
+    todo = []
+    for it in pending:
+        parsed = parse_item(it)
+        if parsed and is_fresh(parsed[1]):
+            stats["exists"] += 1
+            journal.record(it, "exists")
+            if sink: sink(parsed[1])
+        else:
+            todo.append(it)
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(download_stock_data, it): it for it in items}
-        pbar = tqdm(total=len(items), desc="美股下載進度", unit="檔")
-        
-        for future in as_completed(futures):
-            res = future.result()
+    pbar = tqdm(total=len(items), initial=len(items) - len(todo), desc="美股下載進度", unit="檔")
+
+    def on_result(results):
+        for res in results:
             stats[res.get("status", "error")] += 1
+            journal.record(res.get("item"), res.get("status", "error"))
             pbar.update(1)
-            
-            # 每成功下載 100 檔額外休息，防止被 Yahoo 封鎖
-            if pbar.n % 100 == 0:
-                time.sleep(random.uniform(10, 20))
-        pbar.close()
+            if sink and res.get("status") in ("success", "exists"):
+                sink(res["path"], res.get("frame"))
+
+    run_tasks(download_chunk, list(chunked(todo, BATCH_SIZE)), host="yahoo", limit=MAX_WORKERS,
+              timeout=TASK_TIMEOUT, on_result=on_result,
+              on_error=lambda chunk, e: [{"status": "error", "item": it} for it in chunk])
+    pbar.close()
+    log(YAHOO.summary())
+    # 欄式倉儲 (選用)：整批寫出下載期間暫存的 K 線
+    price_store.flush(MARKET_CODE, rebuild=journal.resumed)
     
     # ✨ 重要：構建回傳給 main.py 的統計字典
     report_stats = {
@@ -155,6 +238,7 @@ def main():
         "success": stats["success"] + stats["exists"],
         "fail": stats["error"] + stats["empty"]
     }
+    journal.finish(report_stats)
     
     print("\n" + "="*50)
     log(f"📊 美股下載完成報告: {report_stats}")
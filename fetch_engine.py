@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import get_limiter, TaskClock, TaskCancelled, bind_task
+from price_provider import get_provider
+import metrics
+
+# ========== 連線池設定 ==========
+POOL_SIZE = 16
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+
+_SESSIONS = {}
+_SESSION_LOCK = threading.Lock()
+
+def get_session(host):
+    """每個主機共用一個 keep-alive Session，避免每次請求重新建立 TCP/TLS 連線"""
+    with _SESSION_LOCK:
+        if host not in _SESSIONS:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers.update(DEFAULT_HEADERS)
+            _SESSIONS[host] = s
+        return _SESSIONS[host]
+
+def http_get(url, host, timeout=15, **kwargs):
+    """經由共用連線池與限流器發出 GET 請求 (錄製/重播時由行情來源處理)"""
+    with get_limiter(host).request() as req:
+        resp = get_provider().get(url, get_session(host), timeout=timeout, **kwargs)
+        if resp.status_code == 429:
+            req.throttled()
+        return resp
+
+class FetchEngine:
+    """
+    asyncio 下載引擎
+    - 以單一事件迴圈排程所有標的，等待中的任務不佔用執行緒
+    - 每個主機一個 Semaphore 控制同時進行中的請求數
+    - 每個任務具備逾時，只計算取得限流名額後的執行時間 (在限流器排隊不算)；
+      cancel() 可從任何執行緒中止尚未開始的任務
+    - 逾時或中止的任務在下一次請求前停下 (TaskCancelled)，引擎等它的執行緒真正結束才回報結果，
+      run() 返回後不會再有任務寫檔 / 寫入倉儲
+    阻塞式的 yfinance / requests 呼叫由大小等於併發上限的執行緒池執行。
+    """
+    def __init__(self, host="yahoo", limit=None, timeout=None):
+        self.host = host
+        self.limit = max(1, int(limit or get_limiter(host).max_workers))
+        self.timeout = timeout
+        self._loop = None
+        self._main = None
+        self._clocks = set()
+
+    async def _run_all(self, func, items, on_result, on_error):
+        self._loop = asyncio.get_running_loop()
+        self._main = asyncio.current_task()
+        sem = asyncio.Semaphore(self.limit)
+        results = [None] * len(items)
+
+        executor = ThreadPoolExecutor(max_workers=self.limit)
+
+        def timed(item, queued_at, clock):
+            # 排隊 = 等待併發名額與執行緒；任務耗時含限流等待、網路、解析與寫檔
+            start = time.perf_counter()
+            metrics.observe("task_queue_seconds", start - queued_at, host=self.host)
+            clock.started = time.monotonic()
+            bind_task(clock)
+            try:
+                return func(item)
+            finally:
+                bind_task(None)
+                metrics.observe("task_seconds", time.perf_counter() - start, _task_label(item), host=self.host)
+
+        async def one(i, item):
+            queued_at = time.perf_counter()
+            async with sem:
+                clock = TaskClock()
+                self._clocks.add(clock)
+                fut = self._loop.run_in_executor(executor, timed, item, queued_at, clock)
+                try:
+                    res = await self._await_task(fut, clock, item)
+                except asyncio.CancelledError:
+                    raise
+                except (Exception, TaskCancelled) as e:
+                    res = on_error(item, e) if on_error else None
+                finally:
+                    self._clocks.discard(clock)
+            results[i] = res
+            if on_result:
+                on_result(res)
+
+        tasks = [asyncio.create_task(one(i, it)) for i, it in enumerate(items)]
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for clock in list(self._clocks):
+                clock.cancel()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # 執行中的任務已標記取消，會在下一次請求前停下；等它們結束，呼叫端收尾 (flush/close) 後不會再被寫入
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+        return results
+
+    async def _await_task(self, fut, clock, item):
+        """
+        等待單一任務；執行時間 (不含限流排隊) 超過逾時即標記取消，
+        並等執行緒真正結束：正常完成就採用其結果，在請求前被中止則拋出 TaskCancelled 由 on_error 處理
+        """
+        if not self.timeout:
+            return await fut
+        while True:
+            left = self.timeout - clock.active_seconds()
+            if left <= 0:
+                break
+            done, _ = await asyncio.wait({fut}, timeout=max(left, 0.05))
+            if done:
+                return fut.result()
+        clock.cancel()
+        metrics.inc("task_timeouts_total", host=self.host)
+        return await fut
+
+    def run(self, func, items, on_result=None, on_error=None):
+        """
+        對每個 item 執行 func(item)，回傳與 items 同順序的結果清單
+        on_result(res): 每完成一個任務即呼叫 (在事件迴圈執行緒中，無需加鎖)
+        on_error(item, exc): 逾時或例外時產生替代結果
+        被 cancel() 中止時，未執行的項目結果為 None
+        """
+        items = list(items)
+        if not items:
+            return []
+        return asyncio.run(self._run_all(func, items, on_result, on_error))
+
+    def cancel(self):
+        """中止執行中的 run()：已送出的請求會跑完，尚未開始的任務直接取消"""
+        if self._loop and self._main:
+            self._loop.call_soon_threadsafe(self._main.cancel)
+
+def _task_label(item):
+    """任務標籤 (量測的最慢項目)：逐檔為代號，批次 (list) 為首檔與檔數"""
+    if isinstance(item, list):
+        return f"{_task_label(item[0])} +{len(item) - 1}" if item else "[]"
+    if isinstance(item, tuple) and item:
+        item = item[0]
+    return str(item).split("&", 1)[0]
+
+def run_tasks(func, items, host="yahoo", limit=None, timeout=None, on_result=None, on_error=None):
+    """FetchEngine 的便捷包裝"""
+    return FetchEngine(host=host, limit=limit, timeout=timeout).run(func, items, on_result, on_error)
@@ -1,23 +1,53 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import time
+import importlib
 import argparse
 import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext, contextmanager
 from datetime import datetime, timedelta
 
-# 導入自定義模組
-import downloader_tw
-import downloader_us
-import downloader_hk
-import downloader_cn
-import downloader_jp
-import downloader_kr
-import analyzer
-import notifier
-
-def run_market_pipeline(market_id, market_name, emoji):
+# 導入自定義模組 (下載器、分析與通知模組連同其第三方套件，到實際執行該市場時才載入)
+import metrics
+import profiler
+import deps
+
+# 各市場的下載器模組
+DOWNLOADERS = {
+    "tw-share": "downloader_tw",
+    "us-share": "downloader_us",
+    "hk-share": "downloader_hk",
+    "cn-share": "downloader_cn",
+    "jp-share": "downloader_jp",
+    "kr-share": "downloader_kr",
+}
+# 以 dayK CSV 儲存、支援邊下載邊分析的市場
+STREAMING_MARKETS = {"tw-share", "us-share", "cn-share", "kr-share"}
+# 平行模式市場行程的啟動方式：啟動前補寄報告可能已開出通知執行緒，fork 會把它們持有中的鎖帶進子行程，
+# 改由 forkserver 的乾淨程序分叉 (不支援的平台用 spawn)
+PIPELINE_START_METHOD = os.getenv("PIPELINE_START_METHOD") or (
+    "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+
+def _slot(slots, name):
+    """取得跨行程共用的併發名額；未啟用平行模式時不做限制"""
+    if slots and slots.get(name) is not None:
+        return slots[name]
+    return nullcontext()
+
+@contextmanager
+def _stage(name, market_id):
+    """管線階段：記錄耗時量測，--profile 時另做 CPU / 記憶體剖析"""
+    with metrics.stage(name, market=market_id), profiler.stage(name, market_id):
+        yield
+
+def run_market_pipeline(market_id, market_name, emoji, slots=None, stream=False):
     """
     執行單一市場的完整管線：下載 -> 分析 -> 寄信
+    slots: 平行模式下由 main() 傳入的全域名額 {"download": Semaphore, "analysis": Semaphore}
+    stream: 串流模式，每檔下載完成即送入分析佇列，省去下載後重新掃描整個 dayK 目錄
     """
     print("\n" + "="*60)
     print(f"{emoji} 啟動管線：{market_name} ({market_id})")
@@ -25,30 +55,30 @@ def run_market_pipeline(market_id, market_name, emoji):
 
     # 初始化統計變數，預設為 0
     stats = {"total": 0, "success": 0, "fail": 0}
+
+    import analyzer
+    import notifier
     
-    # 建立通知器實例 (用於發送 Telegram 與 Resend 郵件)
-    agent = notifier.StockNotifier()
+    # 建立通知器實例 (用於發送 Telegram 與 Resend 郵件)，報告交由背景派送，不阻塞下一個市場
+    agent = notifier.StockNotifier(dispatcher=notifier.get_dispatcher())
+
+    # 串流分析器：下載期間即在背景計算報酬
+    stream_acc = None
+    if stream and market_id in STREAMING_MARKETS:
+        stream_acc = analyzer.StreamingAnalysis(market_id)
+    sink = stream_acc.submit if stream_acc else None
 
     # --- Step 1: 數據獲取 ---
     print(f"【Step 1: 數據獲取】正在更新 {market_name} 原始 K 線資料...")
     try:
         res = None
-        # 根據市場 ID 呼叫對應的下載器主函數
-        if market_id == "tw-share":
-            res = downloader_tw.main()
-        elif market_id == "us-share":
-            res = downloader_us.main()
-        elif market_id == "hk-share":
-            res = downloader_hk.main()
-        elif market_id == "cn-share":
-            res = downloader_cn.main()
-        elif market_id == "jp-share":
-            res = downloader_jp.main()
-        elif market_id == "kr-share":
-            res = downloader_kr.main()
-        else:
-            print(f"⚠️ 未知的市場 ID: {market_id}")
-            return
+        with _slot(slots, "download"), _stage("download", market_id):
+            # 根據市場 ID 載入並呼叫對應的下載器主函數
+            if market_id not in DOWNLOADERS:
+                print(f"⚠️ 未知的市場 ID: {market_id}")
+                return
+            downloader = importlib.import_module(DOWNLOADERS[market_id])
+            res = downloader.main(sink=sink) if market_id in STREAMING_MARKETS else downloader.main()
 
         # ✨ 數據標準化：對接新版下載器的 return 字典
         if isinstance(res, dict):
@@ -67,8 +97,13 @@ def run_market_pipeline(market_id, market_name, emoji):
     # --- Step 2: 數據分析 & 繪圖 ---
     print(f"\n【Step 2: 矩陣分析】正在計算 {market_name} 動能分布並生成圖表...")
     try:
-        # 呼叫分析核心，這會產生 9 張矩陣圖與報酬報表
-        img_paths, report_df, text_reports = analyzer.run_global_analysis(market_id=market_id)
+        # 呼叫分析核心，這會產生 9 張矩陣圖與報酬報表 (CPU 密集，受分析名額限制)
+        with _slot(slots, "analysis"), _stage("analysis", market_id):
+            if stream_acc:
+                # 報酬已於下載期間算好，這裡只需收尾繪圖
+                img_paths, report_df, text_reports = stream_acc.finish()
+            else:
+                img_paths, report_df, text_reports = analyzer.run_global_analysis(market_id=market_id)
         
         if report_df is None or report_df.empty:
             print(f"⚠️ {market_name} 分析結果為空 (可能是 CSV 資料不足)，跳過寄信步驟。")
@@ -80,28 +115,107 @@ def run_market_pipeline(market_id, market_name, emoji):
         print(f"\n【Step 3: 報表發送】正在透過 Resend 傳送郵件...")
         
         # 將下載統計 (stats) 與分析結果一併送出
-        success_sent = agent.send_stock_report(
-            market_name=market_name,
-            img_data=img_paths,
-            report_df=report_df,
-            text_reports=text_reports,
-            stats=stats
-        )
+        with _stage("report", market_id):
+            success_sent = agent.send_stock_report(
+                market_name=market_name,
+                img_data=img_paths,
+                report_df=report_df,
+                text_reports=text_reports,
+                stats=stats
+            )
         
         if success_sent:
-            print(f"✅ {market_name} 監控報告已成功寄達！")
+            print(f"✅ {market_name} 監控報告已交付派送！")
         else:
             print(f"❌ {market_name} 報告寄送失敗 (請檢查 API Key 或日誌)。")
 
     except Exception as e:
         print(f"❌ {market_name} 分析或寄信過程出錯:\n{traceback.format_exc()}")
 
+def run_market_pipeline_isolated(*args, budget_share=1):
+    """
+    平行模式的子行程入口：管線結束後等待本行程的背景通知派送完成，並寫出該市場的量測與剖析摘要
+    budget_share: 同時下載的市場行程數，本行程只使用共用主機 (Yahoo) 1/budget_share 的限流預算
+    """
+    import notifier
+    import rate_limiter
+    rate_limiter.set_process_share(budget_share)
+    # 工作行程可能沿用上一個市場的紀錄，先清空
+    metrics.reset()
+    profiler.reset()
+    try:
+        return run_market_pipeline(*args)
+    finally:
+        notifier.drain_dispatcher()
+        write_run_reports(args[0])
+
+def write_run_reports(label):
+    """寫出本行程的量測檔 (與 --profile 的剖析摘要) 並印出摘要"""
+    paths = metrics.write(label)
+    if paths:
+        print(f"📈 [{label}] 量測結果：{', '.join(paths)}")
+        text = metrics.summary()
+        if text:
+            print(text)
+    path = profiler.write_summary(label)
+    if path:
+        print(f"🔬 [{label}] 剖析結果：{profiler.PROFILE_DIR} (摘要 {os.path.basename(path)})")
+        print(profiler.summary())
+
+def run_markets_parallel(markets_config, jobs, download_slots, analysis_slots, stream=False):
+    """
+    以多行程同時執行多個市場管線
+    下載 (網路密集) 與分析 (CPU 密集) 各自有全域名額，讓一個市場的下載可與另一個市場的分析重疊
+    """
+    print(f"⚡ 平行模式：{jobs} 個行程 | 下載名額 {download_slots} | 分析名額 {analysis_slots}")
+    ctx = mp.get_context(PIPELINE_START_METHOD)
+    # 同時下載的行程數上限：Yahoo 預算依此均分，合計不超過單一行程的上限
+    share = min(download_slots, jobs)
+    with ctx.Manager() as manager:
+        slots = {
+            "download": manager.Semaphore(download_slots),
+            "analysis": manager.Semaphore(analysis_slots),
+        }
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as pool:
+            futures = {
+                pool.submit(run_market_pipeline_isolated, m_id, m_info["name"], m_info["emoji"], slots, stream,
+                            budget_share=share): m_id
+                for m_id, m_info in markets_config.items()
+            }
+            for f in as_completed(futures):
+                try:
+                    f.result()
+                except Exception:
+                    print(f"❌ {futures[f]} 管線行程異常終止:\n{traceback.format_exc()}")
+
 def main():
     parser = argparse.ArgumentParser(description="Global Stock Monitor Orchestrator")
     parser.add_argument('--market', type=str, default='all', 
                         choices=['tw-share', 'us-share', 'hk-share', 'cn-share', 'jp-share', 'kr-share', 'all'])
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='--market all 時同時執行的市場數 (1 = 依序執行)')
+    parser.add_argument('--download-slots', type=int, default=3,
+                        help='平行模式下同時進行下載的市場數上限')
+    parser.add_argument('--analysis-slots', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='平行模式下同時進行分析/繪圖的市場數上限')
+    parser.add_argument('--stream', action='store_true',
+                        help='邊下載邊分析 (TW/US/CN/KR)，下載結束後只剩繪圖與寄信')
+    parser.add_argument('--check-deps', action='store_true',
+                        help='只檢查所選市場需要的套件是否已安裝 (AUTO_INSTALL_DEPS=1 時安裝缺少的套件) 後結束')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='DIR',
+                        help='以 cProfile + tracemalloc 剖析各階段，輸出至 DIR (預設 output/profile/<時間>)')
     args = parser.parse_args()
 
+    if args.check_deps:
+        markets = list(DOWNLOADERS) if args.market == 'all' else [args.market]
+        print(f"📦 套件檢查：{', '.join(markets)}")
+        sys.exit(1 if deps.report(markets) else 0)
+
+    if args.profile is not None:
+        out_dir = args.profile or os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "profile",
+                                               datetime.now().strftime("%Y%m%d_%H%M%S"))
+        print(f"🔬 剖析模式：輸出至 {profiler.enable(out_dir)}")
+
     start_time = time.time()
     
     # 獲取台北時間 (UTC+8) 供 Log 記錄
@@ -114,6 +228,10 @@ def main():
     print(f"🚀 執行目標: {args.market}")
     print("🚀 " + "="*55 + "\n")
 
+    import notifier
+    # 補寄上次執行未送達的報告 (於啟動子行程前處理，避免重複寄送)
+    notifier.get_dispatcher().resend_pending()
+
     # 市場配置表
     markets_config = {
         "tw-share": {"name": "台灣股市", "emoji": "🇹🇼"},
@@ -124,18 +242,27 @@ def main():
         "us-share": {"name": "美國股市", "emoji": "🇺🇸"}
     }
 
-    if args.market == 'all':
+    if args.market == 'all' and args.jobs > 1:
+        # 多行程平行執行所有市場
+        run_markets_parallel(markets_config, min(args.jobs, len(markets_config)),
+                             max(1, args.download_slots), max(1, args.analysis_slots), args.stream)
+    elif args.market == 'all':
         # 依序執行所有市場
         for m_id, m_info in markets_config.items():
-            run_market_pipeline(m_id, m_info["name"], m_info["emoji"])
+            run_market_pipeline(m_id, m_info["name"], m_info["emoji"], stream=args.stream)
     else:
         # 執行指定市場
         m_info = markets_config.get(args.market)
         if m_info:
-            run_market_pipeline(args.market, m_info["name"], m_info["emoji"])
+            run_market_pipeline(args.market, m_info["name"], m_info["emoji"], stream=args.stream)
         else:
             print(f"❌ 找不到對應的市場配置: {args.market}")
 
+    # 只在結束前等待背景通知送達
+    notifier.drain_dispatcher()
+    # 平行模式的各市場量測已由子行程寫出，這裡只記錄本行程 (依序模式為全部市場)
+    write_run_reports(args.market if not (args.market == 'all' and args.jobs > 1) else "main")
+
     end_time = time.time()
     total_duration = (end_time - start_time) / 60
     print("\n" + "="*60)
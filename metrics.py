@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+管線量測 (本程序共用一份 REGISTRY，各模組直接呼叫 timer / observe / inc)
+- 延遲以直方圖記錄，輸出 count / sum / min / max / p50 / p95 / p99，並保留最慢的項目 (例如哪一檔)
+- 計數器記錄請求結果 (含限流)、重試與重抓次數
+- write() 於每次執行結束時寫出 output/metrics/<時間>_<標籤>.json (METRICS_FORMAT=prom/both 另寫 Prometheus 文字格式)
+METRICS=0 時所有呼叫皆為空操作
+"""
+import os
+import json
+import time
+import random
+import heapq
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+METRICS_ENABLED = os.getenv("METRICS", "1") != "0"
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(BASE_DIR, "output", "metrics"))
+# json | prom | both
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "json").lower()
+# Prometheus 指標名稱前綴
+PROM_PREFIX = "stock_"
+# 每個序列保留的樣本上限 (超過後以蓄水池抽樣，百分位數仍具代表性)
+MAX_SAMPLES = 50_000
+# 每個序列保留的最慢項目數
+TOP_N = 10
+QUANTILES = (0.5, 0.95, 0.99)
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.samples = []
+        self.slowest = []  # (值, 項目) 的最小堆，只保留 TOP_N 筆
+
+    def observe(self, value, item=None):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(value)
+        else:
+            j = random.randrange(self.count)
+            if j < MAX_SAMPLES:
+                self.samples[j] = value
+        if item is not None:
+            entry = (value, str(item)[:120])
+            if len(self.slowest) < TOP_N:
+                heapq.heappush(self.slowest, entry)
+            elif value > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def stats(self):
+        qs = np.quantile(self.samples, QUANTILES) if self.samples else [0.0] * len(QUANTILES)
+        out = {"count": self.count, "sum": round(self.sum, 6),
+               "min": round(self.min if self.count else 0.0, 6), "max": round(self.max, 6)}
+        out.update({f"p{int(q * 100)}": round(float(v), 6) for q, v in zip(QUANTILES, qs)})
+        if self.slowest:
+            out["slowest"] = [{"item": it, "seconds": round(v, 4)} for v, it in sorted(self.slowest, reverse=True)]
+        return out
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, name, value, item=None, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(float(value), item)
+
+    def inc(self, name, n=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextmanager
+    def timer(self, name, item=None, **labels):
+        """計時區塊；例外時仍記錄 (outcome 標籤由呼叫端自行決定)"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, item, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            hists = [(n, dict(l), h.stats()) for (n, l), h in self.histograms.items()]
+            counters = [(n, dict(l), v) for (n, l), v in self.counters.items()]
+        return {
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "pid": os.getpid(),
+            "histograms": [{"name": n, "labels": l, **s} for n, l, s in sorted(hists, key=lambda x: (x[0], sorted(x[1].items())))],
+            "counters": [{"name": n, "labels": l, "value": v} for n, l, v in sorted(counters, key=lambda x: (x[0], sorted(x[1].items())))],
+        }
+
+    def to_prometheus(self, snap=None):
+        """Prometheus 文字格式：直方圖以 summary (分位數 + _sum/_count) 表示"""
+        snap = snap or self.snapshot()
+        lines, typed = [], set()
+        fmt = lambda labels: "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels.items()) + "}" if labels else ""
+        for h in snap["histograms"]:
+            name = PROM_PREFIX + h["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} summary")
+                typed.add(name)
+            for q in QUANTILES:
+                lines.append(f"{name}{fmt({**h['labels'], 'quantile': q})} {h[f'p{int(q * 100)}']}")
+            lines.append(f"{name}_sum{fmt(h['labels'])} {h['sum']}")
+            lines.append(f"{name}_count{fmt(h['labels'])} {h['count']}")
+        for c in snap["counters"]:
+            name = PROM_PREFIX + c["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{fmt(c['labels'])} {c['value']}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+timer = REGISTRY.timer
+reset = REGISTRY.reset
+snapshot = REGISTRY.snapshot
+
+def stage(name, **labels):
+    """管線階段計時 (stage_seconds{stage=...})"""
+    return REGISTRY.timer("stage_seconds", stage=name, **labels)
+
+def write(label="run", out_dir=None, fmt=None):
+    """寫出本程序的量測結果；回傳寫出的檔案清單"""
+    if not METRICS_ENABLED:
+        return []
+    out_dir = out_dir or METRICS_DIR
+    fmt = fmt or METRICS_FORMAT
+    os.makedirs(out_dir, exist_ok=True)
+    snap = REGISTRY.snapshot()
+    base = os.path.join(out_dir, f"{datetime.now():%Y%m%d_%H%M%S}_{label}")
+    paths = []
+    if fmt in ("json", "both"):
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump({"label": label, **snap}, f, ensure_ascii=False, indent=1)
+        paths.append(base + ".json")
+    if fmt in ("prom", "both"):
+        with open(base + ".prom", "w", encoding="utf-8") as f:
+            f.write(REGISTRY.to_prometheus(snap))
+        paths.append(base + ".prom")
+    return paths
+
+def summary(top=8):
+    """終端機摘要：各階段耗時、請求最慢的主機 (p95) 與限流/錯誤次數"""
+    snap = REGISTRY.snapshot()
+    lines = []
+    for h in snap["histograms"]:
+        if h["name"] == "stage_seconds":
+            lbl = " ".join(f"{k}={v}" for k, v in h["labels"].items())
+            lines.append(f"  ⏱️ {lbl}: {h['sum']:.1f}s")
+    reqs = sorted((h for h in snap["histograms"] if h["name"] == "request_seconds"), key=lambda h: -h["p95"])
+    for h in reqs[:top]:
+        lbl = " ".join(f"{k}={v}" for k, v in h["labels"].items())
+        lines.append(f"  🌐 {lbl}: {h['count']} 次 | p50 {h['p50']:.2f}s | p95 {h['p95']:.2f}s | p99 {h['p99']:.2f}s")
+    for c in snap["counters"]:
+        if c["name"] in ("requests_total", "retries_total", "refetch_total") and c["labels"].get("outcome") != "ok":
+            lbl = " ".join(f"{k}={v}" for k, v in c["labels"].items())
+            lines.append(f"  🔁 {c['name']} {lbl}: {c['value']}")
+    return "\n".join(lines)
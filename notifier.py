@@ -1,16 +1,322 @@
 # -*- coding: utf-8 -*-
+import io
 import os
+import json
+import time
+import uuid
+import base64
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import resend
 import pandas as pd
 from datetime import datetime, timedelta
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# ========== 郵件附件設定 ==========
+# 圖檔格式：png (原檔) / palette (256 色調色盤 PNG) / webp
+MAIL_IMAGE_FORMAT = os.getenv("MAIL_IMAGE_FORMAT", "png").lower()
+# 全部附件的位元組預算 (KB)，0 為不限制；超出時依序改用更精簡的編碼
+MAIL_ATTACH_BUDGET_KB = int(os.getenv("MAIL_ATTACH_BUDGET_KB", "0"))
+# 由輕到重的重新壓縮階梯 (格式, 參數)：調色盤色數 / WebP 品質
+RECOMPRESS_STEPS = [("palette", 256), ("palette", 64), ("webp", 80), ("webp", 50)]
+
+# ========== 背景派送設定 ==========
+# 同時派送的報告數
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "3"))
+# 單一請求最多嘗試次數與退避基準秒數 (指數退避 + 抖動，優先採用 Retry-After)
+NOTIFY_ATTEMPTS = int(os.getenv("NOTIFY_ATTEMPTS", "4"))
+NOTIFY_BACKOFF = 2.0
+RETRY_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# 未送達的報告存放處，下次執行時自動補寄；無法重試的錯誤移至 failed/
+OUTBOX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "outbox")
+MAIL_FROM = "StockMonitor <onboarding@resend.dev>"
+MAIL_TO = "wallacehsieh366@gmail.com"
+
+_SESSION = None
+_SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session():
+    """共用的連線池 Session (Telegram 與 Resend 共用，避免每次請求重新握手)；fork 出的子行程各自重建"""
+    global _SESSION, _SESSION_PID
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_PID != os.getpid():
+            _SESSION_PID = os.getpid()
+            _SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(4, NOTIFY_WORKERS * 2))
+            _SESSION.mount("https://", adapter)
+            _SESSION.mount("http://", adapter)
+        return _SESSION
+
+try:
+    from resend.http_client import HTTPClient as _ResendHTTPClient
+
+    class PooledResendClient(_ResendHTTPClient):
+        """讓 Resend SDK 改走共用 Session"""
+        def request(self, method, url, headers, json=None, files=None, data=None):
+            try:
+                resp = get_session().request(method=method, url=url, headers=headers, files=files,
+                                             json=json if data is None and files is None else None,
+                                             data=data, timeout=30)
+                return resp.content, resp.status_code, resp.headers
+            except requests.RequestException as e:
+                raise RuntimeError(f"Request failed: {e}") from e
+
+    resend.default_http_client = PooledResendClient()
+except ImportError:
+    # 舊版 SDK 不支援自訂 HTTP client，維持預設
+    pass
+
+class SendError(Exception):
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def _retry_after(headers):
+    try:
+        return float((headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def send_email(payload):
+    """透過 Resend 寄信；失敗時拋出 SendError"""
+    api_key = os.getenv("RESEND_API_KEY")
+    if not api_key:
+        raise SendError("缺少 Resend API Key", retryable=False)
+    resend.api_key = api_key
+    try:
+        resend.Emails.send(payload)
+    except resend.exceptions.ResendError as e:
+        try:
+            code = int(e.code)
+        except (TypeError, ValueError):
+            code = 500
+        raise SendError(f"Resend {code}: {e}", retryable=code in RETRY_STATUS,
+                        retry_after=_retry_after(getattr(e, "headers", None))) from e
+
+def send_telegram_message(text):
+    """發送 Telegram 訊息 (附發送時間)；未設定 Token 時略過"""
+    token, chat_id = os.getenv("TELEGRAM_BOT_TOKEN"), os.getenv("TELEGRAM_CHAT_ID")
+    if not token or not chat_id:
+        return
+    ts = (datetime.utcnow() + timedelta(hours=8)).strftime("%H:%M:%S")
+    payload = {"chat_id": chat_id, "text": f"{text}\n\n🕒 <i>Sent at {ts} (UTC+8)</i>", "parse_mode": "HTML"}
+    try:
+        resp = get_session().post(f"https://api.telegram.org/bot{token}/sendMessage", json=payload, timeout=10)
+    except requests.RequestException as e:
+        raise SendError(f"Telegram 連線失敗: {e}") from e
+    if not resp.ok:
+        raise SendError(f"Telegram {resp.status_code}", retryable=resp.status_code in RETRY_STATUS,
+                        retry_after=_retry_after(resp.headers))
+
+SENDERS = {"email": send_email, "telegram": send_telegram_message}
+
+def send_with_retry(step, attempts=NOTIFY_ATTEMPTS):
+    """有限次數重試；回傳 None 表示成功，否則回傳最後的 SendError"""
+    for attempt in range(attempts):
+        if attempt:
+            metrics.inc("retries_total", op="send", type=step["type"])
+        t0 = time.perf_counter()
+        try:
+            SENDERS[step["type"]](step["payload"])
+            metrics.observe("send_seconds", time.perf_counter() - t0, type=step["type"], outcome="ok")
+            return None
+        except SendError as e:
+            err = e
+        metrics.observe("send_seconds", time.perf_counter() - t0, type=step["type"], outcome="error")
+        if not err.retryable or attempt == attempts - 1:
+            break
+        wait = err.retry_after if err.retry_after is not None else NOTIFY_BACKOFF * 2 ** attempt
+        time.sleep(wait + random.uniform(0, 0.5))
+    return err
+
+def deliver(job, on_progress=None):
+    """
+    依序執行報告的派送步驟 (郵件成功後才發 Telegram)；已完成的步驟標記 done，補寄時略過
+    回傳 (是否全部成功, 是否可再重試)
+    """
+    for step in job["steps"]:
+        if step.get("done"):
+            continue
+        err = send_with_retry(step)
+        if err is not None:
+            print(f"❌ {job['label']} {step['type']} 派送失敗: {err}")
+            return False, err.retryable
+        step["done"] = True
+        if on_progress:
+            on_progress(job)
+    return True, False
+
+class NotificationDispatcher:
+    """
+    背景派送佇列：submit() 立即返回，由執行緒池並行寄送
+    每份報告先寫入 outbox，全部步驟成功才刪除；drain() 於程式結束前等待所有派送完成
+    """
+    def __init__(self, workers=NOTIFY_WORKERS, outbox_dir=OUTBOX_DIR):
+        self.pid = os.getpid()
+        self.outbox = outbox_dir
+        os.makedirs(self.outbox, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def _path(self, job):
+        return os.path.join(self.outbox, f"{job['id']}.json")
+
+    def _persist(self, job):
+        tmp = self._path(job) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, self._path(job))
+
+    def submit(self, job):
+        job.setdefault("id", f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}")
+        self._persist(job)
+        fut = self.pool.submit(self._run, job)
+        with self.lock:
+            self.futures.append(fut)
+        return fut
+
+    def _run(self, job):
+        ok, retryable = deliver(job, on_progress=self._persist)
+        if ok:
+            os.remove(self._path(job))
+            print(f"✅ {job['label']} 報告派送完成")
+        elif not retryable:
+            failed_dir = os.path.join(self.outbox, "failed")
+            os.makedirs(failed_dir, exist_ok=True)
+            os.replace(self._path(job), os.path.join(failed_dir, os.path.basename(self._path(job))))
+        else:
+            print(f"📮 {job['label']} 報告保留於 outbox，下次執行時補寄")
+        return ok
+
+    def resend_pending(self):
+        """補寄上次執行未送達的報告"""
+        pending = sorted(f for f in os.listdir(self.outbox) if f.endswith(".json"))
+        for name in pending:
+            try:
+                with open(os.path.join(self.outbox, name), "r", encoding="utf-8") as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            print(f"📮 補寄上次未送達的報告：{job.get('label', name)}")
+            self.submit(job)
+        return len(pending)
+
+    def drain(self, timeout=None):
+        """等待所有派送結束，回傳 (成功數, 失敗數)"""
+        with self.lock:
+            futures, self.futures = self.futures, []
+        results = []
+        for f in futures:
+            try:
+                results.append(bool(f.result(timeout=timeout)))
+            except Exception:
+                results.append(False)
+        return sum(results), len(results) - sum(results)
+
+    def close(self, timeout=None):
+        sent, failed = self.drain(timeout)
+        self.pool.shutdown(wait=True)
+        return sent, failed
+
+_DISPATCHER = None
+
+def get_dispatcher():
+    """程序內共用的派送器 (補寄舊報告需由主程序呼叫 resend_pending，避免多行程重複寄送)"""
+    global _DISPATCHER
+    # fork 出的子行程繼承的派送器沒有工作執行緒，需重建
+    if _DISPATCHER is None or _DISPATCHER.pid != os.getpid():
+        _DISPATCHER = NotificationDispatcher()
+    return _DISPATCHER
+
+def drain_dispatcher():
+    """程式結束前呼叫：等待背景派送完成"""
+    global _DISPATCHER
+    if _DISPATCHER is None or _DISPATCHER.pid != os.getpid():
+        return
+    print("📮 等待背景通知派送完成...")
+    sent, failed = _DISPATCHER.close()
+    print(f"📮 通知派送結束：成功 {sent} | 失敗 {failed}")
+    _DISPATCHER = None
+
+def recompress(raw, fmt, param):
+    """以 Pillow 重新編碼圖檔，回傳 (bytes, 副檔名, MIME)"""
+    img = Image.open(io.BytesIO(raw)).convert("RGB")
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, format="WEBP", quality=param, method=6)
+        return buf.getvalue(), "webp", "image/webp"
+    img.quantize(colors=param).save(buf, format="PNG", optimize=True)
+    return buf.getvalue(), "png", "image/png"
+
+def encode_image(raw, budget=0, fmt=MAIL_IMAGE_FORMAT):
+    """
+    依設定格式編碼單張圖，超出 budget (bytes) 時沿壓縮階梯往下直到符合或用盡
+    回傳 (bytes, 副檔名, MIME)；未安裝 Pillow 時一律回傳原檔
+    """
+    best = (raw, "png", "image/png")
+    if Image is None or (fmt == "png" and (not budget or len(raw) <= budget)):
+        return best
+    steps = [s for s in RECOMPRESS_STEPS if fmt != "webp" or s[0] == "webp"]
+    for fmt_step, param in steps:
+        out = recompress(raw, fmt_step, param)
+        if len(out[0]) < len(best[0]):
+            best = out
+        if not budget or len(best[0]) <= budget:
+            break
+    return best
+
+def build_attachments(img_data, budget_kb=MAIL_ATTACH_BUDGET_KB, fmt=MAIL_IMAGE_FORMAT):
+    """
+    讀取圖檔並組成 Resend inline 附件 (base64 字串，而非逐位元組的整數陣列)
+    回傳 (attachments, 原始總位元組, 編碼後總位元組)
+    """
+    found = []
+    for img in img_data:
+        if os.path.exists(img['path']):
+            found.append(img)
+        else:
+            print(f"⚠️ 圖表檔案不存在: {img['path']}")
+    per_image = budget_kb * 1024 // len(found) if budget_kb and found else 0
+
+    attachments, raw_total, out_total = [], 0, 0
+    for img in found:
+        try:
+            with open(img['path'], "rb") as f:
+                raw = f.read()
+            data, ext, mime = encode_image(raw, per_image, fmt)
+            content = base64.b64encode(data).decode("ascii")
+            attachments.append({
+                "content": content,
+                "filename": f"{img['id']}.{ext}",
+                "content_id": img['id'],
+                "content_type": mime,
+                "disposition": "inline"
+            })
+            raw_total += len(raw)
+            out_total += len(content)
+        except Exception as e:
+            print(f"⚠️ 處理圖表附件失敗 {img['id']}: {e}")
+    return attachments, raw_total, out_total
 
 class StockNotifier:
-    def __init__(self):
+    def __init__(self, dispatcher=None):
         # 從環境變數讀取金鑰與 ID
         self.tg_token = os.getenv("TELEGRAM_BOT_TOKEN")
         self.tg_chat_id = os.getenv("TELEGRAM_CHAT_ID")
         self.resend_api_key = os.getenv("RESEND_API_KEY")
+        # 指定派送器時報告改為背景寄送，send_stock_report 排入佇列即返回
+        self.dispatcher = dispatcher
         
         if self.resend_api_key:
             resend.api_key = self.resend_api_key
@@ -25,35 +331,18 @@ class StockNotifier:
         if not self.tg_token or not self.tg_chat_id:
             return False
         
-        # 取得簡短時間戳
-        ts = self.get_now_time_str().split(" ")[1]
-        full_message = f"{message}\n\n🕒 <i>Sent at {ts} (UTC+8)</i>"
-        
-        url = f"https://api.telegram.org/bot{self.tg_token}/sendMessage"
-        payload = {
-            "chat_id": self.tg_chat_id, 
-            "text": full_message, 
-            "parse_mode": "HTML"
-        }
-        try:
-            requests.post(url, json=payload, timeout=10)
-            return True
-        except Exception as e:
-            print(f"⚠️ Telegram 發送失敗: {e}")
+        err = send_with_retry({"type": "telegram", "payload": message})
+        if err is not None:
+            print(f"⚠️ Telegram 發送失敗: {err}")
             return False
+        return True
 
-    def send_stock_report(self, market_name, img_data, report_df, text_reports, stats=None):
-        """
-        🚀 專業版更新：整合智慧下載統計、六國專業平台跳轉
-        支援：將下載器 (Downloader) 的統計結果完美呈現於 HTML 報表頂端
-        """
-        # 🟢 Debug 訊息：方便在終端機確認 main.py 傳進來的數值
-        print(f"DEBUG: notifier 正在處理 {market_name} 報告 (Stats: {stats})")
-
-        if not self.resend_api_key:
-            print("⚠️ 缺少 Resend API Key，無法寄信。")
-            return False
+    def build_report_job(self, market_name, img_data, report_df, text_reports, stats=None):
+        """組出報告派送工作 (HTML、附件與 Telegram 簡報)，不做任何網路請求"""
+        with metrics.timer("html_build_seconds", market=market_name):
+            return self._build_report_job(market_name, img_data, report_df, text_reports, stats)
 
+    def _build_report_job(self, market_name, img_data, report_df, text_reports, stats):
         report_time = self.get_now_time_str()
         
         # --- 1. 處理下載統計數據 (防止 0 或 None 導致報表崩潰) ---
@@ -154,41 +443,47 @@ class StockNotifier:
         """
 
         # --- 5. 處理附件 (Inline Embedding) ---
-        attachments = []
-        for img in img_data:
-            try:
-                if os.path.exists(img['path']):
-                    with open(img['path'], "rb") as f:
-                        attachments.append({
-                            "content": list(f.read()),
-                            "filename": f"{img['id']}.png",
-                            "content_id": img['id'],
-                            "disposition": "inline"
-                        })
-                else:
-                    print(f"⚠️ 圖表檔案不存在: {img['path']}")
-            except Exception as e:
-                print(f"⚠️ 處理圖表附件失敗 {img['id']}: {e}")
-
-        # --- 6. 寄送 Resend 郵件 ---
-        try:
-            resend.Emails.send({
-                "from": "StockMonitor <onboarding@resend.dev>",
-                "to": "wallacehsieh366@gmail.com",
+        attachments, raw_total, att_total = build_attachments(img_data)
+        payload_kb = (att_total + len(html_content.encode("utf-8"))) / 1024
+        print(f"📦 {market_name} 郵件附件 {len(attachments)} 張：原檔 {raw_total / 1024:.0f} KB → 編碼後 {att_total / 1024:.0f} KB | 總酬載約 {payload_kb:.0f} KB")
+
+        # --- 6. 寄送 Resend 郵件，成功後發送 Telegram 簡報 ---
+        tg_msg = f"📊 <b>{market_name} 監控報表已送達</b>\n涵蓋率: {success_rate}\n處理樣本: {success_count} 檔"
+        job = {"label": market_name, "steps": [
+            {"type": "email", "payload": {
+                "from": MAIL_FROM,
+                "to": MAIL_TO,
                 "subject": f"🚀 {market_name} 全方位監控報告 - {report_time.split(' ')[0]}",
                 "html": html_content,
                 "attachments": attachments
-            })
-            print(f"✅ {market_name} 郵件報告已寄送！")
-            
-            # --- 7. 發送 Telegram 簡報 ---
-            tg_msg = f"📊 <b>{market_name} 監控報表已送達</b>\n涵蓋率: {success_rate}\n處理樣本: {success_count} 檔"
-            self.send_telegram(tg_msg)
-            
-            return True
-        except Exception as e:
-            print(f"❌ 寄送失敗: {e}")
+            }},
+            {"type": "telegram", "payload": tg_msg},
+        ]}
+        return job
+
+    def send_stock_report(self, market_name, img_data, report_df, text_reports, stats=None):
+        """
+        🚀 專業版更新：整合智慧下載統計、六國專業平台跳轉
+        支援：將下載器 (Downloader) 的統計結果完美呈現於 HTML 報表頂端
+        """
+        # 🟢 Debug 訊息：方便在終端機確認 main.py 傳進來的數值
+        print(f"DEBUG: notifier 正在處理 {market_name} 報告 (Stats: {stats})")
+
+        if not self.resend_api_key:
+            print("⚠️ 缺少 Resend API Key，無法寄信。")
             return False
 
+        job = self.build_report_job(market_name, img_data, report_df, text_reports, stats)
+
+        if self.dispatcher is not None:
+            self.dispatcher.submit(job)
+            print(f"📮 {market_name} 報告已排入背景派送佇列")
+            return True
+
+        ok, _ = deliver(job)
+        if ok:
+            print(f"✅ {market_name} 郵件報告已寄送！")
+        return ok
+
 
 
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+OHLC 面板快取：每個市場一組依日期對齊的 (標的 × 交易日) float32 矩陣
+    data/<market>/panel/close.npy, high.npy, low.npy  - 以 np.load(mmap_mode="r") 零複製開啟
+    data/<market>/panel/present.npy                    - 該檔該日是否有 K 棒 (CSV 中 OHLC 為 NaN 的列仍算一根)
+    data/<market>/panel/index.json                     - 標的索引、日期索引與同步時間
+每次同步只讀取上次同步後有變動的 dayK 檔尾，將新交易日附加為新欄位；
+多個程序可同時以唯讀 memmap 共用，不必各自持有一份資料。
+"""
+import os
+import json
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from dayk_io import read_tails, TAIL_ROWS, ADJUST_RTOL
+
+# ========== 面板設定 ==========
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PANEL_ENABLED = os.getenv("PANEL_CACHE", "1") != "0"
+# 面板保留的交易日數 (需大於最長回溯期 250 日)
+PANEL_DAYS = int(os.getenv("PANEL_DAYS", "320"))
+FIELDS = ("close", "high", "low")
+# K 棒存在遮罩：與價格分開記錄，價格為 NaN 不代表該日沒有 K 棒
+PRESENT = "present"
+INDEX_NAME = "index.json"
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+def enabled():
+    return PANEL_ENABLED
+
+def panel_dir(market):
+    return Path(BASE_DIR) / "data" / market / "panel"
+
+class Panel:
+    """唯讀面板：tickers[i] 對應矩陣第 i 列，dates[j] 對應第 j 欄，無 K 棒處 present 為 False、價格為 NaN"""
+    def __init__(self, market, tickers, dates, arrays, synced_at=0.0):
+        self.market = market
+        self.tickers = tickers
+        self.dates = dates
+        self.arrays = arrays
+        self.synced_at = synced_at
+        self.ticker_index = {t: i for i, t in enumerate(tickers)}
+
+    @property
+    def shape(self):
+        return (len(self.tickers), len(self.dates))
+
+    def __getitem__(self, field):
+        return self.arrays[field]
+
+    def frame(self, i):
+        """第 i 檔的 K 線 (略過無 K 棒的日期)，欄位同 dayK CSV"""
+        valid = np.asarray(self.arrays[PRESENT][i], dtype=bool)
+        return pd.DataFrame({"date": np.asarray(self.dates)[valid],
+                             **{f: self.arrays[f][i][valid] for f in FIELDS}})
+
+def open_panel(market, mmap_mode="r"):
+    """零複製開啟面板；不存在或正在寫入 (形狀不一致) 時回傳 None"""
+    d = panel_dir(market)
+    try:
+        with open(d / INDEX_NAME, "r", encoding="utf-8") as f:
+            idx = json.load(f)
+        # 舊版面板沒有 present.npy：視為不存在，下次同步整份重建
+        arrays = {f: np.load(d / f"{f}.npy", mmap_mode=mmap_mode) for f in FIELDS + (PRESENT,)}
+    except (OSError, ValueError):
+        return None
+    shape = (len(idx["tickers"]), len(idx["dates"]))
+    if any(a.shape != shape for a in arrays.values()):
+        return None
+    return Panel(market, idx["tickers"], idx["dates"], arrays, idx.get("synced_at", 0.0))
+
+def _save(market, tickers, dates, arrays, synced_at):
+    """先寫暫存檔再原子取代；索引最後寫入，讀取端以形狀比對偵測寫入中的狀態"""
+    d = panel_dir(market)
+    d.mkdir(parents=True, exist_ok=True)
+    for f in FIELDS + (PRESENT,):
+        tmp = d / f"{f}.tmp.npy"
+        np.save(tmp, np.ascontiguousarray(arrays[f], dtype=bool if f == PRESENT else np.float32))
+        os.replace(tmp, d / f"{f}.npy")
+    tmp = d / (INDEX_NAME + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"market": market, "synced_at": synced_at, "tickers": tickers, "dates": dates}, fh, ensure_ascii=False)
+    os.replace(tmp, d / INDEX_NAME)
+
+def _dedupe(dates, vals):
+    """同一日期重複時保留最後一筆"""
+    last = {d: j for j, d in enumerate(dates)}
+    return list(last), vals[list(last.values())]
+
+def _needs_reload(panel, i, bars, pos):
+    """
+    檔尾未涵蓋面板最後一筆，或重疊區間 (最後一根除外) 價格與面板不符 (除權息/分割後整檔重抓)，
+    需重新讀取完整視窗
+    """
+    close = panel["close"][i]
+    valid = np.flatnonzero(panel[PRESENT][i])
+    keys, vals = bars
+    if len(valid) == 0:
+        return True
+    last_date = panel.dates[valid[-1]]
+    if not keys or keys[0] > last_date:
+        return True
+    common = [(j, pos[d]) for j, d in enumerate(keys) if d in pos and d < last_date]
+    if not common:
+        return False
+    new = vals[[j for j, _ in common], 0]
+    old = close[[p for _, p in common]]
+    return not np.allclose(new, old, rtol=ADJUST_RTOL, equal_nan=True)
+
+def sync_panel(market, data_dir=None):
+    """
+    以 dayK CSV 更新面板並回傳 (唯讀 memmap)
+    - 新標的：讀取檔尾 PANEL_DAYS 根
+    - 既有標的：檔案在上次同步後有變動才讀取檔尾，新交易日附加為新欄位
+    - 已刪除的檔案自面板移除；超出 PANEL_DAYS 的舊欄位捨棄
+    """
+    data_dir = Path(data_dir) if data_dir else Path(BASE_DIR) / "data" / market / "dayK"
+    files = {f.stem: f for f in data_dir.glob("*.csv")}
+    if not files:
+        return None
+
+    started = time.time()
+    old = open_panel(market)
+    if old is None:
+        old = Panel(market, [], [], {**{f: np.empty((0, 0), np.float32) for f in FIELDS},
+                                     PRESENT: np.empty((0, 0), bool)})
+
+    old_pos = {d: j for j, d in enumerate(old.dates)}
+    new_stems = [s for s in files if s not in old.ticker_index]
+    changed = [s for s in files if s in old.ticker_index and files[s].stat().st_mtime > old.synced_at]
+
+    # 檔尾讀取交由程序池平行處理
+    updates = {}
+    for stem, res in zip(new_stems, read_tails([files[s] for s in new_stems], PANEL_DAYS)):
+        if res:
+            updates[stem] = _dedupe(*res)
+    reloads = []
+    for stem, res in zip(changed, read_tails([files[s] for s in changed], TAIL_ROWS)):
+        if not res:
+            continue
+        bars = _dedupe(*res)
+        if _needs_reload(old, old.ticker_index[stem], bars, old_pos):
+            reloads.append(stem)
+        else:
+            updates[stem] = bars
+    for stem, res in zip(reloads, read_tails([files[s] for s in reloads], PANEL_DAYS)):
+        if res:
+            updates[stem] = _dedupe(*res)
+    reloads = set(reloads)
+
+    if not updates and len(files) == len(old.tickers):
+        return old
+
+    tickers = [t for t in old.tickers if t in files] + sorted(s for s in updates if s not in old.ticker_index)
+    all_dates = set(old.dates)
+    for keys, _ in updates.values():
+        all_dates.update(keys)
+    dates = sorted(all_dates)[-PANEL_DAYS:]
+
+    # 既有資料整塊搬移 (依日期與標的位置對應)，不重新解析歷史
+    new_pos = {d: j for j, d in enumerate(dates)}
+    keep_cols = [j for j, d in enumerate(old.dates) if d in new_pos]
+    dst_cols = [new_pos[old.dates[j]] for j in keep_cols]
+    keep_rows = [old.ticker_index[t] for t in tickers if t in old.ticker_index]
+
+    arrays = {}
+    for f in FIELDS + (PRESENT,):
+        arr = (np.zeros((len(tickers), len(dates)), dtype=bool) if f == PRESENT
+               else np.full((len(tickers), len(dates)), np.nan, dtype=np.float32))
+        if keep_rows and keep_cols:
+            arr[np.ix_(range(len(keep_rows)), dst_cols)] = old[f][np.ix_(keep_rows, keep_cols)]
+        arrays[f] = arr
+
+    row_of = {t: i for i, t in enumerate(tickers)}
+    for stem, (keys, vals) in updates.items():
+        r = row_of[stem]
+        if stem in reloads:
+            for f in FIELDS:
+                arrays[f][r] = np.nan
+            arrays[PRESENT][r] = False
+        inside = [(j, new_pos[d]) for j, d in enumerate(keys) if d in new_pos]
+        src = [j for j, _ in inside]
+        cols = [c for _, c in inside]
+        for k, f in enumerate(FIELDS):
+            arrays[f][r, cols] = vals[src, k]
+        arrays[PRESENT][r, cols] = True
+
+    added = len(dates) - len(keep_cols)
+    _save(market, tickers, dates, arrays, started)
+    log(f"🧮 [{market}] 面板同步：{len(tickers)} 檔 × {len(dates)} 日 | 更新 {len(updates)} 檔 | 新增 {added} 日")
+    return open_panel(market)
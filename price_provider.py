@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+行情來源抽象層 (PRICE_PROVIDER=live | record | replay)
+- live：直接呼叫 yfinance 與各交易所清單網址 (預設)
+- record：照常連線，同時把 K 線、清單網址回應與最終標的清單寫入本機封存 (PROVIDER_ARCHIVE)
+- replay：完全離線，由封存重播；可注入延遲、錯誤率與連續 429，用來重現限流器/重試/併發的行為
+  設定 PROVIDER_URL 時改向本機 HTTP 替身 (python price_provider.py serve) 取資料，故障由替身端注入
+
+封存目錄結構：
+  history/<代號>.pkl      單檔完整 K 線 (yf.Ticker().history 格式)，重播時依 start/end/period 切片
+  http/<url 雜湊>.json     清單網址回應 (狀態碼、標頭、內容)
+  universe/<市場>.json     load_universe 的最終清單 (CN/JP/KR 清單來自套件，無法以網址重播)
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import signal
+import argparse
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+import requests
+from requests.structures import CaseInsensitiveDict
+from rate_limiter import is_throttle_error
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PRICE_PROVIDER = os.getenv("PRICE_PROVIDER", "live").lower()
+PROVIDER_ARCHIVE = os.getenv("PROVIDER_ARCHIVE", os.path.join(BASE_DIR, "data", "provider_archive"))
+# 重播時改由 HTTP 替身取資料 (例如 http://127.0.0.1:8765)
+PROVIDER_URL = os.getenv("PROVIDER_URL", "")
+# 批次中缺資料的標的達此比例才探測是否遭限流 (零星缺漏多為下市/無報價，交由逐檔補抓判斷)
+THROTTLE_PROBE_RATIO = 0.8
+
+# ========== 故障注入 (重播) ==========
+# 每次請求的延遲 (毫秒) 與隨機抖動
+REPLAY_LATENCY_MS = float(os.getenv("REPLAY_LATENCY_MS", "0"))
+REPLAY_JITTER_MS = float(os.getenv("REPLAY_JITTER_MS", "0"))
+# 單次請求失敗 (連線錯誤 / 5xx) 的機率
+REPLAY_ERROR_RATE = float(os.getenv("REPLAY_ERROR_RATE", "0"))
+# 每次請求觸發一段 429 的機率，觸發後連續 REPLAY_429_BURST 次請求皆被限流
+REPLAY_429_RATE = float(os.getenv("REPLAY_429_RATE", "0"))
+REPLAY_429_BURST = int(os.getenv("REPLAY_429_BURST", "20"))
+REPLAY_SEED = os.getenv("REPLAY_SEED")
+SERVE_PORT = 8765
+
+PERIOD_UNITS = {"d": "days", "wk": "weeks", "mo": "months", "y": "years"}
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+class ReplayRateLimitError(Exception):
+    """重播注入的限流 (訊息與 yfinance 相同，限流器會判定為 throttled)"""
+    def __init__(self, message="Too Many Requests. Rate limited. Try after a while."):
+        super().__init__(message)
+
+class ReplayError(ConnectionError):
+    """重播注入的一般連線錯誤"""
+
+# ========== 封存格式 ==========
+
+def _safe_name(symbol):
+    return "".join(c if c.isalnum() or c in ".-_^=" else "_" for c in symbol)
+
+def url_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+def _atomic_write(path, write):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+def slice_history(df, start=None, end=None, period=None, **_):
+    """依 yfinance 參數切出重播範圍 (start 含、end 不含；period 如 5d / 1mo / 2y / max)"""
+    if df is None or df.empty:
+        return pd.DataFrame()
+    naive = df.index.tz_localize(None) if getattr(df.index, "tz", None) is not None else df.index
+    keep = np.ones(len(df), dtype=bool)
+    if start:
+        keep &= naive >= pd.Timestamp(start)
+    if end:
+        keep &= naive < pd.Timestamp(end)
+    if not start and period and period != "max":
+        num = "".join(c for c in period if c.isdigit())
+        unit = PERIOD_UNITS.get(period[len(num):])
+        if num and unit:
+            keep &= naive > naive.max() - pd.DateOffset(**{unit: int(num)})
+    return df[keep]
+
+def to_download_frame(frames):
+    """{代號: history} 組成 yf.download(group_by='ticker') 的寬表 (交易日聯集為索引)"""
+    frames = {sym: df for sym, df in frames.items() if df is not None and not df.empty}
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, axis=1, sort=True)
+
+def frame_to_json(df):
+    """K 線轉為 JSON (索引以 UTC 奈秒計，另存時區名稱)"""
+    tz = getattr(df.index, "tz", None)
+    idx = df.index.as_unit("ns") if hasattr(df.index, "as_unit") else df.index
+    return {"tz": str(tz) if tz is not None else None,
+            "index": idx.asi8.tolist() if len(df) else [],
+            "columns": list(df.columns),
+            "data": df.to_numpy(dtype=np.float64).tolist()}
+
+def frame_from_json(obj):
+    idx = pd.to_datetime(obj["index"], unit="ns", utc=obj["tz"] is not None)
+    if obj["tz"] is not None:
+        idx = idx.tz_convert(obj["tz"])
+    df = pd.DataFrame(obj["data"], index=pd.DatetimeIndex(idx, name="Date"), columns=obj["columns"])
+    if "Volume" in df.columns:
+        df["Volume"] = df["Volume"].fillna(0).astype("int64")
+    return df
+
+class Archive:
+    """本機封存的讀寫 (同一代號的多次錄製會合併，新資料覆蓋舊資料)"""
+    def __init__(self, root=PROVIDER_ARCHIVE):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    def history_path(self, symbol):
+        return self.root / "history" / f"{_safe_name(symbol)}.pkl"
+
+    def load_history(self, symbol):
+        path = self.history_path(symbol)
+        return pd.read_pickle(path) if path.exists() else None
+
+    def save_history(self, symbol, df):
+        if df is None or df.empty:
+            return
+        with self._lock:
+            old = self.load_history(symbol)
+            if old is not None:
+                df = pd.concat([old[~old.index.isin(df.index)], df]).sort_index()
+            _atomic_write(self.history_path(symbol), lambda p: df.to_pickle(p))
+
+    def load_http(self, url):
+        path = self.root / "http" / f"{url_key(url)}.json"
+        if not path.exists():
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_http(self, url, resp):
+        entry = {"url": url, "status": resp.status_code, "headers": dict(resp.headers),
+                 "content": base64.b64encode(resp.content).decode("ascii")}
+        # 內容已解壓，不可再宣告壓縮編碼
+        entry["headers"].pop("Content-Encoding", None)
+        entry["headers"].pop("Transfer-Encoding", None)
+        def write(p):
+            with open(p, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+        _atomic_write(self.root / "http" / f"{url_key(url)}.json", write)
+
+    def load_universe(self, market):
+        path = self.root / "universe" / f"{market}.json"
+        if not path.exists():
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["items"]
+
+    def save_universe(self, market, items):
+        def write(p):
+            with open(p, "w", encoding="utf-8") as f:
+                json.dump({"market": market, "recorded_at": time.time(), "items": items}, f, ensure_ascii=False)
+        _atomic_write(self.root / "universe" / f"{market}.json", write)
+
+    def info(self):
+        count = lambda sub, pat: len(list((self.root / sub).glob(pat))) if (self.root / sub).exists() else 0
+        return {"root": str(self.root), "history": count("history", "*.pkl"),
+                "http": count("http", "*.json"), "universe": count("universe", "*.json")}
+
+def http_response(entry, url):
+    """由封存紀錄組出 requests.Response (呼叫端照常使用 .content / .text / .headers)"""
+    resp = requests.Response()
+    resp.url = url
+    if entry is None:
+        resp.status_code, resp._content = 404, b""
+        return resp
+    resp.status_code = int(entry["status"])
+    resp.headers = CaseInsensitiveDict(entry.get("headers") or {})
+    resp._content = base64.b64decode(entry["content"])
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    return resp
+
+# ========== 故障注入 ==========
+
+class FaultInjector:
+    """
+    每次請求呼叫 next_fault()：先套用延遲，再決定 None / "throttled" / "error"
+    429 以段落出現：觸發後連續 burst 次請求皆被限流 (跨執行緒共用，模擬整個主機的限流)
+    """
+    def __init__(self, latency_ms=REPLAY_LATENCY_MS, jitter_ms=REPLAY_JITTER_MS, error_rate=REPLAY_ERROR_RATE,
+                 burst_rate=REPLAY_429_RATE, burst_len=REPLAY_429_BURST, seed=REPLAY_SEED):
+        self.latency = max(0.0, latency_ms) / 1000
+        self.jitter = max(0.0, jitter_ms) / 1000
+        self.error_rate, self.burst_rate, self.burst_len = error_rate, burst_rate, max(1, int(burst_len))
+        self._rng = random.Random(None if seed in (None, "") else int(seed))
+        self._lock = threading.Lock()
+        self._burst_left = 0
+        self.counts = {"requests": 0, "throttled": 0, "error": 0}
+
+    def next_fault(self):
+        with self._lock:
+            self.counts["requests"] += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            if self._burst_left == 0 and self.burst_rate and self._rng.random() < self.burst_rate:
+                self._burst_left = self.burst_len
+            if self._burst_left > 0:
+                self._burst_left -= 1
+                fault = "throttled"
+            elif self.error_rate and self._rng.random() < self.error_rate:
+                fault = "error"
+            else:
+                fault = None
+            if fault:
+                self.counts[fault] += 1
+        if delay:
+            time.sleep(delay)
+        return fault
+
+    def summary(self):
+        c = self.counts
+        return f"🎭 重播請求 {c['requests']} 次 | 注入 429 {c['throttled']} 次 | 注入錯誤 {c['error']} 次"
+
+# ========== 行情來源 ==========
+
+def missing_symbols(raw, symbols):
+    """yf.download 寬表中沒有任何收盤價的標的"""
+    if raw is None or raw.empty:
+        return list(symbols)
+    if not isinstance(raw.columns, pd.MultiIndex):
+        return [] if 'Close' in raw.columns and raw['Close'].notna().any() else list(symbols[:1])
+    present = set(raw.columns.get_level_values(0))
+    return [s for s in symbols
+            if s not in present or 'Close' not in raw[s].columns or not raw[s]['Close'].notna().any()]
+
+class LiveProvider:
+    """直接連線 (yfinance 延遲到第一次使用才匯入)"""
+    name = "live"
+
+    def history(self, symbol, **kwargs):
+        import yfinance as yf
+        return yf.Ticker(symbol).history(**kwargs)
+
+    def download(self, symbols, **kwargs):
+        """
+        回傳 (yf.download 寬表, 是否遭限流)
+        yf.download 會吞掉個別標的的例外，而其錯誤紀錄 (yf.shared._ERRORS) 為全程序共用、會被並行的批次覆寫，
+        因此只看本次結果：整批 (或絕大多數) 無資料才像是被限流，此時以其中一檔的單檔 history() 探測，
+        由探測的例外判斷；零星缺漏不探測，由逐檔補抓請求本身的例外分類
+        """
+        import yfinance as yf
+        raw = yf.download(symbols, group_by="ticker", actions=True, ignore_tz=False, progress=False, **kwargs)
+        missing = missing_symbols(raw, symbols)
+        if not missing or len(missing) < THROTTLE_PROBE_RATIO * len(symbols):
+            return raw, False
+        try:
+            yf.Ticker(missing[0]).history(period="5d", timeout=kwargs.get("timeout", 10), raise_errors=True)
+        except Exception as e:
+            return raw, is_throttle_error(e)
+        return raw, False
+
+    def get(self, url, session, **kwargs):
+        return session.get(url, **kwargs)
+
+    def universe(self, market):
+        """重播時回傳封存的標的清單；其他模式回傳 None (照常抓取)"""
+        return None
+
+    def record_universe(self, market, items):
+        pass
+
+    def summary(self):
+        return None
+
+class RecordingProvider(LiveProvider):
+    """照常連線並把成功的回應寫入封存"""
+    name = "record"
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.recorded = 0
+
+    def history(self, symbol, **kwargs):
+        df = super().history(symbol, **kwargs)
+        self.archive.save_history(symbol, df)
+        self.recorded += 1
+        return df
+
+    def download(self, symbols, **kwargs):
+        raw, throttled = super().download(symbols, **kwargs)
+        if raw is not None and not raw.empty:
+            multi = isinstance(raw.columns, pd.MultiIndex)
+            for sym in (raw.columns.get_level_values(0).unique() if multi else symbols[:1]):
+                df = raw[sym] if multi else raw
+                if 'Close' in df.columns:
+                    self.archive.save_history(sym, df[df['Close'].notna()])
+                    self.recorded += 1
+        return raw, throttled
+
+    def get(self, url, session, **kwargs):
+        resp = super().get(url, session, **kwargs)
+        if resp.status_code == 200:
+            self.archive.save_http(url, resp)
+        return resp
+
+    def record_universe(self, market, items):
+        self.archive.save_universe(market, items)
+
+    def summary(self):
+        return f"📼 已錄製 {self.recorded} 筆 K 線至 {self.archive.root}"
+
+class ReplayProvider(LiveProvider):
+    """由本機封存離線重播，並依 FaultInjector 注入延遲、錯誤與 429"""
+    name = "replay"
+
+    def __init__(self, archive, faults=None):
+        self.archive = archive
+        self.faults = faults or FaultInjector()
+
+    def _fault(self):
+        fault = self.faults.next_fault()
+        if fault == "throttled":
+            raise ReplayRateLimitError()
+        if fault == "error":
+            raise ReplayError("Injected replay connection error")
+
+    def history(self, symbol, **kwargs):
+        self._fault()
+        return slice_history(self.archive.load_history(symbol), **kwargs)
+
+    def download(self, symbols, **kwargs):
+        # yf.download 不拋出例外：限流時整批無資料，個別錯誤只讓該檔缺漏
+        fault = self.faults.next_fault()
+        if fault == "throttled":
+            return pd.DataFrame(), True
+        frames = {}
+        for sym in symbols:
+            if fault == "error" and self.faults._rng.random() < 0.5:
+                continue
+            frames[sym] = slice_history(self.archive.load_history(sym), **kwargs)
+        return to_download_frame(frames), False
+
+    def get(self, url, session, **kwargs):
+        fault = self.faults.next_fault()
+        if fault == "error":
+            raise ReplayError("Injected replay connection error")
+        if fault == "throttled":
+            return http_response({"status": 429, "headers": {"Retry-After": "1"}, "content": ""}, url)
+        return http_response(self.archive.load_http(url), url)
+
+    def universe(self, market):
+        return self.archive.load_universe(market)
+
+    def summary(self):
+        return self.faults.summary()
+
+class RemoteReplayProvider(LiveProvider):
+    """向 HTTP 替身取資料 (故障由替身注入；429 / 5xx 依實際狀態碼處理)"""
+    name = "replay-remote"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=64))
+
+    def _call(self, path, **params):
+        resp = self.session.get(f"{self.base_url}{path}", params=params, timeout=60)
+        if resp.status_code == 429:
+            raise ReplayRateLimitError()
+        if resp.status_code >= 500:
+            raise ReplayError(f"Replay server error {resp.status_code}")
+        resp.raise_for_status()
+        return resp
+
+    def history(self, symbol, **kwargs):
+        params = {k: kwargs[k] for k in ("start", "end", "period") if kwargs.get(k)}
+        return frame_from_json(self._call("/history", symbol=symbol, **params).json())
+
+    def download(self, symbols, **kwargs):
+        params = {k: kwargs[k] for k in ("start", "end", "period") if kwargs.get(k)}
+        try:
+            frames = self._call("/download", symbols=",".join(symbols), **params).json()
+        except ReplayRateLimitError:
+            return pd.DataFrame(), True
+        except ReplayError:
+            return pd.DataFrame(), False
+        return to_download_frame({sym: frame_from_json(obj) for sym, obj in frames.items()}), False
+
+    def get(self, url, session, **kwargs):
+        resp = self.session.get(f"{self.base_url}/http", params={"url": url}, timeout=60)
+        resp.url = url
+        return resp
+
+    def universe(self, market):
+        resp = self.session.get(f"{self.base_url}/universe", params={"market": market}, timeout=60)
+        return resp.json()["items"] if resp.status_code == 200 else None
+
+    def summary(self):
+        return f"🎭 重播來源：{self.base_url}"
+
+_PROVIDER = None
+_PROVIDER_LOCK = threading.Lock()
+
+def get_provider():
+    """依 PRICE_PROVIDER 建立本程序共用的行情來源"""
+    global _PROVIDER
+    with _PROVIDER_LOCK:
+        if _PROVIDER is None:
+            if PRICE_PROVIDER == "record":
+                _PROVIDER = RecordingProvider(Archive())
+            elif PRICE_PROVIDER == "replay":
+                _PROVIDER = RemoteReplayProvider(PROVIDER_URL) if PROVIDER_URL else ReplayProvider(Archive())
+            else:
+                _PROVIDER = LiveProvider()
+            if _PROVIDER.name != "live":
+                log(f"🎞️ 行情來源：{_PROVIDER.name} ({PROVIDER_URL or PROVIDER_ARCHIVE})")
+        return _PROVIDER
+
+def set_provider(provider):
+    """替換行情來源 (基準測試/負載測試用)；回傳原本的來源"""
+    global _PROVIDER
+    with _PROVIDER_LOCK:
+        old, _PROVIDER = _PROVIDER, provider
+    return old
+
+# ========== HTTP 替身 ==========
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    archive = None
+    faults = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None, content_type="application/json"):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            if k.lower() not in ("content-length", "connection"):
+                self.send_header(k, v)
+        if not headers or not any(k.lower() == "content-type" for k in headers):
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj):
+        self._send(200, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/universe":
+            items = self.archive.load_universe(q.get("market", ""))
+            return self._json({"items": items}) if items is not None else self._send(404)
+
+        fault = self.faults.next_fault()
+        if fault == "throttled":
+            return self._send(429, b'{"error": "Too Many Requests"}', {"Retry-After": "1"})
+        if fault == "error":
+            return self._send(503, b'{"error": "injected"}')
+
+        span = {k: q[k] for k in ("start", "end", "period") if q.get(k)}
+        if url.path == "/history":
+            return self._json(frame_to_json(slice_history(self.archive.load_history(q.get("symbol", "")), **span)))
+        if url.path == "/download":
+            frames = {}
+            for sym in filter(None, q.get("symbols", "").split(",")):
+                df = slice_history(self.archive.load_history(sym), **span)
+                if not df.empty:
+                    frames[sym] = frame_to_json(df)
+            return self._json(frames)
+        if url.path == "/http":
+            entry = self.archive.load_http(q.get("url", ""))
+            if entry is None:
+                return self._send(404)
+            return self._send(int(entry["status"]), base64.b64decode(entry["content"]), entry.get("headers"))
+        self._send(404)
+
+def serve(archive, faults, port=SERVE_PORT, host="127.0.0.1"):
+    """啟動 HTTP 替身 (多執行緒)，直到 Ctrl+C"""
+    handler = type("Handler", (ReplayHandler,), {"archive": archive, "faults": faults})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    # 背景執行時以 SIGTERM 結束也要印出注入統計
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    log(f"🎭 重播替身 http://{host}:{server.server_port} | 封存 {archive.root} | {archive.info()}")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        log(faults.summary())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record/replay price provider")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_serve = sub.add_parser("serve", help="以 HTTP 替身提供封存資料")
+    p_serve.add_argument('--port', type=int, default=SERVE_PORT)
+    p_serve.add_argument('--host', type=str, default="127.0.0.1")
+    p_serve.add_argument('--latency-ms', type=float, default=REPLAY_LATENCY_MS)
+    p_serve.add_argument('--jitter-ms', type=float, default=REPLAY_JITTER_MS)
+    p_serve.add_argument('--error-rate', type=float, default=REPLAY_ERROR_RATE)
+    p_serve.add_argument('--burst-rate', type=float, default=REPLAY_429_RATE, help='每次請求觸發一段 429 的機率')
+    p_serve.add_argument('--burst-len', type=int, default=REPLAY_429_BURST, help='每段 429 持續的請求數')
+    p_serve.add_argument('--seed', type=str, default=REPLAY_SEED)
+    for p in (p_serve, sub.add_parser("info", help="顯示封存內容統計")):
+        p.add_argument('--archive', type=str, default=PROVIDER_ARCHIVE)
+    args = parser.parse_args(argv)
+
+    archive = Archive(args.archive)
+    if args.cmd == "info":
+        print(json.dumps(archive.info(), ensure_ascii=False, indent=1))
+        return 0
+    serve(archive, FaultInjector(args.latency_ms, args.jitter_ms, args.error_rate,
+                                 args.burst_rate, args.burst_len, args.seed), args.port, args.host)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+欄式價格倉儲 (選用)：每個市場的 OHLCV 依年份分割存成少數幾個壓縮 Parquet 檔
+    data/<market>/prices/year=2025.parquet
+啟用方式：PRICE_STORE=parquet (需安裝 pyarrow)；首次啟用前先執行遷移：
+    python price_store.py --market us-share
+dayK CSV 仍是增量合併的工作檔，下載器寫入 CSV 後同步暫存到倉儲，結束時整批寫出；
+分析器在倉儲存在時改由此讀取，不再逐檔解析 CSV。
+"""
+import os
+import time
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# ========== 倉儲設定 ==========
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PRICE_BACKEND = os.getenv("PRICE_STORE", "csv").lower()
+STORE_SUBDIR = "prices"
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+COMPRESSION = "zstd"
+# 暫存列數超過此值即先寫出一次，避免大市場整批留在記憶體
+STAGE_MAX_ROWS = 2_000_000
+# 由 CSV 完整建立 (migrate) 後寫入的標記；沒有標記的倉儲只含增量暫存，分析不可採用
+COMPLETE_MARKER = ".complete"
+# 分析只需最近 251 根 K 棒，讀取時只載入涵蓋範圍內的年份
+ANALYSIS_LOOKBACK_DAYS = 400
+MARKETS = ["tw-share", "us-share", "cn-share", "kr-share"]
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+_WARNED = []
+
+def enabled():
+    """PRICE_STORE=parquet 且 pyarrow 可用時啟用；缺套件時提示一次並退回 CSV"""
+    if PRICE_BACKEND != "parquet":
+        return False
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        if not _WARNED:
+            _WARNED.append(True)
+            log("⚠️ PRICE_STORE=parquet 但未安裝 pyarrow，改用 CSV")
+        return False
+
+def normalize(df, stem):
+    """轉為倉儲格式：stem + 日期 (datetime64) + 具型別的 OHLCV"""
+    df = df.copy()
+    df.columns = [c.lower() for c in df.columns]
+    out = pd.DataFrame({
+        'stem': stem,
+        'date': pd.to_datetime(df['date'].astype(str).str[:10]),
+    })
+    for col in PRICE_COLUMNS:
+        vals = pd.to_numeric(df[col], errors='coerce') if col in df.columns else pd.Series(float('nan'), index=df.index)
+        out[col] = vals.fillna(0).astype('int64') if col == 'volume' else vals.astype('float64')
+    return out
+
+class PriceStore:
+    """單一市場的 Parquet 倉儲，暫存區可由多個下載執行緒同時寫入"""
+    def __init__(self, market):
+        self.market = market
+        self.dir = Path(BASE_DIR) / "data" / market / STORE_SUBDIR
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._staged = {}  # stem -> (replace, frame)
+        self._rows = 0
+
+    def partitions(self):
+        """{year: path}"""
+        if not self.dir.exists():
+            return {}
+        return {int(p.stem.split("=", 1)[1]): p for p in self.dir.glob("year=*.parquet")}
+
+    def exists(self):
+        return bool(self.partitions())
+
+    def complete(self):
+        """倉儲是否由 CSV 完整建立過 (僅有下載增量的倉儲缺少既有標的的歷史)"""
+        return (self.dir / COMPLETE_MARKER).exists() and self.exists()
+
+    def mark_complete(self, done=True):
+        marker = self.dir / COMPLETE_MARKER
+        if done:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            marker.write_text(pd.Timestamp.now().isoformat(), encoding="utf-8")
+        else:
+            marker.unlink(missing_ok=True)
+
+    def stage(self, stem, df, replace=False):
+        """
+        暫存單檔 K 線 (flush() 時才寫入磁碟)
+        replace=True: 完整下載，取代該檔所有舊資料；否則以 (stem, date) 覆蓋/追加
+        """
+        if df is None or df.empty or 'date' not in [c.lower() for c in df.columns]:
+            return
+        frame = normalize(df, stem)
+        with self._lock:
+            prev = self._staged.get(stem)
+            if prev and not replace:
+                self._staged[stem] = (prev[0], pd.concat([prev[1], frame], ignore_index=True))
+            else:
+                self._staged[stem] = (replace, frame)
+            self._rows += len(frame)
+            full = self._rows >= STAGE_MAX_ROWS
+        if full:
+            self.flush()
+
+    def flush(self):
+        """將暫存資料合併進年份分割檔，回傳寫入的列數"""
+        with self._flush_lock:
+            with self._lock:
+                staged, self._staged, self._rows = self._staged, {}, 0
+            if not staged:
+                return 0
+
+            new = pd.concat([f for _, f in staged.values()], ignore_index=True)
+            replaced = [s for s, (rep, _) in staged.items() if rep]
+            parts = self.partitions()
+            years = set(new['date'].dt.year.unique())
+            if replaced:
+                # 完整下載的標的需從所有年份移除舊資料
+                years |= set(parts)
+
+            self.dir.mkdir(parents=True, exist_ok=True)
+            for year in sorted(years):
+                frames = []
+                if year in parts:
+                    old = pd.read_parquet(parts[year])
+                    if replaced:
+                        old = old[~old['stem'].isin(replaced)]
+                    frames.append(old)
+                frames.append(new[new['date'].dt.year == year])
+                out = (pd.concat(frames, ignore_index=True)
+                       .drop_duplicates(['stem', 'date'], keep='last')
+                       .sort_values(['stem', 'date'], kind='stable')
+                       .reset_index(drop=True))
+                self._write(out, self.dir / f"year={year}.parquet")
+            return len(new)
+
+    def _write(self, df, path):
+        tmp = path.with_suffix(".tmp")
+        if df.empty:
+            path.unlink(missing_ok=True)
+            return
+        df = df.astype({'stem': 'category'})
+        df.to_parquet(tmp, index=False, compression=COMPRESSION)
+        os.replace(tmp, path)
+
+    def load(self, since=None, columns=None):
+        """
+        讀取市場 K 線 (長表：stem, date, OHLCV)，依 stem、日期排序
+        since: 只載入此日期之後的 K 棒 (以年份分割檔略過舊年份)
+        """
+        parts = self.partitions()
+        cols = ['stem', 'date'] + list(columns or PRICE_COLUMNS)
+        since = pd.Timestamp(since) if since is not None else None
+        frames = []
+        for year in sorted(parts):
+            if since is not None and year < since.year:
+                continue
+            filters = [('date', '>=', since)] if since is not None else None
+            frames.append(pd.read_parquet(parts[year], columns=cols, filters=filters))
+        if not frames:
+            return pd.DataFrame(columns=cols)
+        df = pd.concat(frames, ignore_index=True)
+        df['stem'] = df['stem'].astype(str)
+        return df.sort_values(['stem', 'date'], kind='stable').reset_index(drop=True)
+
+_STORES = {}
+_WARNED_INCOMPLETE = []
+_STORES_LOCK = threading.Lock()
+
+def get_store(market):
+    with _STORES_LOCK:
+        if market not in _STORES:
+            _STORES[market] = PriceStore(market)
+        return _STORES[market]
+
+def stage_csv_write(path, df, replace):
+    """dayK CSV 寫入後的同步掛鉤：由路徑 data/<market>/dayK/<stem>.csv 推得市場與檔名"""
+    if not enabled():
+        return
+    p = Path(path)
+    get_store(p.parent.parent.name).stage(p.stem, df, replace=replace)
+
+def flush(market, rebuild=False, complete=False):
+    """
+    下載結束時呼叫：寫出暫存資料
+    rebuild：續跑中斷的下載時，中斷前的暫存已隨程序遺失，改由 CSV 整個重建
+    complete：暫存內容即為所有標的的完整 K 線 (例如基準測試的合成資料)，寫出後標記為完整建立
+    """
+    if not enabled():
+        return
+    if rebuild:
+        migrate(market)
+        return
+    store = get_store(market)
+    n = store.flush()
+    if complete:
+        store.mark_complete()
+    if n:
+        log(f"🗄️ [{market}] 倉儲寫入 {n} 列")
+
+def load_for_analysis(market):
+    """分析器讀取入口：倉儲未啟用、尚無資料或未完整建立時回傳 None，由呼叫端改讀 CSV"""
+    if not enabled():
+        return None
+    store = get_store(market)
+    if not store.exists():
+        return None
+    if not store.complete():
+        if market not in _WARNED_INCOMPLETE:
+            _WARNED_INCOMPLETE.append(market)
+            log(f"⚠️ [{market}] 倉儲尚未由 CSV 完整建立 (請執行 python price_store.py --market {market})，改讀 CSV")
+        return None
+    since = pd.Timestamp.today().normalize() - pd.Timedelta(days=ANALYSIS_LOOKBACK_DAYS)
+    return store.load(since=since, columns=['high', 'low', 'close'])
+
+def migrate(market, workers=8):
+    """由 data/<market>/dayK 下的 CSV 重建倉儲"""
+    data_dir = Path(BASE_DIR) / "data" / market / "dayK"
+    files = sorted(data_dir.glob("*.csv"))
+    if not files:
+        log(f"⚠️ [{market}] 找不到 CSV，略過")
+        return 0
+    store = get_store(market)
+    t0 = time.time()
+    # 重建前先移除舊分割檔與完成標記，避免殘留已不存在的標的；中途失敗時分析改讀 CSV
+    store.mark_complete(False)
+    for p in store.partitions().values():
+        p.unlink()
+
+    def load(f):
+        try:
+            store.stage(f.stem, pd.read_csv(f, encoding="utf-8-sig"), replace=True)
+            return True
+        except Exception:
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        ok = sum(pool.map(load, files))
+    rows = store.flush()
+    store.mark_complete()
+    size = sum(p.stat().st_size for p in store.partitions().values())
+    log(f"✅ [{market}] 遷移 {ok}/{len(files)} 檔，共 {rows} 列，{size / 1e6:.1f} MB，耗時 {time.time() - t0:.1f} 秒")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="將 dayK CSV 遷移至 Parquet 倉儲")
+    parser.add_argument('--market', type=str, default='all', help='市場 ID 或 all')
+    parser.add_argument('--workers', type=int, default=8, help='讀取 CSV 的執行緒數')
+    args = parser.parse_args()
+    for m in (MARKETS if args.market == 'all' else [args.market]):
+        migrate(m, args.workers)
+
+if __name__ == "__main__":
+    main()
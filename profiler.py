@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+效能剖析模式 (python main.py --profile [目錄])
+- 管線每個階段以 cProfile 記錄 CPU 熱點、tracemalloc 記錄配置來源，並以背景執行緒取樣 RSS
+- 每個市場/階段寫出：
+    <市場>_<階段>.pstats       python -m pstats / snakeviz 可直接開啟
+    <市場>_<階段>_cpu.txt      累積耗時與自身耗時前幾名的函式
+    <市場>_<階段>_alloc.txt    階段結束時仍存活的配置來源，與記憶體高峰當下的配置來源
+- summary_<標籤>.json 彙整各階段耗時、CPU、tracemalloc 峰值與 RSS 峰值/成長
+- cProfile 只看得到本程序：3.12 以前另對階段內新建的執行緒各掛一個剖析器再合併；
+  繪圖工作程序不在剖析範圍內，要看 savefig 的熱點請以 CHART_WORKERS=1 在本程序繪製
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# 設定即啟用；平行模式的子行程經由環境變數繼承
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+# tracemalloc 保留的堆疊層數 (越多越慢，1 即可定位到程式行)
+TRACE_FRAMES = int(os.getenv("PROFILE_TRACE_FRAMES", "1"))
+# 報表列出的函式 / 程式行數
+TOP_N = int(os.getenv("PROFILE_TOP", "40"))
+# RSS 取樣間隔 (秒)
+RSS_INTERVAL = float(os.getenv("PROFILE_RSS_INTERVAL", "0.05"))
+# 追蹤記憶體比上次高峰快照多出此比例 (且超過下限) 才重拍快照，限制快照次數
+PEAK_STEP = 1.15
+PEAK_FLOOR_MB = 32
+# 3.12 起 cProfile 改用 sys.monitoring，單一剖析器即涵蓋所有執行緒
+PER_THREAD = sys.version_info < (3, 12)
+# 剖析器自身與匯入機制的配置不列入報表
+TRACE_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+RESULTS = []
+_active = threading.Lock()
+
+def log(msg: str):
+    print(f"{datetime.now():%H:%M:%S}: {msg}")
+
+def current_rss_mb():
+    """本程序目前的 RSS (MB)；無 /proc 時退回 getrusage 的歷史峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return max_rss_mb()
+
+def max_rss_mb(who="self"):
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    # Linux 以 KB 計、macOS 以 bytes 計
+    return usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+class StageMeter:
+    """計時並以背景執行緒取樣 RSS，記錄區段內的峰值與成長量"""
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.seconds = 0.0
+        self.peak_mb = self.start_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._t0
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return False
+
+    def record(self, seconds=None):
+        return {"seconds": round(self.seconds if seconds is None else seconds, 4),
+                "peak_rss_mb": round(self.peak_mb, 1),
+                "rss_growth_mb": round(self.peak_mb - self.start_mb, 1)}
+
+class PeakTracer(StageMeter):
+    """RSS 取樣之外，追蹤記憶體創新高時拍下 tracemalloc 快照，事後可看高峰當下是誰佔著記憶體"""
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(interval)
+        self.peak_snapshot = None
+        self._snap_at = PEAK_FLOOR_MB * 2**20
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+            traced = tracemalloc.get_traced_memory()[0]
+            if traced >= self._snap_at:
+                self.peak_snapshot = tracemalloc.take_snapshot()
+                self._snap_at = traced * PEAK_STEP
+
+def enable(out_dir):
+    """啟用剖析模式並建立輸出目錄 (寫入環境變數供子行程沿用)"""
+    global PROFILE_DIR
+    PROFILE_DIR = os.path.abspath(out_dir)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    os.environ["PROFILE_DIR"] = PROFILE_DIR
+    return PROFILE_DIR
+
+def reset():
+    RESULTS.clear()
+
+def _thread_profiling(profilers):
+    """3.12 以前 cProfile 只剖析呼叫 enable() 的執行緒：對之後新建的執行緒各啟用一個剖析器"""
+    def hook(*_):
+        sys.setprofile(None)
+        prof = cProfile.Profile()
+        profilers.append(prof)
+        prof.enable()
+    return hook
+
+def _write_cpu(stats, path, title):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {title}\n\n## 依累積耗時 (cumulative)\n")
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(TOP_N)
+        f.write("\n## 依自身耗時 (tottime)\n")
+        stats.sort_stats("tottime").print_stats(TOP_N)
+
+def _write_alloc(path, title, end_stats, peak_snapshot):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {title}\n\n## 階段結束時仍存活的配置 (依程式行)\n")
+        for stat in end_stats[:TOP_N]:
+            f.write(f"{stat}\n")
+        if peak_snapshot is not None:
+            f.write("\n## 記憶體高峰當下的配置 (依程式行)\n")
+            for stat in peak_snapshot.filter_traces(TRACE_FILTERS).statistics("lineno")[:TOP_N]:
+                f.write(f"{stat}\n")
+
+@contextmanager
+def stage(name, market):
+    """剖析單一管線階段；未啟用或已有階段在剖析中 (例如其他執行緒) 時不做任何事"""
+    if not PROFILE_DIR or not _active.acquire(blocking=False):
+        yield
+        return
+    started_trace = not tracemalloc.is_tracing()
+    try:
+        if started_trace:
+            tracemalloc.start(TRACE_FRAMES)
+        else:
+            tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+        meter = PeakTracer()
+        prof = cProfile.Profile()
+        thread_profs = []
+        cpu0 = time.process_time()
+        try:
+            with meter:
+                if PER_THREAD:
+                    threading.setprofile(_thread_profiling(thread_profs))
+                prof.enable()
+                try:
+                    yield
+                finally:
+                    prof.disable()
+                    if PER_THREAD:
+                        threading.setprofile(None)
+        finally:
+            # 階段失敗時同樣寫出報表 (往往正是要看的那次)
+            _finish(name, market, prof, thread_profs, meter, time.process_time() - cpu0, before)
+    finally:
+        if started_trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _active.release()
+
+def _finish(name, market, prof, thread_profs, meter, cpu_secs, before):
+    """寫出單一階段的 pstats / CPU / 配置報表並記錄摘要"""
+    _, traced_peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{market}_{name}")
+        title = f"{market} / {name}"
+        stats = pstats.Stats(prof)
+        for p in thread_profs:
+            stats.add(p)
+        stats.dump_stats(base + ".pstats")
+        _write_cpu(stats, base + "_cpu.txt", title)
+        diff = after.compare_to(before, "lineno")
+        _write_alloc(base + "_alloc.txt", title, diff, meter.peak_snapshot)
+    except (OSError, TypeError) as e:
+        # 剖析報表失敗不影響管線本身
+        log(f"⚠️ [{market}] {name} 剖析報表寫出失敗: {e}")
+        return
+
+    rec = {"market": market, "stage": name, **meter.record(),
+           "cpu_seconds": round(cpu_secs, 3),
+           "traced_peak_mb": round(traced_peak / 2**20, 1),
+           "traced_net_mb": round(sum(d.size_diff for d in diff) / 2**20, 1),
+           "threads_profiled": len(thread_profs),
+           "files": [os.path.basename(base + s) for s in (".pstats", "_cpu.txt", "_alloc.txt")]}
+    RESULTS.append(rec)
+    log(f"🔬 [{market}] {name}: {rec['seconds']:.1f}s (CPU {rec['cpu_seconds']:.1f}s) | "
+        f"tracemalloc 峰值 {rec['traced_peak_mb']} MB | RSS 峰值 {rec['peak_rss_mb']} MB (+{rec['rss_growth_mb']})")
+
+def write_summary(label):
+    """寫出本程序各階段的剖析摘要；未啟用或無紀錄時回傳 None"""
+    if not PROFILE_DIR or not RESULTS:
+        return None
+    path = os.path.join(PROFILE_DIR, f"summary_{label}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"label": label, "pid": os.getpid(), "python": sys.version.split()[0],
+                   "per_thread": PER_THREAD, "stages": RESULTS}, f, ensure_ascii=False, indent=1)
+    return path
+
+def summary():
+    """終端機摘要：依記憶體高峰排序的各市場/階段"""
+    lines = [f"  {'市場/階段':<24}{'耗時':>8}{'CPU':>8}{'追蹤峰值':>10}{'RSS峰值':>10}{'RSS成長':>9}"]
+    for r in sorted(RESULTS, key=lambda r: -r["peak_rss_mb"]):
+        lines.append(f"  {r['market'] + '/' + r['stage']:<24}{r['seconds']:>7.1f}s{r['cpu_seconds']:>7.1f}s"
+                     f"{r['traced_peak_mb']:>8.1f}MB{r['peak_rss_mb']:>8.1f}MB{r['rss_growth_mb']:>7.1f}MB")
+    return "\n".join(lines)
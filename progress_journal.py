@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+下載進度日誌 (各市場共用的續跑機制)
+- data/<market>/lists/progress.jsonl，只附加寫入：第一行為表頭 (執行日、模式、標的清單)，
+  之後每完成一檔附加一行 {"k": 識別鍵, "s": 狀態}，最後以 {"done": true} 收尾
+- 寫入先進緩衝，累積 JOURNAL_FLUSH_RECORDS 筆或每 JOURNAL_FLUSH_SECS 秒由背景執行緒 flush + fsync
+- 同一執行日 (與模式) 的日誌未收尾即視為中斷：續跑沿用表頭的標的清單 (不再抓清單)，
+  已完成的標的直接沿用狀態，只下載其餘標的；錯誤狀態的標的重新下載
+- 程序被中止時最後一行可能只寫了一半，讀取時捨棄並截斷，之後從該處繼續附加
+RESUME=0 時一律重新開始
+"""
+import os
+import json
+import threading
+from datetime import datetime
+import pandas as pd
+from universe_store import list_dir, default_key
+
+RESUME_ENABLED = os.getenv("RESUME", "1") != "0"
+JOURNAL_NAME = "progress.jsonl"
+JOURNAL_FLUSH_SECS = float(os.getenv("JOURNAL_FLUSH_SECS", "2"))
+JOURNAL_FLUSH_RECORDS = 500
+# 續跑時重新下載的狀態 (其餘如 success / exists / empty 視為已完成)
+RETRY_STATUSES = {"error", "failed"}
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+class ProgressJournal:
+    """
+    單一市場一次下載的進度日誌
+    用法：load() 判斷是否續跑 -> begin(items) -> record(item, 狀態) ... -> finish(stats)
+    """
+    def __init__(self, market, mode=None, key=default_key):
+        self.market = market
+        self.path = os.path.join(list_dir(market), JOURNAL_NAME)
+        self.run = datetime.now().strftime("%Y-%m-%d") + (f":{mode}" if mode else "")
+        self.key = key
+        self.items = None
+        self.status = {}
+        self.resumed = False
+        self._valid_bytes = 0
+        self._buf = []
+        self._lock = threading.Lock()
+        self._f = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """找到同一執行日且未收尾的日誌時回傳 True，items / status 為上次的清單與各檔最後狀態"""
+        if not RESUME_ENABLED or not os.path.exists(self.path):
+            return False
+        header, status, valid = None, {}, 0
+        with open(self.path, "rb") as f:
+            for raw in f:
+                try:
+                    if not raw.endswith(b"\n"):
+                        raise ValueError("truncated")
+                    rec = json.loads(raw)
+                except ValueError:
+                    # 中止時寫到一半的最後一行
+                    break
+                valid += len(raw)
+                if header is None:
+                    header = rec
+                    if header.get("run") != self.run or not isinstance(header.get("items"), list):
+                        return False
+                elif rec.get("done"):
+                    return False
+                else:
+                    status[rec["k"]] = rec["s"]
+        if header is None:
+            return False
+        self.items, self.status, self._valid_bytes = header["items"], status, valid
+        self.resumed = True
+        n_done = sum(1 for s in status.values() if s not in RETRY_STATUSES)
+        log(f"♻️ [{self.market}] 續跑上次中斷的下載：{n_done}/{len(self.items)} 檔已完成 (起始 {header.get('started', '?')})")
+        return True
+
+    def begin(self, items):
+        """開始寫入：新執行以 items 覆寫日誌表頭，續跑則截掉殘缺行後繼續附加"""
+        if self.resumed:
+            self._f = open(self.path, "r+b")
+            self._f.truncate(self._valid_bytes)
+            self._f.seek(self._valid_bytes)
+        else:
+            self.items, self.status = list(items), {}
+            header = {"run": self.run, "market": self.market,
+                      "started": datetime.now().isoformat(timespec="seconds"), "items": self.items}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.path)
+            self._f = open(self.path, "ab")
+        self._thread = threading.Thread(target=self._flusher, name=f"journal-{self.market}", daemon=True)
+        self._thread.start()
+        return self
+
+    def split(self, items):
+        """續跑時回傳 ([(item, 先前狀態)], 待處理 items)；新執行則全部待處理"""
+        done, todo = [], []
+        for it in items:
+            s = self.status.get(self.key(it))
+            if s is not None and s not in RETRY_STATUSES:
+                done.append((it, s))
+            else:
+                todo.append(it)
+        return done, todo
+
+    def record(self, item, status):
+        """記錄單檔結果 (item 為清單項目或識別鍵)；可由多個執行緒同時呼叫"""
+        if item is None:
+            return
+        k = self.key(item)
+        line = json.dumps({"k": k, "s": status}, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.status[k] = status
+            self._buf.append(line)
+            if len(self._buf) >= JOURNAL_FLUSH_RECORDS:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buf or self._f is None:
+            return
+        self._f.write("".join(self._buf).encode("utf-8"))
+        self._buf.clear()
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flusher(self):
+        while not self._stop.wait(JOURNAL_FLUSH_SECS):
+            try:
+                self.flush()
+            except OSError as e:
+                log(f"⚠️ [{self.market}] 進度日誌寫入失敗: {e}")
+
+    def close(self, stats=None):
+        """寫出剩餘紀錄；stats 不為 None 時加上收尾行 (下次執行即重新開始)"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            if stats is not None:
+                self._buf.append(json.dumps({"done": True, "stats": stats}, ensure_ascii=False) + "\n")
+            self._flush_locked()
+            if self._f:
+                self._f.close()
+                self._f = None
+
+    def finish(self, stats):
+        self.close(stats)
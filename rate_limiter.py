@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import metrics
+
+# ========== 各主機預設節流參數 ==========
+# rate: 初始每秒請求數 | burst: 令牌桶容量 | concurrency: 初始同時連線數
+HOST_DEFAULTS = {
+    "yahoo": {"rate": 5.0, "burst": 10, "min_rate": 0.2, "max_rate": 25.0,
+              "concurrency": 4, "max_concurrency": 12},
+    "twse": {"rate": 1.0, "burst": 2, "max_rate": 3.0, "concurrency": 2, "max_concurrency": 3},
+    "nasdaqtrader": {"rate": 1.0, "burst": 2, "max_rate": 3.0, "concurrency": 2, "max_concurrency": 2},
+    "hkex": {"rate": 0.5, "burst": 1, "max_rate": 1.0, "concurrency": 1, "max_concurrency": 1},
+    "krx": {"rate": 5.0, "burst": 10, "max_rate": 20.0, "concurrency": 2, "max_concurrency": 4},
+    "eastmoney": {"rate": 0.5, "burst": 1, "max_rate": 1.0, "concurrency": 1, "max_concurrency": 1},
+}
+
+# 被限流後的冷卻時間 (秒)，連續限流時倍增
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 120.0
+
+def is_throttle_error(exc):
+    """判斷例外是否屬於限流或逾時 (需要大幅退讓的訊號)"""
+    name = type(exc).__name__
+    msg = str(exc)
+    if name == "YFRateLimitError" or "Timeout" in name or isinstance(exc, TimeoutError):
+        return True
+    return any(k in msg for k in ("Rate limited", "Too Many Requests", "429", "timed out"))
+
+class TaskCancelled(BaseException):
+    """
+    逾時任務在下一次取得限流名額前中止 (不再發出請求、也不再寫檔)
+    繼承 BaseException，才不會被下載器重試迴圈的 except Exception 當成一般失敗吞掉
+    """
+
+class TaskClock:
+    """
+    單一下載任務的計時：扣除在限流器排隊的時間，只計算實際執行的秒數
+    由 FetchEngine 綁定到執行任務的執行緒；cancel() 後該任務的下一次 acquire() 拋出 TaskCancelled
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.waited = 0.0
+        self.waiting_since = None
+        self.cancelled = False
+
+    def active_seconds(self, now=None):
+        now = time.monotonic() if now is None else now
+        queued = self.waited + (now - self.waiting_since if self.waiting_since is not None else 0.0)
+        return now - self.started - queued
+
+    def cancel(self):
+        self.cancelled = True
+
+_TASK = threading.local()
+
+def bind_task(clock):
+    """將任務計時綁定到目前執行緒 (None 解除綁定)"""
+    _TASK.clock = clock
+
+class _Request:
+    """單次請求的回報介面：呼叫端可在未拋出例外時主動標記限流"""
+    def __init__(self):
+        self.outcome = "ok"
+
+    def throttled(self):
+        self.outcome = "throttled"
+
+    def failed(self):
+        self.outcome = "error"
+
+class AdaptiveRateLimiter:
+    """
+    每個主機一組的令牌桶 + AIMD 自適應併發控制
+    - 回應正常：速率與併發數線性增加 (Additive Increase)
+    - 429 / 逾時：速率與併發數減半並進入冷卻 (Multiplicative Decrease)
+    """
+    def __init__(self, host, rate=2.0, burst=5, min_rate=0.1, max_rate=10.0,
+                 concurrency=2, min_concurrency=1, max_concurrency=8,
+                 increase=0.1, decrease=0.5):
+        self.host = host
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate, self.max_rate = float(min_rate), float(max_rate)
+        self.limit = float(concurrency)
+        self.min_concurrency, self.max_concurrency = int(min_concurrency), int(max_concurrency)
+        self.increase, self.decrease = increase, decrease
+
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._waiters = deque()
+        self._cooldown_until = 0.0
+        self._backoff = BACKOFF_BASE
+
+        self._started = None
+        self._last_done = None
+        self.counts = {"ok": 0, "throttled": 0, "error": 0}
+        self.units = 0  # 批次請求以標的數計，反映實際對主機造成的負載
+        self.peak_rate = self.rate
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, cost=1):
+        """
+        等待併發名額、冷卻期與令牌；cost 大於桶容量時以預支方式扣除
+        依到達順序放行 (FIFO)，避免大批次在 notify_all 的搶奪中一再落後而餓死
+        """
+        need = min(float(cost), self.burst)
+        clock = getattr(_TASK, "clock", None)
+        ticket = object()
+        with self._cond:
+            if self._started is None:
+                self._started = time.monotonic()
+            self._waiters.append(ticket)
+            if clock:
+                clock.waiting_since = time.monotonic()
+            try:
+                while True:
+                    if clock and clock.cancelled:
+                        raise TaskCancelled()
+                    now = time.monotonic()
+                    self._refill(now)
+                    if (self._waiters[0] is ticket and self._in_flight < int(self.limit)
+                            and now >= self._cooldown_until and self._tokens >= need):
+                        self._tokens -= cost
+                        self._in_flight += 1
+                        return
+                    if self._waiters[0] is not ticket:
+                        wait = None  # 等待前面的請求先取得名額
+                    elif now < self._cooldown_until:
+                        wait = self._cooldown_until - now
+                    elif self._tokens < need:
+                        wait = (need - self._tokens) / self.rate
+                    else:
+                        wait = None  # 等待其他請求釋放併發名額
+                    # 任務中的請求定期醒來檢查是否已被取消
+                    if clock:
+                        wait = 1.0 if wait is None else min(wait, 1.0)
+                    self._cond.wait(timeout=wait)
+            finally:
+                self._waiters.remove(ticket)
+                if clock:
+                    clock.waited += time.monotonic() - clock.waiting_since
+                    clock.waiting_since = None
+                self._cond.notify_all()
+
+    def release(self, outcome="ok", cost=1):
+        """
+        回報請求結果並調整速率/併發
+        成功時每次釋放固定增加 increase，與 cost 無關：批次請求只是一次往返，
+        若按標的數放大，一個 100 檔的批次就會把速率直接推到上限
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self.units += cost
+            self._last_done = time.monotonic()
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            if outcome == "ok":
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+                self._backoff = BACKOFF_BASE
+                self.peak_rate = max(self.peak_rate, self.rate)
+            elif outcome == "throttled":
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                self._tokens = min(self._tokens, 0.0)
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + self._backoff)
+                self._backoff = min(BACKOFF_MAX, self._backoff * 2)
+            self._cond.notify_all()
+
+    @contextmanager
+    def request(self, cost=1):
+        """
+        用法：
+            with limiter.request() as req:
+                data = fetch()
+                if looks_rate_limited(data): req.throttled()
+        例外會自動分類為 throttled / error 後再往外拋出
+        排隊 (等待令牌/併發名額/冷卻) 與請求本身的耗時分別記錄於 limiter_wait_seconds / request_seconds
+        """
+        t0 = time.perf_counter()
+        self.acquire(cost)
+        t1 = time.perf_counter()
+        metrics.observe("limiter_wait_seconds", t1 - t0, host=self.host)
+        req = _Request()
+        try:
+            yield req
+        except Exception as e:
+            req.outcome = "throttled" if is_throttle_error(e) else "error"
+            raise
+        finally:
+            self.release(req.outcome, cost)
+            metrics.observe("request_seconds", time.perf_counter() - t1, host=self.host, outcome=req.outcome)
+            metrics.inc("requests_total", host=self.host, outcome=req.outcome)
+
+    @property
+    def max_workers(self):
+        """執行緒池大小：以併發上限為準，實際同時請求數由 AIMD 控制"""
+        return self.max_concurrency
+
+    def stats(self):
+        with self._cond:
+            total = sum(self.counts.values())
+            elapsed = (self._last_done - self._started) if self._started and self._last_done else 0.0
+            return {
+                "host": self.host,
+                "requests": total,
+                "units": self.units,
+                **self.counts,
+                "effective_rate": round(self.units / elapsed, 2) if elapsed > 0 else 0.0,
+                "current_rate": round(self.rate, 2),
+                "peak_rate": round(self.peak_rate, 2),
+                "concurrency": int(self.limit),
+            }
+
+    def summary(self):
+        s = self.stats()
+        return (f"🚦 [{s['host']}] 請求 {s['requests']} 次 ({s['units']} 單位) | 有效速率 {s['effective_rate']}/s "
+                f"(峰值 {s['peak_rate']}/s) | 併發 {s['concurrency']} | 限流 {s['throttled']} | 錯誤 {s['error']}")
+
+_LIMITERS = {}
+_LOCK = threading.Lock()
+
+# 各市場行程都會連線的主機：平行模式下每個行程各有一組限流器，預算需依同時下載的行程數均分
+SHARED_HOSTS = {"yahoo"}
+_SHARE = 1
+
+def set_process_share(n):
+    """
+    本行程只分得共用主機 1/n 的預算 (速率、桶容量、併發上限)，讓 n 個同時下載的市場行程合計不超過單一行程的上限
+    需在第一次 get_limiter() 前呼叫 (平行模式的子行程入口)
+    """
+    global _SHARE
+    _SHARE = max(1, int(n))
+
+def _scaled(cfg, n):
+    out = dict(cfg)
+    for k in ("rate", "max_rate"):
+        if k in out:
+            out[k] = out[k] / n
+    if "burst" in out:
+        out["burst"] = max(1.0, out["burst"] / n)
+    for k in ("concurrency", "max_concurrency"):
+        if k in out:
+            out[k] = max(1, int(out[k]) // n)
+    if "min_rate" in out and "rate" in out:
+        out["min_rate"] = min(out["min_rate"], out["rate"])
+    return out
+
+def get_limiter(host, **overrides):
+    """取得 (或建立) 指定主機的共用限流器，同一程序內所有下載器共用同一實例"""
+    with _LOCK:
+        if host not in _LIMITERS:
+            cfg = {**HOST_DEFAULTS.get(host, {}), **overrides}
+            if host in SHARED_HOSTS and _SHARE > 1:
+                cfg = _scaled(cfg, _SHARE)
+            _LIMITERS[host] = AdaptiveRateLimiter(host, **cfg)
+        return _LIMITERS[host]
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# 專案為平鋪模組，測試直接匯入根目錄下的 .py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import analyzer
+
+BINS = [0, 10, 20, 30]
+
+def naive_bins(arr, bins):
+    """逐一比較的參考實作：區內維持原順序，極端區依報酬由高到低"""
+    groups = [[i for i, v in enumerate(arr) if lo <= v < hi] for lo, hi in zip(bins[:-1], bins[1:])]
+    extreme = [i for i, v in enumerate(arr) if v >= bins[-1]]
+    groups.append(sorted(extreme, key=lambda i: -arr[i]))
+    return groups
+
+def test_assign_bins_edges_and_order():
+    arr = [5, 10, 0, 35, 29.9, 30, 50, 9.99, 35]
+    groups = analyzer.assign_bins(arr, BINS)
+    assert [g.tolist() for g in groups] == [[0, 2, 7], [1], [4], [6, 3, 8, 5]]
+
+def test_assign_bins_drops_nan_and_below_range():
+    groups = analyzer.assign_bins([np.nan, -5, 15, np.nan, 40], BINS)
+    assert [g.tolist() for g in groups] == [[], [2], [], [4]]
+
+def test_assign_bins_matches_reference():
+    rng = np.random.default_rng(0)
+    arr = np.round(rng.normal(15, 20, 500), 1)
+    bins = list(range(-50, 60, 5))
+    assert [g.tolist() for g in analyzer.assign_bins(arr, bins)] == naive_bins(arr.tolist(), bins)
+
+def test_assign_bins_empty():
+    groups = analyzer.assign_bins([], BINS)
+    assert len(groups) == len(BINS) and all(len(g) == 0 for g in groups)
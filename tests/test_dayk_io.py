@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import dayk_io
+
+DATES = pd.date_range("2026-01-01", periods=40, freq="B").strftime("%Y-%m-%d").tolist()
+
+def bars(dates, close, header=("Date", "Open", "High", "Low", "Close", "Volume")):
+    close = np.asarray(close, dtype=float)
+    return pd.DataFrame(dict(zip(header, [dates, close, close + 1, close - 1, close, 1000])))
+
+def write_csv(path, dates, close, **kw):
+    bars(dates, close, **kw).to_csv(path, index=False, encoding="utf-8-sig")
+
+def delta(dates, close):
+    return bars(dates, close, header=("date", "open", "high", "low", "close", "volume"))
+
+@pytest.fixture
+def csv(tmp_path):
+    path = tmp_path / "AAA_Test.csv"
+    write_csv(path, DATES[:30], np.arange(30) + 100.0)
+    return path
+
+def test_appended_adds_only_new_bars(csv):
+    new = delta(DATES[25:35], np.arange(25, 35) + 100.0)
+    assert dayk_io.apply_delta(csv, new) == "appended"
+    out = pd.read_csv(csv, encoding="utf-8-sig")
+    assert out["Date"].tolist() == DATES[:35]
+    assert out["Close"].tolist() == list(np.arange(35) + 100.0)
+
+def test_unchanged_when_delta_has_no_new_bars(csv):
+    before = csv.read_bytes()
+    new = delta(DATES[25:30], np.arange(25, 30) + 100.0)
+    assert dayk_io.apply_delta(csv, new) == "unchanged"
+    assert csv.read_bytes() == before
+
+def test_rewritten_revises_last_bar_and_keeps_header(csv):
+    close = np.arange(25, 32) + 100.0
+    close[4] += 0.5  # 最後一根 (DATES[29]) 盤中修正
+    assert dayk_io.apply_delta(csv, delta(DATES[25:32], close)) == "rewritten"
+    out = pd.read_csv(csv, encoding="utf-8-sig")
+    assert list(out.columns) == ["Date", "Open", "High", "Low", "Close", "Volume"]
+    assert out["Date"].tolist() == DATES[:32]
+    assert out["Close"].iloc[29] == 129.5
+    assert out["Close"].iloc[:29].tolist() == list(np.arange(29) + 100.0)
+
+def test_refetch_when_overlap_price_was_adjusted(csv):
+    before = csv.read_bytes()
+    close = np.arange(25, 32) + 100.0
+    close[1] *= 0.5  # 重疊區間 (非最後一根) 價格變動：除權息/分割
+    assert dayk_io.apply_delta(csv, delta(DATES[25:32], close)) == "refetch"
+    assert csv.read_bytes() == before
+
+def test_refetch_when_no_overlap(csv):
+    assert dayk_io.apply_delta(csv, delta(DATES[32:35], [1.0, 2.0, 3.0])) == "refetch"
+
+def test_refetch_on_split_in_new_bars(csv):
+    new = delta(DATES[28:32], np.arange(28, 32) + 100.0)
+    new["stock splits"] = [0.0, 0.0, 2.0, 0.0]
+    assert dayk_io.apply_delta(csv, new) == "refetch"
+
+def test_sync_batch_outcomes(tmp_path):
+    """增量合併、價格調整改完整重抓、新標的完整下載、批次缺漏交由呼叫端補抓"""
+    paths = {s: tmp_path / f"{s}.csv" for s in ("INC", "ADJ", "NEW", "MISS")}
+    for s in ("INC", "ADJ", "MISS"):
+        write_csv(paths[s], DATES[:30], np.arange(30) + 100.0)
+    calls = []
+
+    def fetch(symbols, start):
+        calls.append((sorted(symbols), start))
+        out = {}
+        for s in symbols:
+            if s == "MISS":
+                continue
+            if start is None:
+                out[s] = delta(DATES[:32], np.arange(32) + 50.0)
+            else:
+                close = np.arange(25, 32) + 100.0
+                if s == "ADJ":
+                    close[:4] *= 0.5
+                out[s] = delta(DATES[25:32], close)
+        return out
+
+    res = dayk_io.sync_batch(list(paths.items()), fetch, lambda df: df)
+    assert set(res) == {"INC", "ADJ", "NEW"}
+    assert res["INC"] is None
+    assert len(res["ADJ"]) == 32 and len(res["NEW"]) == 32
+    assert calls[0][0] == ["ADJ", "INC", "MISS"] and calls[0][1] is not None
+    assert calls[1] == (["ADJ", "NEW"], None)
+    assert pd.read_csv(paths["INC"], encoding="utf-8-sig")["Date"].tolist() == DATES[:32]
+    assert pd.read_csv(paths["MISS"], encoding="utf-8-sig")["Date"].tolist() == DATES[:30]
+
+def test_read_tail_arrays_keeps_nan_rows(tmp_path):
+    path = tmp_path / "NAN.csv"
+    close = np.arange(10) + 1.0
+    close[7] = np.nan
+    write_csv(path, DATES[:10], close)
+    dates, vals = dayk_io.read_tail_arrays(path, 5)
+    assert dates == DATES[5:10]
+    assert np.isnan(vals[2, 0]) and vals[-1, 0] == 10.0
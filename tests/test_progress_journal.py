@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import progress_journal
+from progress_journal import ProgressJournal
+
+ITEMS = [f"T{i}&Name{i}" for i in range(6)]
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(progress_journal, "list_dir", lambda market: str(tmp_path))
+    monkeypatch.setattr(progress_journal, "RESUME_ENABLED", True)
+    return tmp_path
+
+def interrupted(statuses):
+    """模擬中斷：寫入部分紀錄後只 close (不收尾)"""
+    j = ProgressJournal("xx-share").begin(ITEMS)
+    for item, s in statuses:
+        j.record(item, s)
+    j.close()
+    return j.path
+
+def test_fresh_run_has_nothing_to_resume(journal_dir):
+    assert ProgressJournal("xx-share").load() is False
+
+def test_resume_keeps_done_and_retries_errors(journal_dir):
+    interrupted([(ITEMS[0], "success"), (ITEMS[1], "error"), (ITEMS[2], "empty")])
+    j = ProgressJournal("xx-share")
+    assert j.load() is True
+    assert j.items == ITEMS
+    done, todo = j.split(ITEMS)
+    assert done == [(ITEMS[0], "success"), (ITEMS[2], "empty")]
+    assert todo == [ITEMS[1]] + ITEMS[3:]
+
+def test_truncated_tail_line_is_dropped_and_overwritten(journal_dir):
+    path = interrupted([(ITEMS[0], "success"), (ITEMS[1], "success")])
+    with open(path, "ab") as f:
+        f.write(b'{"k": "T2", "s": "succ')  # 中止時寫到一半
+
+    j = ProgressJournal("xx-share")
+    assert j.load() is True
+    assert set(j.status) == {"T0", "T1"}
+    j.begin(ITEMS)
+    j.record(ITEMS[2], "success")
+    j.close()
+
+    lines = open(path, "rb").read().splitlines()
+    assert all(json.loads(ln) for ln in lines)
+    again = ProgressJournal("xx-share")
+    assert again.load() is True
+    assert again.status == {"T0": "success", "T1": "success", "T2": "success"}
+
+def test_finished_journal_starts_fresh(journal_dir):
+    j = ProgressJournal("xx-share").begin(ITEMS)
+    for it in ITEMS:
+        j.record(it, "success")
+    j.finish({"total": len(ITEMS)})
+    assert ProgressJournal("xx-share").load() is False
+
+def test_other_run_day_or_mode_is_not_resumed(journal_dir):
+    interrupted([(ITEMS[0], "success")])
+    assert ProgressJournal("xx-share", mode="hot").load() is False
+
+def test_resume_disabled(journal_dir, monkeypatch):
+    interrupted([(ITEMS[0], "success")])
+    monkeypatch.setattr(progress_journal, "RESUME_ENABLED", False)
+    assert ProgressJournal("xx-share").load() is False
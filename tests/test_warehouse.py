@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import warehouse
+
+DATES = pd.date_range("2026-01-01", periods=12, freq="B").strftime("%Y-%m-%d").tolist()
+BARS = {"AAA": 3, "BBB": 5, "CCC": 12}
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "prices.db")
+    conn = warehouse.connect(path)
+    warehouse.init_schema(conn)
+    with conn:
+        for sym, n in BARS.items():
+            conn.executemany(
+                f"INSERT INTO stock_prices ({', '.join(warehouse.PRICE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(d, sym, 1.0, i + 2.0, i + 0.5, i + 1.0, 100) for i, d in enumerate(DATES[:n])])
+    conn.close()
+    return path
+
+def window(path, n):
+    conn = warehouse.connect(path)
+    try:
+        return pd.read_sql_query(warehouse.WINDOW_SQL, conn, params=(n - 1,))
+    finally:
+        conn.close()
+
+def test_window_sql_returns_last_n_bars_per_symbol(db):
+    out = window(db, 5)
+    assert out.groupby("stem").size().to_dict() == {"AAA": 3, "BBB": 5, "CCC": 5}
+    ccc = out[out["stem"] == "CCC"]
+    assert ccc["date"].tolist() == DATES[7:12]
+    assert ccc["close"].tolist() == [8.0, 9.0, 10.0, 11.0, 12.0]
+    # 依代號、日期排序 (frame_matrix 依此決定欄位位置)
+    assert out[["stem", "date"]].apply(tuple, axis=1).is_monotonic_increasing
+
+def test_window_sql_shorter_than_every_symbol(db):
+    out = window(db, 1)
+    assert out.set_index("stem")["date"].to_dict() == {"AAA": DATES[2], "BBB": DATES[4], "CCC": DATES[11]}
+
+def test_window_sql_empty_table(tmp_path):
+    path = str(tmp_path / "empty.db")
+    conn = warehouse.connect(path)
+    warehouse.init_schema(conn)
+    conn.close()
+    assert window(path, 5).empty
+
+def test_last_bars(db):
+    tails = warehouse.last_bars(db, n=4)
+    assert set(tails) == set(BARS)
+    dates, closes = tails["AAA"]
+    assert dates == DATES[:3]
+    np.testing.assert_array_equal(closes, [1.0, 2.0, 3.0])
+    assert tails["CCC"][0] == DATES[8:12]
+
+def test_load_window(db, monkeypatch):
+    monkeypatch.setattr(warehouse, "db_path", lambda market: db)
+    prices, names = warehouse.load_window("hk-share", 4)
+    assert prices.groupby("stem").size().to_dict() == {"AAA": 3, "BBB": 4, "CCC": 4}
+    assert names == {}
+
+def test_revised_only_for_bars_before_the_last():
+    tail = (DATES[:5], np.array([1.0, 2.0, 3.0, 4.0, 5.0]))
+    same = pd.DataFrame({"date": DATES[3:7], "close": [4.0, 5.5, 6.0, 7.0]})
+    adjusted = pd.DataFrame({"date": DATES[3:7], "close": [2.0, 2.5, 3.0, 3.5]})
+    disjoint = pd.DataFrame({"date": DATES[6:8], "close": [7.0, 8.0]})
+    assert warehouse.revised(tail, same) is False
+    assert warehouse.revised(tail, adjusted) is True
+    assert warehouse.revised(tail, disjoint) is True
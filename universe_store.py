@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import pandas as pd
+from fetch_engine import http_get
+from price_provider import get_provider
+import metrics
+
+# ========== 標的清單快照設定 ==========
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 快照有效時數：期限內直接沿用，不發出任何請求
+UNIVERSE_TTL_HOURS = float(os.getenv("UNIVERSE_TTL_HOURS", "12"))
+SNAPSHOT_NAME = "universe.json"
+# 每次上市/下市異動附加一行，保留完整歷史
+CHANGES_NAME = "universe_changes.jsonl"
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+def list_dir(market):
+    """data/<market>/lists (CI 已快取此目錄)"""
+    path = os.path.join(BASE_DIR, "data", market, "lists")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def default_key(item):
+    """標的識別鍵："代號&名稱" 取代號，序列取第一欄，dict 取 code"""
+    if isinstance(item, str):
+        return item.split("&", 1)[0]
+    if isinstance(item, dict):
+        return str(item.get("code"))
+    return str(item[0])
+
+def load_snapshot(market):
+    path = os.path.join(list_dir(market), SNAPSHOT_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def save_snapshot(market, items, validators=None):
+    """原子寫入快照 (先寫暫存檔再取代)，避免中斷時留下半個 JSON"""
+    snap = {"market": market, "fetched_at": time.time(), "count": len(items),
+            "validators": validators or {}, "items": items}
+    path = os.path.join(list_dir(market), SNAPSHOT_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snap, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return snap
+
+def snapshot_age_hours(snap):
+    return (time.time() - float(snap.get("fetched_at", 0))) / 3600.0
+
+def diff_items(old_items, new_items, key=default_key):
+    """比對新舊清單，回傳 {"added": [...], "removed": [...]} (以識別鍵比對，名稱變更不算異動)"""
+    old_keys = {key(x) for x in old_items}
+    new_keys = {key(x) for x in new_items}
+    return {"added": [x for x in new_items if key(x) not in old_keys],
+            "removed": [x for x in old_items if key(x) not in new_keys]}
+
+def record_changes(market, diff):
+    if not diff["added"] and not diff["removed"]:
+        return
+    entry = {"date": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S"), **diff}
+    with open(os.path.join(list_dir(market), CHANGES_NAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def conditional_get(url, host, snapshot=None, **kwargs):
+    """
+    帶 If-None-Match / If-Modified-Since 的 GET
+    回傳 (resp, validators)；來源未變動 (304) 時 resp 為 None
+    """
+    old = ((snapshot or {}).get("validators") or {}).get(url) or {}
+    headers = dict(kwargs.pop("headers", None) or {})
+    if old.get("etag"):
+        headers["If-None-Match"] = old["etag"]
+    if old.get("last_modified"):
+        headers["If-Modified-Since"] = old["last_modified"]
+    resp = http_get(url, host, headers=headers, **kwargs)
+    if resp.status_code == 304:
+        return None, old
+    return resp, {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+
+def load_universe(market, fetch, key=default_key, ttl_hours=None, min_items=1):
+    """
+    取得市場標的清單 (快照優先)
+    fetch(snapshot): 回傳 (items, validators)；items 為 None 代表來源未變動，沿用快照
+    min_items: 新清單少於此數視為抓取失敗 (含備援名單)：有快照時沿用舊快照，且不寫入快照
+    回傳 (items, diff)，diff 為 {"added": [...], "removed": [...]}
+    """
+    with metrics.timer("list_fetch_seconds", market=market):
+        return _load_universe(market, fetch, key, ttl_hours, min_items)
+
+def _load_universe(market, fetch, key, ttl_hours, min_items):
+    ttl = UNIVERSE_TTL_HOURS if ttl_hours is None else ttl_hours
+    no_change = {"added": [], "removed": []}
+    # 重播模式：直接使用錄製時的清單，不碰快照也不連線
+    replayed = get_provider().universe(market)
+    if replayed is not None:
+        log(f"🎞️ [{market}] 使用封存清單 ({len(replayed)} 檔)")
+        metrics.inc("list_source_total", market=market, source="replay")
+        return replayed, no_change
+    snap = load_snapshot(market)
+
+    if snap and snapshot_age_hours(snap) < ttl:
+        log(f"📦 [{market}] 沿用清單快照 ({snap.get('count', len(snap['items']))} 檔，{snapshot_age_hours(snap):.1f} 小時前)")
+        metrics.inc("list_source_total", market=market, source="snapshot")
+        return snap["items"], no_change
+
+    items, validators = fetch(snap)
+    if items is None and snap:
+        # 來源回應 304：只更新快照時間
+        save_snapshot(market, snap["items"], {**snap.get("validators", {}), **(validators or {})})
+        log(f"📦 [{market}] 來源清單未變動，沿用快照 ({len(snap['items'])} 檔)")
+        metrics.inc("list_source_total", market=market, source="not_modified")
+        return snap["items"], no_change
+
+    items = items or []
+    if len(items) < min_items:
+        if snap:
+            log(f"⚠️ [{market}] 新清單僅 {len(items)} 檔，沿用舊快照 ({len(snap['items'])} 檔)")
+            get_provider().record_universe(market, snap["items"])
+            metrics.inc("list_source_total", market=market, source="fallback")
+            return snap["items"], no_change
+        return items, no_change
+
+    diff = diff_items(snap["items"], items, key) if snap else no_change
+    save_snapshot(market, items, validators)
+    get_provider().record_universe(market, items)
+    metrics.inc("list_source_total", market=market, source="fetched")
+    record_changes(market, diff)
+    if snap:
+        log(f"🔄 [{market}] 清單更新：共 {len(items)} 檔 | 新上市 {len(diff['added'])} | 下市 {len(diff['removed'])}")
+    return items, diff
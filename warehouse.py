@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+港股/日股 SQLite 倉儲存取
+- 連線一律使用 WAL 模式與調整過的 PRAGMA
+- WarehouseWriter：下載執行緒只把整理好的 K 線放入佇列，由單一連線以大批次交易寫入，不再互搶資料庫鎖
+- maintain()：空頁比例超過門檻才執行 VACUUM / ANALYZE，否則只做輕量的 PRAGMA optimize
+- load_window()：分析器以單一索引查詢取得每檔最後 N 根 K 棒與名稱，不需另存 CSV
+- last_bars() / delta_start() / revised()：hot 模式只抓最後日期往前重疊區間之後的 K 棒
+"""
+import os
+import time
+import queue
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from dayk_io import OVERLAP_DAYS, ADJUST_RTOL
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 以 SQLite 倉儲儲存價格的市場
+MARKET_DBS = {"hk-share": "hk_stock_warehouse.db", "jp-share": "jp_stock_warehouse.db"}
+
+# ========== 寫入設定 ==========
+# 累積到此列數即提交一次交易
+WRITE_BATCH_ROWS = int(os.getenv("WAREHOUSE_BATCH_ROWS", "50000"))
+# 佇列閒置或距上次提交超過此秒數也會提交，避免資料長時間停在記憶體
+WRITE_FLUSH_SECS = float(os.getenv("WAREHOUSE_FLUSH_SECS", "2"))
+# 佇列上限 (以標的數計)，寫入跟不上時讓下載端稍候
+QUEUE_MAX = 512
+# close() 等待寫入執行緒收尾的秒數上限
+CLOSE_TIMEOUT = float(os.getenv("WAREHOUSE_CLOSE_TIMEOUT", "300"))
+# 空頁 (freelist) 佔總頁數比例達此門檻才 VACUUM
+VACUUM_FREE_RATIO = float(os.getenv("WAREHOUSE_VACUUM_RATIO", "0.2"))
+# 增量同步時讀取的每檔最後 K 棒數 (需涵蓋 OVERLAP_DAYS 重疊區間)
+SYNC_TAIL_ROWS = 10
+
+PRICE_COLUMNS = ['date', 'symbol', 'open', 'high', 'low', 'close', 'volume']
+SCHEMA_SQL = (
+    '''CREATE TABLE IF NOT EXISTS stock_prices (
+           date TEXT, symbol TEXT, open REAL, high REAL,
+           low REAL, close REAL, volume INTEGER,
+           PRIMARY KEY (date, symbol))''',
+    '''CREATE TABLE IF NOT EXISTS stock_info (
+           symbol TEXT PRIMARY KEY,
+           name TEXT,
+           sector TEXT,
+           market TEXT,
+           updated_at TEXT)''',
+)
+# 主鍵為 (date, symbol)，逐檔區間查詢需另建 (symbol, date) 索引；含價格欄位即為覆蓋索引，不必回表
+INDEX_SQL = ("CREATE INDEX IF NOT EXISTS idx_prices_symbol_date "
+             "ON stock_prices (symbol, date, close, high, low)")
+# 每檔最後 N 根：以遞迴 CTE 沿索引逐一跳到下一個代號，再由第 N 新的日期起做區間查詢，
+# 只碰觸需要的索引項目 (參數為 N - 1)
+WINDOW_SQL = """
+    WITH RECURSIVE syms(symbol) AS (
+        SELECT MIN(symbol) FROM stock_prices
+        UNION ALL
+        SELECT (SELECT MIN(symbol) FROM stock_prices WHERE symbol > syms.symbol)
+        FROM syms WHERE syms.symbol IS NOT NULL
+    )
+    SELECT p.symbol AS stem, p.date, p.close, p.high, p.low
+    FROM syms JOIN stock_prices p INDEXED BY idx_prices_symbol_date ON p.symbol = syms.symbol
+    WHERE p.date >= COALESCE((SELECT date FROM stock_prices INDEXED BY idx_prices_symbol_date
+                              WHERE symbol = syms.symbol ORDER BY date DESC LIMIT 1 OFFSET ?), '')
+    ORDER BY p.symbol, p.date
+"""
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+)
+
+def log(msg: str):
+    print(f"{pd.Timestamp.now():%H:%M:%S}: {msg}")
+
+def connect(db_path, timeout=60):
+    """開啟倉儲連線並套用 WAL 與效能 PRAGMA (journal_mode 會寫入檔案，之後的連線沿用)"""
+    conn = sqlite3.connect(db_path, timeout=timeout)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def db_path(market):
+    """市場對應的倉儲路徑；非 SQLite 市場回傳 None"""
+    name = MARKET_DBS.get(market)
+    return os.path.join(BASE_DIR, name) if name else None
+
+def ensure_indexes(conn):
+    conn.execute(INDEX_SQL)
+
+def init_schema(conn):
+    """建立價格表、資訊表與索引 (已存在則略過)"""
+    for sql in SCHEMA_SQL:
+        conn.execute(sql)
+    ensure_indexes(conn)
+
+class WarehouseWriter:
+    """
+    單一寫入者：put() 可由多個下載執行緒同時呼叫，實際寫入只在背景執行緒進行
+    寫入失敗的批次其標的記錄於 failed，供呼叫端改列為失敗；
+    on_commit(symbols) 於每個批次提交成功後呼叫 (例如寫入進度日誌，確保記為完成的標的已落地)
+    """
+    def __init__(self, db_path, table="stock_prices", on_commit=None):
+        self.db_path = db_path
+        self.on_commit = on_commit
+        self.sql = (f"INSERT OR REPLACE INTO {table} ({', '.join(PRICE_COLUMNS)}) "
+                    f"VALUES ({', '.join(['?'] * len(PRICE_COLUMNS))})")
+        self.failed = []
+        self.rows = 0
+        self.commits = 0
+        self.error = None
+        self._q = queue.Queue(maxsize=QUEUE_MAX)
+        self._thread = threading.Thread(target=self._run, name="warehouse-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, symbol, df):
+        """放入單一標的 K 線 (需含 PRICE_COLUMNS)；轉為 tuple 在下載執行緒完成，寫入端只管執行"""
+        rows = list(df[PRICE_COLUMNS].itertuples(index=False, name=None))
+        if not rows:
+            return
+        # 寫入執行緒意外結束時不再等待佇列空位，直接列為失敗
+        while self._thread.is_alive():
+            try:
+                self._q.put((symbol, rows), timeout=WRITE_FLUSH_SECS)
+                return
+            except queue.Full:
+                pass
+        self.failed.append(symbol)
+
+    def _commit(self, conn, batch):
+        """提交一個批次；任何錯誤 (含壞資料列的 TypeError/OverflowError) 只讓該批標的列為失敗，寫入執行緒照常運作"""
+        try:
+            with conn, metrics.timer("write_seconds", mode="sqlite_batch"):
+                conn.executemany(self.sql, (r for _, rows in batch for r in rows))
+            self.rows += sum(len(rows) for _, rows in batch)
+            self.commits += 1
+        except Exception as e:
+            log(f"⚠️ 倉儲批次寫入失敗 ({len(batch)} 檔): {type(e).__name__}: {e}")
+            self.error = e
+            self.failed.extend(sym for sym, _ in batch)
+            return
+        if self.on_commit:
+            try:
+                self.on_commit([sym for sym, _ in batch])
+            except Exception as e:
+                # 資料已落地，回呼失敗 (例如進度日誌) 只影響續跑紀錄
+                log(f"⚠️ 倉儲提交回呼失敗: {type(e).__name__}: {e}")
+
+    def _run(self):
+        try:
+            conn = connect(self.db_path)
+        except Exception as e:
+            log(f"⚠️ 倉儲連線失敗，本次資料全數列為失敗: {type(e).__name__}: {e}")
+            self.error, conn = e, None
+        batch, n_rows, last = [], 0, time.time()
+        try:
+            while True:
+                try:
+                    item = self._q.get(timeout=WRITE_FLUSH_SECS)
+                except queue.Empty:
+                    item = ()
+                if item:
+                    batch.append(item)
+                    n_rows += len(item[1])
+                # 結束、佇列閒置、列數或時間達門檻時提交
+                if batch and (not item or n_rows >= WRITE_BATCH_ROWS or time.time() - last >= WRITE_FLUSH_SECS):
+                    if conn is None:
+                        self.failed.extend(sym for sym, _ in batch)
+                    else:
+                        self._commit(conn, batch)
+                    batch, n_rows, last = [], 0, time.time()
+                if item is None:
+                    break
+        finally:
+            if conn is not None:
+                try:
+                    # 合併 WAL 回主檔，讓單獨複製/快取 .db 檔也拿得到完整資料
+                    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    log(f"⚠️ WAL 合併失敗: {e}")
+                finally:
+                    conn.close()
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """送出剩餘資料並等待寫入完成 (最多 timeout 秒；逾時表示寫入執行緒卡住，回報後不再等待)"""
+        try:
+            self._q.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log(f"❌ 倉儲寫入逾時 ({timeout:.0f} 秒)，尚未確認寫入的資料可能遺失")
+        log(f"💾 倉儲寫入 {self.rows} 列，共 {self.commits} 次交易" + (f"，失敗 {len(self.failed)} 檔" if self.failed else "")
+            + (f" | 最後錯誤：{type(self.error).__name__}: {self.error}" if self.error else ""))
+        return self
+
+def maintain(db_path, threshold=VACUUM_FREE_RATIO):
+    """空頁比例達門檻才 VACUUM + ANALYZE；回傳是否執行"""
+    conn = sqlite3.connect(db_path)
+    try:
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        ratio = free / pages if pages else 0.0
+        if ratio < threshold:
+            conn.execute("PRAGMA optimize")
+            log(f"🧹 空頁比例 {ratio:.1%} 低於門檻 {threshold:.0%}，略過 VACUUM")
+            return False
+        log(f"🧹 空頁比例 {ratio:.1%}，執行 VACUUM + ANALYZE...")
+        conn.execute("VACUUM")
+        conn.execute("ANALYZE")
+        return True
+    finally:
+        conn.close()
+
+def last_bars(db_path, n=SYNC_TAIL_ROWS):
+    """
+    啟動時一次查詢所有標的最後 n 根 K 棒：{symbol: (日期清單, 收盤價陣列)}
+    無資料的標的不在結果中 (呼叫端改為完整下載)
+    """
+    if not os.path.exists(db_path):
+        return {}
+    conn = connect(db_path)
+    try:
+        ensure_indexes(conn)
+        rows = conn.execute(WINDOW_SQL, (int(n) - 1,)).fetchall()
+    finally:
+        conn.close()
+    out = {}
+    for sym, date, close, _, _ in rows:
+        out.setdefault(sym, ([], []))
+        out[sym][0].append(date)
+        out[sym][1].append(np.nan if close is None else close)
+    return {sym: (dates, np.array(closes, dtype=np.float64)) for sym, (dates, closes) in out.items()}
+
+def delta_start(tail):
+    """增量下載起始日：倉儲最後日期往前 OVERLAP_DAYS 天"""
+    return (pd.Timestamp(tail[0][-1]) - pd.Timedelta(days=OVERLAP_DAYS)).strftime("%Y-%m-%d")
+
+def revised(tail, df):
+    """
+    比對重疊區間收盤價：最後一根以外的既有 K 棒被修正 (除權息/分割調整)，
+    或新資料與倉儲完全沒有重疊時，回傳 True 代表需完整重抓
+    """
+    dates, closes = tail
+    stored = pd.Series(closes, index=dates)
+    new = pd.to_numeric(df.set_index('date')['close'], errors='coerce')
+    new = new[~new.index.duplicated(keep='last')]
+    common = stored.index.intersection(new.index)
+    if len(common) == 0:
+        return True
+    common = common[common < dates[-1]]
+    return not np.allclose(new[common].to_numpy(dtype=np.float64), stored[common].to_numpy(),
+                           rtol=ADJUST_RTOL, equal_nan=True)
+
+def load_window(market, window):
+    """
+    讀取每檔最後 window 根 K 棒 (長表：stem, date, close, high, low；依 stem、date 排序) 與 {代號: 名稱}
+    倉儲不存在或無資料時回傳 None
+    """
+    path = db_path(market)
+    if path is None or not os.path.exists(path):
+        return None
+    conn = connect(path)
+    try:
+        ensure_indexes(conn)
+        prices = pd.read_sql_query(WINDOW_SQL, conn, params=(int(window) - 1,))
+        try:
+            names = dict(conn.execute("SELECT symbol, name FROM stock_info").fetchall())
+        except sqlite3.Error:
+            names = {}
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        log(f"⚠️ [{market}] 倉儲讀取失敗: {e}")
+        return None
+    finally:
+        conn.close()
+    if prices.empty:
+        return None
+    return prices, names
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import time
+import pandas as pd
+from rate_limiter import get_limiter
+from price_provider import get_provider
+import metrics
+
+# 所有 Yahoo 請求共用同一個自適應限流器
+YAHOO = get_limiter("yahoo")
+
+# yf.Ticker().history() 的標準欄位順序，批次結果拆分後依此排列，確保 CSV 格式不變
+HISTORY_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume', 'Dividends', 'Stock Splits']
+
+def chunked(items, size):
+    """將清單依固定大小切塊 (size <= 1 時每塊僅一檔)"""
+    size = max(1, int(size))
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def history_kwargs(start=None, period="2y"):
+    """增量模式以 start 起抓，否則抓取完整 period"""
+    return {"start": start} if start else {"period": period}
+
+def fetch_history(symbol, **kwargs):
+    """經由共用限流器抓取單檔歷史 K 線 (取代各下載器自行 sleep)；來源由 PRICE_PROVIDER 決定"""
+    with YAHOO.request():
+        return get_provider().history(symbol, **kwargs)
+
+def fetch_history_batch(symbols, timeout=30, threads=True, **kwargs):
+    """
+    一次抓取多檔標的的歷史 K 線，並拆回 {symbol: DataFrame}
+    回傳的每個 DataFrame 與 yf.Ticker(symbol).history() 格式一致 (Date 索引、首字大寫欄位)，
+    無資料的標的不會出現在結果中，由呼叫端決定是否個別重試。
+    """
+    symbols = list(dict.fromkeys(symbols))
+    if not symbols:
+        return {}
+
+    with YAHOO.request(cost=len(symbols)) as req:
+        raw, throttled = get_provider().download(symbols, threads=threads, timeout=timeout, **kwargs)
+        if throttled:
+            req.throttled()
+    if raw is None or raw.empty:
+        return {}
+
+    t0 = time.perf_counter()
+    out = {}
+    multi = isinstance(raw.columns, pd.MultiIndex)
+    available = set(raw.columns.get_level_values(0)) if multi else set(symbols)
+    for sym in symbols:
+        if sym not in available:
+            continue
+        df = raw[sym] if multi else raw
+        if 'Close' not in df.columns:
+            continue
+        # 批次結果以所有標的的交易日聯集為索引，需剔除該檔無成交的列
+        df = df[df['Close'].notna()]
+        if df.empty:
+            continue
+        df = df[[c for c in HISTORY_COLUMNS if c in df.columns]].copy()
+        for col in ('Dividends', 'Stock Splits'):
+            if col in df.columns:
+                df[col] = df[col].fillna(0.0)
+        df.index.name = 'Date'
+        out[sym] = df
+    metrics.observe("parse_seconds", time.perf_counter() - t0, op="batch_split")
+    return out